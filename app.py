@@ -3,15 +3,64 @@ import argparse
 DEVICE_ID = "00000"
 DEVICE_NAME = f"TRAPMOS_{DEVICE_ID}"
 
+def overlap_fraction(value):
+    """argparse type for -overlap: tiles stop advancing at an overlap of 1."""
+    overlap = float(value)
+    if not 0 <= overlap < 1:
+        raise argparse.ArgumentTypeError(f"overlap must be in [0, 1), got {value}")
+    return overlap
+
 def main():
     from src.detection import run_detection
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-dev", action="store_true", help="Run in development mode")
+    parser.add_argument("-weights", default=None, help="Run on the CPU with these .pt or exported .onnx weights instead of TensorRT")
+    parser.add_argument("-threads", type=int, default=None, help="Intra-op threads for the CPU backend")
+    parser.add_argument("-tile", type=int, default=None, help="Detect on overlapping tiles of this size instead of the whole frame")
+    parser.add_argument("-overlap", type=overlap_fraction, default=0.2, help="Minimum overlap between tiles, as a fraction of the tile size")
+    parser.add_argument("-motion", action="store_true", help="Skip inference on static frames and infer only the regions that moved")
+    parser.add_argument("-source", default=None, help="Video file to read instead of the /dev/video0 camera")
+    parser.add_argument("-quality", action="store_true", help="Skip inference on blurry or badly exposed frames")
+    parser.add_argument("-min-sharpness", type=float, default=100.0, help="Lowest Laplacian variance of the quarter-size frame to infer")
+    parser.add_argument("-brightness", type=int, nargs=2, default=[40, 220], metavar=("MIN", "MAX"), help="Mean brightness range to infer")
+    parser.add_argument("-max-clipped", type=float, default=0.5, help="Largest fraction of black or white clipped pixels to infer")
+    parser.add_argument("-quality-stats", default=None, help="JSON file the quality gate's skip statistics are written to")
+    parser.add_argument("-payload", choices=["full", "crops"], default="full", help="Upload the whole frame, or crops around the detections under a thumbnail")
+    parser.add_argument("-jpeg-quality", type=int, default=95, help="JPEG quality of uploads, the highest with -adaptive-quality")
+    parser.add_argument("-adaptive-quality", action="store_true", help="Lower the JPEG quality while uploads back up on a slow link")
+    parser.add_argument("-index", choices=["firestore", "metadata"], default="firestore", help="Write a Firestore document per upload, or send the detections as the image's custom metadata in the same request")
+    parser.add_argument("-offline-first", action="store_true", help="Stop sending while the network is down and sync the backlog once it returns")
+    parser.add_argument("-disk-quota", type=float, default=None, help="MiB of unsent images kept on disk, the oldest are dropped beyond it")
+    parser.add_argument("-drain-order", choices=["oldest", "newest", "confidence"], default="oldest", help="Which unsent uploads go first")
+    parser.add_argument("-sync-rate", type=float, default=None, help="KiB per second uploads are limited to")
     args = parser.parse_args()
 
+    quality = None
+    if args.quality:
+        quality = {
+            "min_sharpness": args.min_sharpness,
+            "min_brightness": args.brightness[0],
+            "max_brightness": args.brightness[1],
+            "max_clipped": args.max_clipped,
+        }
+
+    payload = {
+        "profile": args.payload,
+        "quality": args.jpeg_quality,
+        "adaptive": args.adaptive_quality,
+    }
+
+    offline = {
+        "offline_after": 3 if args.offline_first else None,
+        "disk_quota": int(args.disk_quota * 1024 ** 2) if args.disk_quota else None,
+        "drain_order": args.drain_order,
+        "sync_rate": args.sync_rate * 1024 if args.sync_rate else None,
+    }
+
     print("Running in development mode..." if args.dev else "Running in normal mode...")
-    run_detection(args.dev)
+    run_detection(args.dev, args.weights, args.threads, args.tile, args.overlap, args.motion,
+                  quality, args.quality_stats, args.source, payload, args.index, offline)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,1559 @@
+import argparse
+import contextlib
+import io
+import json
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import cv2
+import numpy as np
+
+from src.backend import InferenceBackend, TorchBackend, ONNXBackend
+from src.boxes import box_iou
+from src.motion import MotionGate
+from src.capture import CameraCapture
+from src.streams import StreamDetector
+from src.tracker import Tracker
+from src.spool import UploadSpool
+from src.payload import PayloadEncoder
+from src.detections import DETECTION_DTYPE
+from src.pipeline import InferencePipeline
+from src.yoloDet import YoloTRT
+
+
+def synthetic_outputs(n, num_boxes=100, input_size=640, num_classes=3, seed=0):
+    """Random yololayer plugin outputs with clustered, overlapping boxes."""
+    rng = np.random.default_rng(seed)
+    outputs = np.zeros((n, 1 + num_boxes * 6), dtype=np.float32)
+    for output in outputs:
+        dets = output[1:].reshape(num_boxes, 6)
+        centers = rng.uniform(32, input_size - 32, (max(num_boxes // 8, 1), 2))
+        cluster = rng.integers(0, len(centers), num_boxes)
+        dets[:, :2] = centers[cluster] + rng.normal(0, 6, (num_boxes, 2))
+        dets[:, 2:4] = rng.uniform(12, 48, (num_boxes, 2))
+        dets[:, 4] = rng.uniform(0.1, 1.0, num_boxes)
+        dets[:, 5] = rng.integers(0, num_classes, num_boxes)
+        output[0] = num_boxes
+    return outputs
+
+
+class SyntheticBackend(InferenceBackend):
+    """Backend that cycles through synthetic plugin outputs, for benchmarks without a model."""
+    def __init__(self, num_boxes=100, batch_size=1, input_size=640, latency=0.0, seed=0):
+        self.batch_size = batch_size
+        self.input_h = self.input_w = input_size
+        self.latency = latency
+        self.outputs = synthetic_outputs(64, num_boxes, input_size, seed=seed)
+        self.calls = 0
+
+    def load(self):
+        self.input_buffer = np.zeros((self.batch_size, 3, self.input_h, self.input_w), dtype=np.float32)
+        return self
+
+    def infer(self, batch):
+        i = self.calls % len(self.outputs)
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)  # stands in for the accelerator, which releases the GIL
+        return np.repeat(self.outputs[i:i + 1], len(batch), axis=0)
+
+
+class EagerBackend(TorchBackend):
+    """Unfused checkpoint model run in eager mode, the PyTorch baseline."""
+    def load(self):
+        import torch
+        self.device = torch.device(self.device)
+        ckpt = torch.load(self.weights, map_location=self.device)
+        self.model = ckpt['ema' if ckpt.get('ema') else 'model'].float().eval()
+        self.input_buffer = np.empty((self.batch_size, 3, self.input_h, self.input_w), dtype=np.float32)
+        return self
+
+    def allocate_input(self, batch_size=1):
+        return InferenceBackend.allocate_input(self, batch_size)
+
+    def infer(self, batch):
+        import torch
+        with torch.no_grad():
+            pred = self.model(torch.from_numpy(batch).to(self.device))[0]
+        return self.to_plugin_output(pred.float().cpu().numpy())
+
+
+def reference_nms(model, prediction, origin_h, origin_w, conf_thres=0.5, nms_thres=0.4):
+    """The original per-pick greedy loop, kept as the parity baseline.
+
+    Like NonMaxSuppression it only looks at the NMS_TOPK most confident boxes.
+    """
+    boxes = prediction[prediction[:, 4] >= conf_thres]
+    if len(boxes) > model.NMS_TOPK:
+        boxes = boxes[np.argpartition(-boxes[:, 4], model.NMS_TOPK)[:model.NMS_TOPK]]
+    boxes[:, :4] = model.xywh2xyxy(origin_h, origin_w, boxes[:, :4])
+    boxes[:, 0] = np.clip(boxes[:, 0], 0, origin_w - 1)
+    boxes[:, 2] = np.clip(boxes[:, 2], 0, origin_w - 1)
+    boxes[:, 1] = np.clip(boxes[:, 1], 0, origin_h - 1)
+    boxes[:, 3] = np.clip(boxes[:, 3], 0, origin_h - 1)
+    boxes = boxes[np.argsort(-boxes[:, 4])]
+    keep_boxes = []
+    while boxes.shape[0]:
+        large_overlap = model.bbox_iou(np.expand_dims(boxes[0, :4], 0), boxes[:, :4]) > nms_thres
+        label_match = boxes[0, -1] == boxes[:, -1]
+        keep_boxes += [boxes[0]]
+        boxes = boxes[~(large_overlap & label_match)]
+    return np.stack(keep_boxes, 0) if len(keep_boxes) else np.array([])
+
+
+def reference_preprocess(model, img):
+    """The original copy-per-step letterbox, kept as the parity baseline."""
+    h, w, c = img.shape
+    image = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    r_w = model.input_w / w
+    r_h = model.input_h / h
+    if r_h > r_w:
+        tw = model.input_w
+        th = int(r_w * h)
+        tx1 = tx2 = 0
+        ty1 = int((model.input_h - th) / 2)
+        ty2 = model.input_h - th - ty1
+    else:
+        tw = int(r_h * w)
+        th = model.input_h
+        tx1 = int((model.input_w - tw) / 2)
+        tx2 = model.input_w - tw - tx1
+        ty1 = ty2 = 0
+    image = cv2.resize(image, (int(tw), int(th)))
+    image = cv2.copyMakeBorder(image, int(ty1), int(ty2), int(tx1), int(tx2), cv2.BORDER_CONSTANT, None, (128, 128, 128))
+    image = image.astype(np.float32)
+    image /= 255.0
+    image = np.transpose(image, [2, 0, 1])
+    image = np.expand_dims(image, axis=0)
+    image = np.ascontiguousarray(image)
+    return image
+
+
+def peak_bytes(fn):
+    """Peak bytes allocated by one call, as seen by tracemalloc."""
+    fn()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - start
+
+
+def timeit(fn, iters):
+    fn()
+    t = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - t) / iters * 1000
+
+
+def bench_nms(opt):
+    model = YoloTRT(conf=opt.conf, backend=SyntheticBackend())
+    outputs = synthetic_outputs(opt.iters, opt.boxes, model.input_w)
+    preds = [o[1:].reshape(-1, 6) for o in outputs]
+    h, w = 1080, 1920
+
+    for pred in preds:
+        old = reference_nms(model, pred.copy(), h, w, opt.conf, opt.iou)
+        new = model.NonMaxSuppression(pred.copy(), h, w, opt.conf, opt.iou)
+        assert np.array_equal(old, new), "vectorized NMS differs from the reference loop"
+
+    def run(nms):
+        def fn():
+            for pred in preds:
+                nms(pred.copy(), h, w, opt.conf, opt.iou)
+        return fn
+
+    old_ms = timeit(run(lambda *a: reference_nms(model, *a)), 3) / len(preds)
+    new_ms = timeit(run(model.NonMaxSuppression), 3) / len(preds)
+    print(f"NMS on {opt.boxes} boxes, the {model.NMS_TOPK} most confident kept, conf={opt.conf}, iou={opt.iou} "
+          f"({len(preds)} outputs, identical results)")
+    print(f"  loop:       {old_ms:.3f} ms/frame")
+    print(f"  vectorized: {new_ms:.3f} ms/frame ({old_ms / new_ms:.1f}x)")
+
+
+def bench_preprocess(opt):
+    model = YoloTRT(backend=SyntheticBackend())
+    input_buffer = model.backend.input_buffer
+    rng = np.random.default_rng(0)
+
+    print(f"Letterbox preprocessing to {model.input_w}x{model.input_h}")
+    for w, h in opt.sizes:
+        img = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        old = reference_preprocess(model, img)
+        new = model.PreProcessImg(img, input_buffer[:1])[0]
+        assert np.array_equal(old, new), "in-place preprocessing differs from the reference path"
+
+        old_fn = lambda: np.copyto(input_buffer[:1], reference_preprocess(model, img))
+        new_fn = lambda: model.PreProcessImg(img, input_buffer[:1])
+        old_ms, new_ms = timeit(old_fn, opt.iters), timeit(new_fn, opt.iters)
+        old_mb, new_mb = peak_bytes(old_fn) / 2 ** 20, peak_bytes(new_fn) / 2 ** 20
+        print(f"  {w}x{h}:")
+        print(f"    copy per step: {old_ms:7.3f} ms/frame {old_mb:7.2f} MiB allocated/frame")
+        print(f"    in place:      {new_ms:7.3f} ms/frame {new_mb:7.2f} MiB allocated/frame")
+
+
+def make_backend(opt, **kwargs):
+    if opt.weights and opt.weights.endswith(".onnx"):
+        return ONNXBackend(opt.weights, **kwargs)
+    if opt.weights:
+        return TorchBackend(opt.weights, **kwargs)
+    return SyntheticBackend(latency=opt.latency, **kwargs)
+
+
+def bench_pipeline(opt):
+    rng = np.random.default_rng(0)
+    w, h = opt.size
+    frames = [rng.integers(0, 256, (h, w, 3), dtype=np.uint8) for _ in range(opt.frames)]
+
+    model = YoloTRT(conf=opt.conf, backend=make_backend(opt))
+    t = time.perf_counter()
+    sequential = [model.Inference(img.copy())[0] for img in frames]
+    sequential_fps = len(frames) / (time.perf_counter() - t)
+    model.close()
+
+    model = YoloTRT(conf=opt.conf, backend=make_backend(opt))
+    pipeline = InferencePipeline(model, depth=opt.depth)
+    results = []
+    t = time.perf_counter()
+    for i, img in enumerate(frames):
+        pipeline.submit(img.copy(), i)
+        results += pipeline.completed()
+    results += pipeline.close()
+    pipelined_fps = len(frames) / (time.perf_counter() - t)
+    model.close()
+
+    assert [tag for _, tag, _, _ in results] == list(range(len(frames))), "pipeline reordered frames"
+    for expected, (_, _, detections, _) in zip(sequential, results):
+        assert len(expected) == len(detections), "pipeline changed detections"
+    backend = opt.weights or f"synthetic backend, {opt.latency * 1000:.0f} ms/call"
+    print(f"{len(frames)} frames at {w}x{h} ({backend})")
+    print(f"  sequential: {sequential_fps:6.1f} FPS")
+    print(f"  pipelined:  {pipelined_fps:6.1f} FPS (depth {opt.depth})")
+
+
+def bench_cpu(opt):
+    frame = cv2.imread(opt.source)
+    assert frame is not None, f"could not read {opt.source}"
+
+    results = {}
+    for name, backend in [
+        ("eager", EagerBackend(opt.weights, img_size=opt.img_size)),
+        ("optimized", TorchBackend(opt.weights, img_size=opt.img_size, threads=opt.threads)),
+    ]:
+        model = YoloTRT(conf=opt.conf, backend=backend)
+        model.Inference(frame)  # warm up
+        t = time.perf_counter()
+        for _ in range(opt.iters):
+            detections, _ = model.Inference(frame)
+        results[name] = (opt.iters / (time.perf_counter() - t), detections)
+        model.close()
+
+    (eager_fps, eager_dets), (fast_fps, fast_dets) = results["eager"], results["optimized"]
+    print(f"{opt.weights} at {opt.img_size} on {opt.source}, {opt.threads or 'default'} threads")
+    print(f"  eager:     {eager_fps:6.2f} FPS, {len(eager_dets)} detections")
+    print(f"  optimized: {fast_fps:6.2f} FPS, {len(fast_dets)} detections ({fast_fps / eager_fps:.1f}x)")
+    if len(eager_dets) == len(fast_dets) and len(eager_dets):
+        print(f"  max |conf delta|: {np.abs(np.sort(eager_dets['conf']) - np.sort(fast_dets['conf'])).max():.2e}")
+
+
+def onnx_rows(model, output, batch_id=0):
+    """What the End2End graph emits for a plugin output: NMS in input coordinates."""
+    pred = output[1:].reshape(-1, 6)[:int(output[0])].copy()
+    keep = reference_nms(model, pred, model.input_h, model.input_w, 0.0, model.IOU_THRESHOLD)
+    rows = np.zeros((len(keep), 7), dtype=np.float32)
+    if len(keep):
+        rows[:, 0] = batch_id
+        rows[:, 1:5] = keep[:, :4]
+        rows[:, 5] = keep[:, 5]
+        rows[:, 6] = keep[:, 4]
+    return rows
+
+
+def match_detections(model, a, b, iou_thres=0.5):
+    """Greedy one-to-one matching of two detection arrays by IoU and class."""
+    matched, deltas = 0, []
+    used = np.zeros(len(b), dtype=bool)
+    for box, conf, class_id in a:
+        if not len(b):
+            break
+        iou = model.bbox_iou(box[None], b["box"])
+        iou[used | (b["class_id"] != class_id)] = 0
+        j = iou.argmax()
+        if iou[j] >= iou_thres:
+            used[j] = True
+            matched += 1
+            deltas.append(abs(conf - b["conf"][j]))
+    return matched, max(deltas, default=0.0)
+
+
+def raw_predictions(case, num_boxes=256, input_size=640, num_classes=3, seed=0):
+    """(1, num_boxes, 5 + nc) decoded head outputs probing where ONNX_ORT and the Python NMS can differ.
+
+    "random" is clustered boxes, "iou" same-class pairs, apart from each
+    other, whose IoU is 0.1 give or take a pixel, "border" boxes of
+    neighbouring classes running off opposite input corners, which too small
+    a max_wh class offset brings together, and "scores" class scores straddling
+    the 0.1 score threshold with objectness above it. Rows a case does not
+    use have zero objectness.
+    """
+    rng = np.random.default_rng(seed)
+    pred = np.zeros((1, num_boxes, 5 + num_classes), dtype=np.float32)
+    p = pred[0]
+    cls = rng.integers(0, num_classes, num_boxes)
+    p[:, 4] = rng.uniform(0.5, 1.0, num_boxes)
+    p[np.arange(num_boxes), 5 + cls] = rng.uniform(0.6, 1.0, num_boxes)
+    if case == "random":
+        centers = rng.uniform(32, input_size - 32, (max(num_boxes // 8, 1), 2))
+        p[:, :2] = centers[rng.integers(0, len(centers), num_boxes)] + rng.normal(0, 6, (num_boxes, 2))
+        p[:, 2:4] = rng.uniform(12, 48, (num_boxes, 2))
+        p[100:, 4] = 0  # no more than the max_det the plugin layout holds before NMS
+    elif case == "iou":
+        # Two s x s boxes d apart overlap by (s - d) / (s + d), 0.1 at d = 0.9 / 1.1 * s
+        pairs = min(num_boxes // 2, 16)
+        s = rng.uniform(16, 64, pairs)
+        d = s * 0.9 / 1.1 + rng.uniform(-1, 1, pairs)
+        # One pair per 160 px cell, so pairs never overlap each other
+        x = 160 * (np.arange(pairs) % 4) + 40 + rng.uniform(-4, 4, pairs)
+        y = 160 * (np.arange(pairs) // 4) + 80 + rng.uniform(-4, 4, pairs)
+        p[:2 * pairs, 0] = np.concatenate([x, x + d])
+        p[:2 * pairs, 1] = np.concatenate([y, y])
+        p[:2 * pairs, 2] = p[:2 * pairs, 3] = np.concatenate([s, s])
+        cls[pairs:2 * pairs] = cls[:pairs]
+        p[:, 5:] = 0
+        p[np.arange(num_boxes), 5 + cls] = rng.uniform(0.6, 1.0, num_boxes)
+        p[2 * pairs:, 4] = 0
+    elif case == "border":
+        # The offset moves both x and y, so class c past the bottom right corner meets class c + 1
+        # past the top left one. Each class has at most one box in a corner, so none overlap their own
+        pairs = min(num_boxes // 2, num_classes - 1)
+        cls[:2 * pairs] = np.concatenate([np.arange(pairs), np.arange(pairs) + 1])
+        corner = np.concatenate([np.full(pairs, input_size), np.zeros(pairs)])
+        p[:2 * pairs, :2] = corner[:, None] + rng.uniform(-8, 8, (2 * pairs, 2))
+        p[:2 * pairs, 2:4] = rng.uniform(24, 64, (2 * pairs, 2))
+        p[:, 5:] = 0
+        p[np.arange(num_boxes), 5 + cls] = rng.uniform(0.6, 1.0, num_boxes)
+        p[2 * pairs:, 4] = 0
+    elif case == "scores":
+        centers = rng.uniform(32, input_size - 32, (num_boxes, 2))
+        p[:, :2] = centers
+        p[:, 2:4] = rng.uniform(12, 48, (num_boxes, 2))
+        p[:, 5:] = 0
+        p[np.arange(num_boxes), 5 + cls] = rng.uniform(0.05, 0.3, num_boxes)
+        p[64:, 4] = 0
+    return pred
+
+
+def unexplained_mismatches(model, a, b, iou_thres=0.1, score_thres=0.1):
+    """Detections of a and b without an identical one in the other that no known NMS difference explains.
+
+    A detection missing from the other side is explained when its score is
+    at most score_thres, which onnxruntime applies to objectness times class
+    score and the Python path to objectness alone, or when its IoU with a
+    detection of its class is above iou_thres with the +1 pixel convention
+    of the Python NMS and not without it, or the other way round. Whatever
+    an explained detection overlaps is explained too, as keeping or
+    suppressing it changes what it suppresses in turn.
+    """
+    both = np.concatenate([a, b])
+    same = lambda x, y: (x["class_id"] == y["class_id"]) & (np.abs(x["box"] - y["box"]).max(-1) < 1e-3)
+    missing = np.concatenate([~same(a[:, None], b[None, :]).any(1), ~same(b[:, None], a[None, :]).any(1)])
+    boxes = both["box"].astype(np.float64)
+    with_one, without = model.bbox_iou(boxes[:, None], boxes[None, :]), box_iou(boxes, boxes)
+    same_class = both["class_id"][:, None] == both["class_id"][None, :]
+    boundary = same_class & ((with_one > iou_thres) != (without > iou_thres))
+    overlapping = same_class & ((with_one > iou_thres) | (without > iou_thres))
+    explained = missing & ((both["conf"] <= score_thres + 1e-6) | boundary.any(1))
+    while True:
+        spread = explained | (missing & (overlapping & explained[None, :]).any(1))
+        if np.array_equal(spread, explained):
+            return int((missing & ~explained).sum())
+        explained = spread
+
+
+def exported_nms_parity(opt, cases=("random", "iou", "border", "scores"), num_boxes=256, num_classes=3):
+    """Runs raw predictions through the NMS head export.py appends, in onnxruntime, and through the Python NMS.
+
+    The head is exported by export.export_end2end with its defaults, over a
+    model that passes its input through, so the graph holds exactly the
+    ONNX_ORT NMS of a real export: IoU without the +1, a 0.1 score threshold
+    on objectness times class score and classes offset by max_wh. Fails on
+    any difference unexplained_mismatches does not put down to the first two.
+    """
+    import os
+    import tempfile
+    try:
+        import onnxruntime as ort
+        import torch
+        from export import export_end2end
+    except ImportError as e:
+        raise SystemExit(f"Exported NMS parity needs onnxruntime, and torch to export the NMS head: {e}")
+
+    class Passthrough(torch.nn.Module):
+        """Stands in for the network, its input being the decoded head output."""
+        def __init__(self):
+            super().__init__()
+            self.model = torch.nn.ModuleList([torch.nn.Identity()])  # End2End flags model[-1]
+
+        def forward(self, x):
+            return x.clone()  # ONNX_ORT scales the class scores in place
+
+    size = 640  # ORT_NMS traces with made-up indices up to 200, so num_boxes must be larger
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "nms.onnx")
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            export_end2end(Passthrough(), torch.zeros(1, num_boxes, 5 + num_classes), path, num_classes, size)
+        session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    in_graph = SyntheticBackend(input_size=size)
+    in_graph.nms_in_graph = True
+    python_backend, ort_backend = TorchBackend(None, img_size=size), ONNXBackend(None)
+    print(f"Exported NMS parity, onnxruntime {ort.__version__} against the Python NMS, conf {opt.conf}:")
+    for case in cases:
+        # Score thresholds only show below 0.1, as in the conf 0.001 of a mAP run
+        conf = 0.001 if case == "scores" else opt.conf
+        python_model = YoloTRT(conf=conf, backend=SyntheticBackend(input_size=size))
+        ort_model = YoloTRT(conf=conf, backend=in_graph)
+        python_dets, ort_dets = [], []
+        for seed in range(20):
+            pred = raw_predictions(case, num_boxes, size, num_classes, seed)
+            python_dets.append(python_model.Detections(python_backend.to_plugin_output(pred)[0], size, size))
+            rows = session.run(None, {session.get_inputs()[0].name: pred})[0]
+            ort_dets.append(ort_model.Detections(ort_backend.to_plugin_output(rows, 1)[0], size, size))
+        matched = sum(match_detections(python_model, a, b)[0] for a, b in zip(python_dets, ort_dets))
+        n_python, n_ort = sum(map(len, python_dets)), sum(map(len, ort_dets))
+        unexplained = sum(unexplained_mismatches(python_model, a, b) for a, b in zip(python_dets, ort_dets))
+        print(f"  {case:7}: python {n_python:5}, onnxruntime {n_ort:5}, matched {matched:5}, "
+              f"{unexplained} unexplained")
+        python_model.close()
+        ort_model.close()
+        assert unexplained == 0, f"{case}: {unexplained} detections differ beyond the IoU and score threshold conventions"
+
+
+def bench_onnx(opt):
+    # Packing round-trip only: to_plugin_output of the rows the Python NMS keeps must decode unchanged.
+    # It says nothing of onnxruntime's own NMS, which exported_nms_parity checks.
+    in_graph = SyntheticBackend()
+    in_graph.nms_in_graph = True
+    model = YoloTRT(conf=opt.conf, backend=SyntheticBackend())
+    graph_model = YoloTRT(conf=opt.conf, backend=in_graph)
+    packer = ONNXBackend(None)
+    h, w = model.input_h, model.input_w
+    for output in synthetic_outputs(200, input_size=w):
+        expected = model.Detections(output, h, w)
+        got = graph_model.Detections(packer.to_plugin_output(onnx_rows(model, output), 1)[0], h, w)
+        assert len(expected) == len(got), "in-graph NMS path keeps a different number of boxes"
+        for field in ("box", "conf", "class_id"):
+            assert np.allclose(expected[field], got[field], atol=1e-3), f"in-graph NMS path changes {field}"
+    print("In-graph output packing round-trip on 200 synthetic outputs: ok")
+    exported_nms_parity(opt)
+
+    if not (opt.model and opt.weights):
+        return
+    frame = cv2.imread(opt.source)
+    assert frame is not None, f"could not read {opt.source}"
+    results = {}
+    for name, backend in [
+        ("pytorch", TorchBackend(opt.weights, img_size=w, threads=opt.threads)),
+        ("onnxruntime", ONNXBackend(opt.model, threads=opt.threads)),
+    ]:
+        model = YoloTRT(conf=opt.conf, backend=backend)
+        model.Inference(frame)  # warm up
+        t = time.perf_counter()
+        for _ in range(opt.iters):
+            detections, _ = model.Inference(frame)
+        results[name] = ((time.perf_counter() - t) / opt.iters * 1000, detections)
+        model.close()
+
+    (torch_ms, torch_dets), (ort_ms, ort_dets) = results["pytorch"], results["onnxruntime"]
+    matched, conf_delta = match_detections(graph_model, torch_dets, ort_dets)
+    print(f"{opt.source}, {opt.threads or 'default'} threads")
+    print(f"  pytorch + python NMS: {torch_ms:7.2f} ms/frame, {len(torch_dets)} detections")
+    print(f"  onnxruntime end2end:  {ort_ms:7.2f} ms/frame, {len(ort_dets)} detections")
+    print(f"  matched {matched}/{max(len(torch_dets), len(ort_dets))}, max |conf delta| {conf_delta:.2e}")
+
+
+def labelled_images(source):
+    """(BGR image, pixel xyxy labels) for the images in source, with YOLO labels in a sibling labels/ dir."""
+    import glob
+    import os
+    for path in sorted(glob.glob(os.path.join(source, "*.*"))):
+        img = cv2.imread(path)
+        if img is None:
+            continue
+        h, w = img.shape[:2]
+        # Same layout as utils.datasets.img2label_paths
+        label_path = os.path.splitext(path.replace(os.sep + "images" + os.sep, os.sep + "labels" + os.sep))[0] + ".txt"
+        labels = np.zeros((0, 4))
+        if os.path.isfile(label_path):
+            xywhn = np.loadtxt(label_path, ndmin=2)[:, 1:5]
+            if len(xywhn):
+                xywh = xywhn * [w, h, w, h]
+                labels = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], 1)
+        yield img, labels
+
+
+def recall(dets, labels, iou_thres=0.5):
+    if not len(labels):
+        return 0, 0
+    if not len(dets):
+        return 0, len(labels)
+    return int((box_iou(labels, dets["box"]).max(1) >= iou_thres).sum()), len(labels)
+
+
+def bench_tiled(opt):
+    if opt.source:
+        images = list(labelled_images(opt.source))
+    else:
+        rng = np.random.default_rng(0)
+        w, h = opt.size
+        images = [(rng.integers(0, 256, (h, w, 3), dtype=np.uint8), np.zeros((0, 4))) for _ in range(opt.frames)]
+    assert images, f"no images in {opt.source}"
+
+    model = YoloTRT(conf=opt.conf, backend=make_backend(opt, batch_size=opt.batch_size))
+    stats = {}
+    for name, infer in [
+        ("letterbox", lambda img: model.Inference(img)[0]),
+        ("tiled", lambda img: model.InferenceTiled(img, opt.tile_size, opt.overlap)[0]),
+    ]:
+        infer(images[0][0])  # warm up
+        found = total = 0
+        t = time.perf_counter()
+        for img, labels in images:
+            f, n = recall(infer(img), labels)
+            found, total = found + f, total + n
+        stats[name] = (time.perf_counter() - t, found, total)
+    model.close()
+
+    tiles = sum(len(model.TileGrid(*img.shape[:2], opt.tile_size, opt.overlap)) for img, _ in images)
+    print(f"{len(images)} frames, {opt.tile_size}px tiles with {opt.overlap:.0%} overlap, {tiles / len(images):.1f} tiles/frame")
+    for name, (elapsed, found, total) in stats.items():
+        line = f"  {name:9}: {len(images) / elapsed:6.2f} frames/s"
+        if name == "tiled":
+            line += f", {tiles / elapsed:6.1f} tiles/s"
+        if total:
+            line += f", recall {found / total:.3f} ({found}/{total})"
+        print(line)
+
+
+def trap_video(frames, size, moving=0.2, seed=0):
+    """Static textured frames with sensor noise and a small blob crossing them for a `moving` fraction of the clip."""
+    rng = np.random.default_rng(seed)
+    w, h = size
+    background = cv2.GaussianBlur(rng.integers(0, 256, (h, w, 3), dtype=np.uint8), (0, 0), 3)
+    start = int(frames * (1 - moving) / 2)
+    end = start + int(frames * moving)
+    for i in range(frames):
+        frame = cv2.add(background, rng.integers(0, 4, (h, w, 3), dtype=np.uint8))
+        if start <= i < end:
+            x = int(w * (i - start) / max(end - start, 1))
+            cv2.circle(frame, (x, h // 2), 12, (20, 20, 20), -1)
+        yield frame
+
+
+def video_frames(source, limit):
+    cap = cv2.VideoCapture(source)
+    assert cap.isOpened(), f"could not open {source}"
+    while limit is None or limit > 0:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        limit = limit - 1 if limit is not None else None
+        yield frame
+    cap.release()
+
+
+def bench_motion(opt):
+    if opt.source:
+        frames = list(video_frames(opt.source, opt.frames))
+    else:
+        frames = list(trap_video(opt.frames, opt.size, opt.moving))
+    assert frames, f"no frames in {opt.source}"
+
+    model = YoloTRT(conf=opt.conf, backend=make_backend(opt, batch_size=opt.batch_size))
+    model.Inference(frames[0])  # warm up
+    wall, cpu = time.perf_counter(), time.process_time()
+    for frame in frames:
+        model.Inference(frame)
+    full = (time.perf_counter() - wall, time.process_time() - cpu)
+
+    gate = MotionGate(model, threshold=opt.threshold, pad=opt.pad, min_size=opt.min_size, refresh=opt.refresh)
+    wall, cpu = time.perf_counter(), time.process_time()
+    for frame in frames:
+        gate.infer(frame, gate.changed_regions(frame))
+    gated = (time.perf_counter() - wall, time.process_time() - cpu)
+    model.close()
+
+    stats = gate.stats()
+    backend = opt.weights or f"synthetic backend, {opt.latency * 1000:.0f} ms/call"
+    h, w = frames[0].shape[:2]
+    print(f"{len(frames)} frames at {w}x{h} from {opt.source or 'synthetic trap video'} ({backend})")
+    print(f"  skipped {stats['skipped_frames']} frames, inferred {stats['inferred_fraction']:.1%} of the pixels")
+    for name, (elapsed, cpu) in [("every frame", full), ("motion gate", gated)]:
+        print(f"  {name}: {len(frames) / elapsed:7.1f} FPS, {cpu / len(frames) * 1000:6.2f} ms CPU/frame")
+    print(f"  CPU saved: {1 - gated[1] / full[1]:.1%}")
+
+
+class SyntheticCamera:
+    """Stands in for /dev/video0: frames at a fixed rate, queued in `buffers` driver slots like V4L2.
+
+    Every fail_every frames a read fails, and the first fail_opens opens of
+    the device fail, to exercise reconnecting.
+    """
+    opens = 0
+
+    def __init__(self, fps=30, size=(640, 480), buffers=4, fail_every=None, fail_opens=0):
+        SyntheticCamera.opens += 1
+        self.fps = fps
+        self.buffers = buffers
+        self.fail_every = fail_every
+        self.opened = SyntheticCamera.opens > fail_opens
+        self.frame = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        self.start = time.time()
+        self.next = 0
+        self.reads = 0
+        self.times = {}
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, prop, value):
+        return True
+
+    def read(self):
+        self.reads += 1
+        if self.fail_every and self.reads % self.fail_every == 0:
+            return False, None
+        # The oldest frame still in the driver queue, waiting for the next one if it is empty
+        latest = int((time.time() - self.start) * self.fps)
+        self.next = max(self.next, latest - self.buffers + 1)
+        captured = self.start + self.next / self.fps
+        time.sleep(max(0.0, captured - time.time()))
+        self.next += 1
+        frame = self.frame.copy()
+        self.times[id(frame)] = captured
+        return True, frame
+
+    def release(self):
+        self.opened = False
+
+
+def bench_capture(opt):
+    def consume(read, camera):
+        ages = []
+        end = time.time() + opt.duration
+        while time.time() < end:
+            ret, frame = read()
+            if not ret:
+                continue
+            ages.append(time.time() - camera().times.pop(id(frame)))
+            time.sleep(opt.latency)  # the detector
+        return ages
+
+    results = {}
+    SyntheticCamera.opens = 0
+    camera = SyntheticCamera(opt.fps, buffers=opt.buffers)
+    results["inline read"] = (consume(camera.read, lambda: camera), None)
+
+    cameras = []
+    def opener():
+        cameras.append(SyntheticCamera(opt.fps, buffers=opt.buffers, fail_every=opt.fail_every, fail_opens=opt.fail_opens))
+        return cameras[-1]
+    SyntheticCamera.opens = 0
+    cap = CameraCapture(opener=opener, backoff=0.05, max_backoff=0.5)
+    results["capture thread"] = (consume(lambda: cap.read(timeout=1), lambda: cameras[-1]), cap.stats())
+    cap.release()
+
+    print(f"{opt.duration:.0f} s at {opt.fps} FPS, {opt.buffers} driver buffers, detector {opt.latency * 1000:.0f} ms/frame, "
+          f"a read fails every {opt.fail_every} frames")
+    for name, (ages, stats) in results.items():
+        ages = np.array(ages) * 1000
+        line = f"  {name:14}: {len(ages):4} frames, age mean {ages.mean():6.1f} ms, max {ages.max():6.1f} ms"
+        if stats:
+            line += f", {stats['dropped']} dropped, {stats['reconnects']} reconnects"
+        print(line)
+
+
+def write_trap_videos(directory, n, frames, size, fps):
+    """n synthetic trap clips as MJPG .avi files in directory."""
+    import os
+    paths = []
+    for i in range(n):
+        path = os.path.join(directory, f"trap{i}.avi")
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps, size)
+        for frame in trap_video(frames, size, seed=i):
+            writer.write(frame)
+        writer.release()
+        paths.append(path)
+    return paths
+
+
+def bench_streams(opt):
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        sources = opt.sources or write_trap_videos(tmp, opt.streams, 2 * opt.fps, opt.size, opt.fps)
+        print(f"{len(sources)} streams at {opt.fps} FPS, {opt.policy} policy ({opt.weights or f'synthetic backend, {opt.latency * 1000:.0f} ms/call'})")
+        for name, batch_size in [("one by one", 1), ("batched", len(sources))]:
+            model = YoloTRT(conf=opt.conf, backend=make_backend(opt, batch_size=batch_size))
+            service = StreamDetector(model, sources, policies=opt.policy, fps=opt.fps)
+            end = time.time() + opt.duration
+            for _ in service:
+                if time.time() > end:
+                    break
+            stats = service.stats()
+            service.close()
+            model.close()
+
+            print(f"  {name} (batch {batch_size}): {sum(s['fps'] for s in stats):6.1f} frames/s in total")
+            for i, s in enumerate(stats):
+                print(f"    stream {i}: {s['fps']:5.1f} FPS, latency {s['latency_ms']:6.1f} ms (p95 {s['latency_p95_ms']:6.1f}), "
+                      f"{s['dropped']} of {s['frames']} dropped")
+
+
+def trap_detections(frames, arrivals, stay, size=(1920, 1080), misses=0.1, seed=0):
+    """Per frame detections of mosquitoes that land at random times, wander and leave, with missed detections."""
+    rng = np.random.default_rng(seed)
+    w, h = size
+    start = rng.integers(0, frames, arrivals)
+    end = start + rng.integers(stay // 2, stay * 2, arrivals)
+    pos = rng.uniform([0, 0], [w - 40, h - 40], (arrivals, 2))
+    for f in range(frames):
+        pos += rng.normal(0, 2, pos.shape)
+        present = np.nonzero((start <= f) & (f < end) & (rng.random(arrivals) >= misses))[0]
+        dets = np.empty(len(present), dtype=DETECTION_DTYPE)
+        dets["box"] = np.concatenate([pos[present], pos[present] + 30], 1)
+        dets["conf"] = rng.uniform(0.7, 0.95, len(present))
+        dets["class_id"] = 0
+        yield dets
+
+
+def bench_tracker(opt):
+    frames = list(trap_detections(opt.frames, opt.arrivals, opt.stay))
+    image = np.random.default_rng(0).integers(0, 256, (1080, 1920, 3), dtype=np.uint8)
+
+    # The max_mosquito_counter heuristic it replaces
+    uploads, counter, t = 0, 0, time.perf_counter()
+    for dets in frames:
+        if len(dets) > counter:
+            counter = len(dets)
+            cv2.imencode(".jpg", image)
+            uploads += 1
+    heuristic = (uploads, time.perf_counter() - t)
+
+    tracker = Tracker()
+    uploads, update_time, t = 0, 0.0, time.perf_counter()
+    for f, dets in enumerate(frames):
+        t1 = time.perf_counter()
+        tracker.update(dets, f)
+        update_time += time.perf_counter() - t1
+        for _ in tracker.finished():
+            cv2.imencode(".jpg", image)
+            uploads += 1
+    tracked = (uploads, time.perf_counter() - t)
+
+    print(f"{opt.frames} frames, {opt.arrivals} mosquitoes staying ~{opt.stay} frames, 10% of detections missed")
+    print(f"  max counter: {heuristic[0]:4} uploads, {heuristic[1] * 1000:7.1f} ms")
+    print(f"  tracker:     {tracked[0]:4} uploads, {tracked[1] * 1000:7.1f} ms "
+          f"({update_time / len(frames) * 1e6:.0f} us/frame to track)")
+
+
+def upload_item(rng, image_bytes):
+    from datetime import datetime
+    dets = np.empty(3, dtype=DETECTION_DTYPE)
+    dets["box"] = rng.uniform(0, 1000, (3, 4))
+    dets["conf"] = rng.uniform(0.5, 1, 3)
+    dets["class_id"] = rng.integers(0, 3, 3)
+    data = {"timestamp": datetime.now(), "latitude": 14.1234, "longitude": 121.1234,
+            "detections": dets, "classes": ["Aedes Mosquito"] * 3}
+    return rng.bytes(image_bytes), data
+
+
+def bench_spool(opt):
+    import os
+    import queue
+    import tempfile
+    rng = np.random.default_rng(0)
+    items = [upload_item(rng, opt.image_kb * 1024) for _ in range(opt.items)]
+
+    print(f"{opt.items} uploads of {opt.image_kb} KiB in {opt.dir or 'a temporary directory'}")
+    q = queue.Queue()
+    put = timeit(lambda: [q.put(item) for item in items], 1) / opt.items
+    print(f"  in-memory queue: put {put:6.4f} ms")
+
+    for synchronous in ["FULL", "NORMAL"]:
+        with tempfile.TemporaryDirectory(dir=opt.dir) as tmp:
+            spool = UploadSpool(os.path.join(tmp, "uploads.db"), synchronous=synchronous)
+            latencies = []
+            for i, (image, data) in enumerate(items):
+                t = time.perf_counter()
+                spool.put(image, data, f"item{i}.jpg")
+                latencies.append(time.perf_counter() - t)
+            latencies = np.array(latencies) * 1000
+
+            t = time.perf_counter()
+            while True:
+                batch = spool.get_batch(opt.batch_size)
+                if not batch:
+                    break
+                spool.ack([item[0] for item in batch])
+            drain = opt.items / (time.perf_counter() - t)
+            spool.close()
+        print(f"  spool {synchronous:6}:   put {latencies.mean():6.2f} ms mean, p99 {np.percentile(latencies, 99):6.2f} ms, "
+              f"max {latencies.max():6.2f} ms; dequeue {drain:7.0f} items/s in batches of {opt.batch_size}")
+
+
+def utcnow():
+    """Naive UTC now, the way google-auth keeps credential expiries."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class FakeCredentials:
+    """Stands in for the service account credentials when uploading to a MockFirebase.
+
+    Without a lifetime the token never changes or expires. With one, every
+    refresh takes refresh_delay seconds, like a real token request, and
+    issues a new token expiring lifetime seconds later; issued maps every
+    token to its expiry. The first `unreachable` refreshes fail like on a
+    device booting without network, and there is no token until one works.
+    """
+    project_id = "trapmos-test"
+
+    def __init__(self, lifetime=None, refresh_delay=0.0, unreachable=0):
+        self.lifetime = lifetime
+        self.refresh_delay = refresh_delay
+        self.unreachable = unreachable
+        self.token = None if unreachable else "test-token"
+        self.expiry = None
+        self.issued = {}
+
+    def refresh(self, request):
+        if self.unreachable:
+            self.unreachable -= 1
+            raise OSError("network unreachable")
+        if self.lifetime is None:
+            return
+        time.sleep(self.refresh_delay)
+        self.expiry = utcnow() + timedelta(seconds=self.lifetime)
+        self.token = f"test-token-{len(self.issued)}"
+        self.issued[self.token] = self.expiry
+
+
+class MockFirebase:
+    """Local HTTP server answering the Storage and Firestore REST calls the uploader makes.
+
+    Every request waits `latency` seconds, like a slow cellular link, and
+    is counted per method in requests. Documents written with
+    documents:commit are collected in documents and counted, rewrites
+    included, in writes. Uploaded objects are collected in objects with
+    their custom metadata, None unless sent as a multipart upload. The first `poison`
+    documents committed are bad: commits containing them together with
+    others fail with a 400, while committing them alone succeeds. The next `reject` documents
+    are rejected with a 400 every time. Storage uploads are counted in
+    uploads.
+
+    Faults can be injected: error_rate of the requests answer 503 and
+    timeout_rate hang for `hang` seconds, and during `outage`, a (start,
+    duration) in seconds after the server started, every request answers
+    503 and is counted in outage_requests.
+
+    Given the FakeCredentials the uploader uses, requests with a token they
+    did not issue, or one that expired, answer 401 and are counted in
+    unauthorized. skew makes the server's clock run skew seconds ahead, so
+    tokens expire early.
+
+    bandwidth, in bytes per second, makes the requests share one link: each
+    waits its turn and then len(body) / bandwidth seconds. Setting
+    network_up to False cuts the connection of every request, like a
+    dropped cellular link, and counts them and their bytes in down_requests
+    and down_bytes.
+    """
+    def __init__(self, latency=0.0, poison=0, reject=0, error_rate=0.0, timeout_rate=0.0, hang=10.0, outage=None,
+                 credentials=None, skew=0.0, bandwidth=None, seed=0):
+        self.latency = latency
+        self.poison = poison
+        self.reject = reject
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.outage = outage
+        self.credentials = credentials
+        self.skew = skew
+        self.bandwidth = bandwidth
+        self.requests = {}
+        self.documents = set()
+        self.writes = 0
+        self.objects = {}
+        self.uploads = 0
+        self.network_up = True
+        self.down_requests = 0
+        self.down_bytes = 0
+        self.outage_requests = 0
+        self.unauthorized = 0
+        self.__bad = set()
+        self.__rejected = set()
+        self.__rng = np.random.default_rng(seed)
+        self.__started = None
+        self.url = None
+        self.__loop = None
+        self.__runner = None
+
+    def __enter__(self):
+        import asyncio
+        import threading
+        from aiohttp import web
+
+        link = None
+
+        async def handle(request):
+            nonlocal link
+            if not self.network_up:
+                self.down_requests += 1
+                self.down_bytes += request.content_length or 0
+                request.transport.close()
+                return web.Response()
+            self.requests[request.method] = self.requests.get(request.method, 0) + 1
+            body = await request.read()
+            if self.bandwidth:
+                link = link or asyncio.Lock()
+                async with link:
+                    await asyncio.sleep(len(body) / self.bandwidth)
+            await asyncio.sleep(self.latency)
+            if self.credentials is not None:
+                token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+                expiry = self.credentials.issued.get(token)
+                if expiry is None or expiry <= utcnow() + timedelta(seconds=self.skew):
+                    self.unauthorized += 1
+                    return web.json_response({"error": {"code": 401, "message": "invalid token"}}, status=401)
+            if self.outage and 0 <= time.monotonic() - self.__started - self.outage[0] < self.outage[1]:
+                self.outage_requests += 1
+                return web.json_response({"error": {"code": 503, "message": "outage"}}, status=503)
+            fault = self.__rng.random()
+            if fault < self.error_rate:
+                return web.json_response({"error": {"code": 503, "message": "injected"}}, status=503)
+            if fault < self.error_rate + self.timeout_rate:
+                await asyncio.sleep(self.hang)
+            if request.path.endswith(":commit"):
+                names = [write["update"]["name"] for write in json.loads(body)["writes"]]
+                for name in names:
+                    if name in self.documents or name in self.__bad or name in self.__rejected:
+                        continue
+                    if self.poison:
+                        self.poison -= 1
+                        self.__bad.add(name)
+                    elif self.reject:
+                        self.reject -= 1
+                        self.__rejected.add(name)
+                if self.__rejected.intersection(names):
+                    return web.json_response({"error": {"code": 400, "message": "invalid document"}}, status=400)
+                bad = self.__bad.intersection(names)
+                if bad and len(names) == 1:
+                    self.__bad -= bad
+                elif bad:
+                    return web.json_response({"error": {"code": 400, "message": f"bad documents {bad}"}}, status=400)
+                self.documents.update(names)
+                self.writes += len(names)
+                return web.json_response({"writeResults": [{}] * len(names), "commitTime": "2024-01-01T00:00:00Z"})
+            name = request.query.get("name")
+            if request.method != "POST":
+                return web.Response()
+            self.uploads += 1
+            if request.content_type == "multipart/related":
+                boundary = request.headers["Content-Type"].split("boundary=")[1].encode()
+                parts = [part.split(b"\r\n\r\n", 1)[1] for part in body.split(b"--" + boundary)[1:-1]]
+                resource = json.loads(parts[0])
+                if len(parts) != 2 or resource["name"] != name or not parts[1].startswith(b"\xff\xd8"):
+                    return web.json_response({"error": {"code": 400, "message": "bad multipart upload"}}, status=400)
+                self.objects[name] = resource.get("metadata")
+            else:
+                self.objects[name] = None
+            return web.json_response({"name": name})
+
+        async def start():
+            app = web.Application(client_max_size=64 * 1024 ** 2)
+            app.router.add_route("*", "/{tail:.*}", handle)
+            self.__runner = web.AppRunner(app, access_log=None)
+            await self.__runner.setup()
+            site = web.TCPSite(self.__runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            self.url = f"http://127.0.0.1:{port}"
+            self.__started = time.monotonic()
+
+        self.__loop = asyncio.new_event_loop()
+        threading.Thread(target=self.__loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(start(), self.__loop).result()
+        return self
+
+    def __exit__(self, *args):
+        import asyncio
+        asyncio.run_coroutine_threadsafe(self.__runner.cleanup(), self.__loop).result()
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+
+
+def run_uploads(items, tmp, url, quiet=True, interval=0.0, credentials=None, **kwargs):
+    """Uploads items to a MockFirebase at url and returns the uploader and the seconds it took.
+
+    Items are scheduled interval seconds apart, like detections coming in over time.
+    """
+    import os
+    from src.firebase import DetectionUploader
+    output = io.StringIO() if quiet else None
+    with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+        uploader = DetectionUploader(spool_path=os.path.join(tmp, f"uploads{time.monotonic_ns()}.db"),
+                                     credentials=credentials or FakeCredentials(), storage_url=url, firestore_url=url,
+                                     **kwargs)
+        t = time.perf_counter()
+        for image, data in items:
+            uploader.schedule_for_upload(image, data)
+            time.sleep(interval)
+        uploader.wait_for_completion()
+        return uploader, time.perf_counter() - t
+
+
+def bench_upload(opt):
+    import tempfile
+    rng = np.random.default_rng(0)
+    items = [upload_item(rng, opt.image_kb * 1024) for _ in range(opt.items)]
+    print(f"{opt.items} uploads of {opt.image_kb} KiB to a local mock Firebase")
+    with tempfile.TemporaryDirectory() as tmp:
+        for latency in opt.latencies:
+            with MockFirebase(latency) as server:
+                for concurrency in opt.concurrency:
+                    _, elapsed = run_uploads(items, tmp, server.url, concurrency=concurrency)
+                    print(f"  {latency * 1000:4.0f} ms latency, {concurrency:2} workers: {opt.items / elapsed:6.1f} uploads/s")
+
+
+def bench_commit(opt):
+    import tempfile
+    rng = np.random.default_rng(0)
+    items = [upload_item(rng, opt.image_kb * 1024) for _ in range(opt.items)]
+    print(f"{opt.items} uploads, {opt.concurrency} workers, {opt.latency * 1000:.0f} ms per request, "
+          f"{opt.poison} bad documents, {opt.reject} always rejected")
+    times = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for commit_size in [1, opt.commit_size]:
+            with MockFirebase(opt.latency, poison=opt.poison, reject=opt.reject) as server:
+                uploader, elapsed = run_uploads(items, tmp, server.url, concurrency=opt.concurrency,
+                                                commit_size=commit_size, commit_delay=opt.commit_delay)
+            written = opt.items - opt.reject
+            assert len(server.documents) == written, f"{len(server.documents)} of {written} documents written"
+            assert uploader.rejected == opt.reject, f"{uploader.rejected} of {opt.reject} documents rejected"
+            assert server.uploads == opt.items, f"{server.uploads} image uploads for {opt.items} items"
+            print(f"  commit size {commit_size:3}: {elapsed:6.2f} s, {server.requests.get('POST', 0)} requests "
+                  f"for {len(server.documents)} documents, {server.uploads} images, {uploader.rejected} rejected")
+            times[commit_size] = elapsed
+    saved = times[1] - times[opt.commit_size]
+    print(f"  batching saved {saved:.2f} s of {times[1]:.2f} s ({saved / times[1]:.0%})")
+
+
+def bench_faults(opt):
+    import tempfile
+    rng = np.random.default_rng(0)
+    items = [upload_item(rng, opt.image_kb * 1024) for _ in range(opt.items)]
+    outage = (opt.outage_start, opt.outage)
+    print(f"{opt.items} uploads, {opt.error_rate:.0%} 503s, {opt.timeout_rate:.0%} timeouts, "
+          f"{opt.outage:g} s outage after {opt.outage_start:g} s")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, threshold in [("no breaker", 10 ** 9), ("breaker", opt.breaker_threshold)]:
+            with MockFirebase(opt.latency, error_rate=opt.error_rate, timeout_rate=opt.timeout_rate,
+                              hang=opt.request_timeout * 2, outage=outage) as server:
+                _, elapsed = run_uploads(items, tmp, server.url, concurrency=opt.concurrency, commit_delay=0.1,
+                                         request_timeout=opt.request_timeout, retry_base=0.05, retry_cap=1.0,
+                                         breaker_threshold=threshold, breaker_reset=opt.breaker_reset)
+            assert len(server.documents) == opt.items, f"{len(server.documents)} of {opt.items} documents written"
+            print(f"  {name:10}: all {opt.items} delivered in {elapsed:5.2f} s, {sum(server.requests.values())} requests, "
+                  f"{server.outage_requests} during the outage")
+
+
+def bench_auth(opt):
+    import tempfile
+    rng = np.random.default_rng(0)
+    items = [upload_item(rng, opt.image_kb * 1024) for _ in range(opt.items)]
+    duration = opt.items * opt.interval
+    print(f"{opt.items} uploads over {duration:g} s with tokens valid for {opt.lifetime:g} s, "
+          f"refreshes taking {opt.refresh_delay * 1000:g} ms")
+    scenarios = [
+        ("refresh ahead", opt.margin, 0.0, 0),
+        ("on 401 only", -10 ** 9, 0.0, 0),  # the background refresh never comes due
+        (f"{opt.skew:g} s skew", opt.margin, opt.skew, 0),
+        ("offline start", opt.margin, 0.0, 3),  # offline first, no token until the fourth request for one
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, margin, skew, unreachable in scenarios:
+            credentials = FakeCredentials(opt.lifetime, opt.refresh_delay, unreachable)
+            with MockFirebase(opt.latency, credentials=credentials, skew=skew) as server:
+                _, elapsed = run_uploads(items, tmp, server.url, interval=opt.interval, credentials=credentials,
+                                         concurrency=opt.concurrency, commit_delay=0.1, retry_base=0.05,
+                                         retry_cap=1.0, token_margin=margin,
+                                         offline_after=3 if unreachable else None, probe_interval=0.05)
+            assert len(server.documents) == opt.items, f"{len(server.documents)} of {opt.items} documents written"
+            print(f"  {name:13}: all {opt.items} delivered in {elapsed:5.2f} s, {len(credentials.issued)} tokens, "
+                  f"{server.unauthorized} requests rejected with 401 of {sum(server.requests.values())}")
+
+
+def bench_stress(opt):
+    import os
+    import tempfile
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from src.firebase import DetectionUploader
+    rng = np.random.default_rng(0)
+    total = opt.threads * opt.items
+    items = [upload_item(rng, opt.image_kb * 1024) for _ in range(total)]
+
+    def submit(uploader, items):
+        start = threading.Barrier(opt.threads)
+
+        def producer(chunk):
+            start.wait()
+            for image, data in chunk:
+                uploader.schedule_for_upload(image, data)
+
+        with ThreadPoolExecutor(opt.threads) as pool:
+            list(pool.map(producer, [items[i::opt.threads] for i in range(opt.threads)]))
+
+    with tempfile.TemporaryDirectory() as tmp, MockFirebase(opt.latency) as server:
+        print(f"{opt.threads} threads submitting {opt.items} uploads each")
+        with contextlib.redirect_stdout(io.StringIO()):
+            uploader = DetectionUploader(spool_path=os.path.join(tmp, "drain.db"), concurrency=opt.concurrency,
+                                         commit_delay=0.1, credentials=FakeCredentials(),
+                                         storage_url=server.url, firestore_url=server.url)
+            t = time.perf_counter()
+            submit(uploader, items)
+            submitted = time.perf_counter() - t
+            left = uploader.wait_for_completion()
+            elapsed = time.perf_counter() - t
+        assert left == 0 and len(server.documents) == total, f"{len(server.documents)} of {total} documents written"
+        print(f"  drain:    {total} submitted in {submitted:5.2f} s, all delivered in {elapsed:5.2f} s, "
+              f"{server.writes - total} rewritten")
+
+    with tempfile.TemporaryDirectory() as tmp, MockFirebase(opt.slow_latency) as server:
+        spool_path = os.path.join(tmp, "deadline.db")
+        with contextlib.redirect_stdout(io.StringIO()):
+            uploader = DetectionUploader(spool_path=spool_path, concurrency=opt.concurrency, commit_delay=0.1,
+                                         credentials=FakeCredentials(), storage_url=server.url,
+                                         firestore_url=server.url)
+            submit(uploader, items)
+            t = time.perf_counter()
+            left = uploader.wait_for_completion(timeout=opt.deadline)
+            closed = time.perf_counter() - t
+            sent = len(server.documents)
+            # The next start sends what was left
+            uploader = DetectionUploader(spool_path=spool_path, concurrency=opt.concurrency, commit_delay=0.1,
+                                         credentials=FakeCredentials(), storage_url=server.url,
+                                         firestore_url=server.url)
+            uploader.wait_for_completion()
+        assert len(server.documents) == total, f"{len(server.documents)} of {total} documents written"
+        print(f"  deadline: stopped {closed:5.2f} s after a {opt.deadline:g} s deadline with {sent} sent and "
+              f"{left} left, all delivered after restarting, {server.writes - total} rewritten")
+
+
+def bench_encode(opt):
+    import os
+    import tempfile
+    from src.firebase import DetectionUploader
+    rng = np.random.default_rng(0)
+    frames = list(trap_video(8, opt.size))
+    _, data = upload_item(rng, 0)
+    frame_mb = frames[0].nbytes / 1024 ** 2
+    print(f"{opt.frames} frames of {opt.size[0]}x{opt.size[1]}, a burst of {opt.burst} detections every "
+          f"{opt.burst_every} frames, {opt.memory:g} MiB for pending frames ({opt.memory / frame_mb:.0f} frames)")
+
+    with tempfile.TemporaryDirectory() as tmp, MockFirebase(opt.latency) as server:
+        for name in ["inline", "encoder threads"]:
+            with contextlib.redirect_stdout(io.StringIO()):
+                uploader = DetectionUploader(spool_path=os.path.join(tmp, f"{name}.db"), encode_workers=opt.workers,
+                                             frame_memory=int(opt.memory * 1024 ** 2), commit_delay=0.1,
+                                             credentials=FakeCredentials(), storage_url=server.url,
+                                             firestore_url=server.url)
+                loop_ms, burst_ms, peak = [], [], 0
+                for i in range(opt.frames):
+                    frame = frames[i % len(frames)]
+                    t = time.perf_counter()
+                    cv2.GaussianBlur(frame, (0, 0), 2)  # stands in for the per frame detection work
+                    if i % opt.burst_every == 0:
+                        for _ in range(opt.burst):
+                            if name == "inline":
+                                _, buffer = cv2.imencode(".jpg", frame)
+                                uploader.schedule_for_upload(buffer.tobytes(), data)
+                            else:
+                                uploader.schedule_frame(frame, data)
+                    elapsed = (time.perf_counter() - t) * 1000
+                    loop_ms.append(elapsed)
+                    if i % opt.burst_every == 0:
+                        burst_ms.append(elapsed)
+                    peak = max(peak, uploader.frame_bytes)
+                inline = uploader.encoded_inline
+                uploader.wait_for_completion()
+            burst_ms = np.array(burst_ms)
+            print(f"  {name:15}: loop {np.median(loop_ms):6.1f} ms median, burst frames {np.median(burst_ms):6.1f} ms "
+                  f"median {burst_ms.max():6.1f} ms max, peak {peak / 1024 ** 2:5.1f} MiB of pending frames, "
+                  f"{inline} encoded inline")
+
+
+def detection_frames(n, size, seed=0):
+    """Trap frames with one to three small dark mosquitoes, and their detections."""
+    rng = np.random.default_rng(seed)
+    background = next(trap_video(1, size, seed=seed))
+    w, h = size
+    for _ in range(n):
+        frame = background.copy()
+        count = rng.integers(1, 4)
+        dets = np.empty(count, dtype=DETECTION_DTYPE)
+        for i, (x, y) in enumerate(zip(rng.integers(20, w - 20, count), rng.integers(20, h - 20, count))):
+            cv2.circle(frame, (int(x), int(y)), 12, (20, 20, 20), -1)
+            dets[i] = ((x - 14, y - 14, x + 14, y + 14), rng.uniform(0.7, 1), 0)
+        yield frame, dets
+
+
+def bench_payload(opt):
+    import os
+    import tempfile
+    from src.firebase import DetectionUploader
+    samples = list(detection_frames(opt.frames, opt.size))
+    print(f"{opt.frames} frames of {opt.size[0]}x{opt.size[1]} with 1 to 3 detections each")
+    for profile in ["full", "crops"]:
+        for quality in opt.qualities:
+            payload = PayloadEncoder(profile, quality)
+            for frame, dets in samples:
+                payload.encode(frame, dets)
+            stats = payload.stats()
+            print(f"  {profile:5} q{quality:3}: {stats['mean_bytes'] / 1024:7.1f} KiB, {stats['mean_encode_ms']:5.1f} ms "
+                  f"to encode, {stats['bytes_per_detection'] / 1024:7.1f} KiB per detection")
+
+    _, data = upload_item(np.random.default_rng(0), 0)
+    print(f"{opt.rate:g} detections/s for {opt.duration:g} s over a {opt.bandwidth / 1024:g} KiB/s link, "
+          f"full frames, {opt.target_delay:g} s target delay")
+    with tempfile.TemporaryDirectory() as tmp:
+        for adaptive in [False, True]:
+            payload = PayloadEncoder("full", opt.qualities[0], adaptive=adaptive, target_delay=opt.target_delay,
+                                     window=5.0, adapt_interval=0.5)
+            with MockFirebase(bandwidth=opt.bandwidth) as server, contextlib.redirect_stdout(io.StringIO()):
+                uploader = DetectionUploader(spool_path=os.path.join(tmp, f"adaptive{adaptive}.db"),
+                                             payload=payload, commit_delay=0.1, credentials=FakeCredentials(),
+                                             storage_url=server.url, firestore_url=server.url)
+                t = time.perf_counter()
+                qualities = []
+                for i in range(int(opt.rate * opt.duration)):
+                    frame, dets = samples[i % len(samples)]
+                    uploader.schedule_frame(frame, {**data, "detections": dets})
+                    qualities.append(payload.quality)
+                    time.sleep(max(0.0, t + (i + 1) / opt.rate - time.perf_counter()))
+                submitted = time.perf_counter() - t
+                uploader.wait_for_completion()
+                elapsed = time.perf_counter() - t
+            stats = payload.stats()
+            print(f"  {'adaptive' if adaptive else 'fixed':8}: last upload {elapsed - submitted:5.1f} s after the last "
+                  f"detection, {stats['mean_bytes'] / 1024:6.1f} KiB mean, quality {min(qualities)} to {max(qualities)}")
+
+
+def bench_multipart(opt):
+    import os
+    import tempfile
+    from src.firebase import DetectionUploader
+    rng = np.random.default_rng(0)
+    image = cv2.imencode(".jpg", next(trap_video(1, (640, 480))))[1].tobytes()
+    items = [(image, upload_item(rng, 0)[1]) for _ in range(opt.items)]
+    print(f"{opt.items} detections one at a time, then all at once, over a link with {opt.latency * 1000:g} ms latency")
+    with tempfile.TemporaryDirectory() as tmp:
+        for index in ["firestore", "metadata"]:
+            with MockFirebase(opt.latency) as server, contextlib.redirect_stdout(io.StringIO()):
+                # Firestore documents or objects carrying their metadata
+                indexed = (lambda: len(server.documents)) if index == "firestore" else \
+                    (lambda: sum(metadata is not None for metadata in server.objects.values()))
+                uploader = DetectionUploader(spool_path=os.path.join(tmp, f"{index}.db"), index=index,
+                                             commit_delay=0.0, concurrency=opt.concurrency,
+                                             credentials=FakeCredentials(), storage_url=server.url,
+                                             firestore_url=server.url)
+                latencies = []
+                for i, (image, data) in enumerate(items):
+                    t = time.perf_counter()
+                    uploader.schedule_for_upload(image, data)
+                    while indexed() <= i:
+                        time.sleep(0.001)
+                    latencies.append((time.perf_counter() - t) * 1000)
+                t = time.perf_counter()
+                for image, data in items:
+                    uploader.schedule_for_upload(image, data)
+                uploader.wait_for_completion()
+                elapsed = time.perf_counter() - t
+            assert indexed() == 2 * opt.items, f"{indexed()} of {2 * opt.items} detections indexed"
+            print(f"  {index:9}: {np.mean(latencies):6.1f} ms per detection, {opt.items / elapsed:6.1f} detections/s "
+                  f"in a burst, {sum(server.requests.values()) / (2 * opt.items):4.2f} requests per detection")
+
+
+def bench_offline(opt):
+    import os
+    import tempfile
+    from src.firebase import DetectionUploader
+    rng = np.random.default_rng(0)
+    image = cv2.imencode(".jpg", next(trap_video(1, (640, 480))))[1].tobytes()
+    count = int(opt.rate * opt.duration)
+    items = []
+    for i in range(count):
+        _, data = upload_item(rng, 0)
+        items.append((image, {**data, "latitude": float(i)}))  # the latitude tags the order of detection
+    quota = opt.quota_items * len(image) if opt.quota_items else None
+    print(f"{count} detections over {opt.duration:g} s, the network down from {opt.duration - opt.outage:g} s to the end, "
+          f"{len(image) / 1024:.0f} KiB each")
+    scenarios = [
+        ("retrying", {}),
+        ("offline first", {"offline_after": 3, "probe_interval": opt.probe_interval, "disk_quota": quota,
+                           "drain_order": opt.order, "sync_rate": opt.sync_rate * 1024}),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, kwargs in scenarios:
+            with MockFirebase(opt.latency) as server, contextlib.redirect_stdout(io.StringIO()):
+                uploader = DetectionUploader(spool_path=os.path.join(tmp, f"{name}.db"), index="metadata",
+                                             request_timeout=1.0, retry_base=0.05, retry_cap=2.0,
+                                             breaker_reset=opt.probe_interval, credentials=FakeCredentials(),
+                                             storage_url=server.url, firestore_url=server.url, **kwargs)
+                t = time.perf_counter()
+                for i, (image, data) in enumerate(items):
+                    if i == int(opt.rate * (opt.duration - opt.outage)):
+                        server.network_up = False
+                    uploader.schedule_for_upload(image, data)
+                    time.sleep(max(0.0, t + (i + 1) / opt.rate - time.perf_counter()))
+                before = len(server.objects)
+                server.network_up = True
+                t = time.perf_counter()
+                uploader.wait_for_completion()
+                drained = time.perf_counter() - t
+            order = [int(float(metadata["latitude"])) for metadata in list(server.objects.values())[before:]]
+            assert len(server.objects) + uploader.dropped == count, f"{len(server.objects)} of {count} delivered"
+            print(f"  {name:13}: {server.down_requests:3} requests of {server.down_bytes / 1024:5.0f} KiB while down, "
+                  f"{uploader.dropped:3} dropped, "
+                  f"backlog of {len(order):3} sent in {drained:5.2f} s "
+                  f"({len(order) * len(image) / 1024 / max(drained, 1e-9):6.0f} KiB/s), first {order[:5]}")
+
+        # Server errors open the breaker, then the link drops while its probe is out
+        print(f"{opt.errors:g} s of 503s, then the network down for {opt.errors:g} s")
+        with MockFirebase(opt.latency, outage=(0.0, opt.errors)) as server, contextlib.redirect_stdout(io.StringIO()):
+            uploader = DetectionUploader(spool_path=os.path.join(tmp, "breaker.db"), index="metadata",
+                                         request_timeout=1.0, retry_base=0.05, retry_cap=0.5, breaker_threshold=3,
+                                         breaker_reset=opt.errors / 2, offline_after=3,
+                                         probe_interval=opt.probe_interval, credentials=FakeCredentials(),
+                                         storage_url=server.url, firestore_url=server.url)
+            for image, data in items[:10]:
+                uploader.schedule_for_upload(image, data)
+            time.sleep(opt.errors)
+            server.network_up = False
+            time.sleep(opt.errors)
+            server.network_up = True
+            t = time.perf_counter()
+            left = uploader.wait_for_completion(timeout=10 * opt.probe_interval)
+            recovered = time.perf_counter() - t
+        assert not left, f"{left} of 10 still in the spool {recovered:.1f} s after the network came back"
+        print(f"  offline first: all 10 delivered {recovered:5.2f} s after the network came back")
+
+
+def frame_size(s):
+    w, h = s.lower().split("x")
+    return int(w), int(h)
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the detection pipeline")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    nms = sub.add_parser("nms", help="Vectorized NMS against the original loop")
+    nms.add_argument("--boxes", type=int, default=100, help="Candidates per frame")
+    nms.add_argument("--conf", type=float, default=0.1)
+    nms.add_argument("--iou", type=float, default=0.1)
+    nms.add_argument("--iters", type=int, default=200, help="Synthetic outputs to run")
+    nms.set_defaults(func=bench_nms)
+
+    pre = sub.add_parser("preprocess", help="In-place letterbox against the original copy-per-step path")
+    pre.add_argument("--sizes", type=frame_size, nargs="+", default=[(640, 480), (1280, 720), (1920, 1080)], help="Frame sizes as WxH")
+    pre.add_argument("--iters", type=int, default=50)
+    pre.set_defaults(func=bench_preprocess)
+
+    pipe = sub.add_parser("pipeline", help="Pipelined inference against the sequential loop")
+    pipe.add_argument("--weights", default=None, help="Run the CPU backend with these weights instead of a synthetic one")
+    pipe.add_argument("--latency", type=float, default=0.02, help="Synthetic backend seconds per call")
+    pipe.add_argument("--size", type=frame_size, default=(1920, 1080), help="Frame size as WxH")
+    pipe.add_argument("--frames", type=int, default=100)
+    pipe.add_argument("--depth", type=int, default=2, help="Frames in flight per stage")
+    pipe.add_argument("--conf", type=float, default=0.5)
+    pipe.set_defaults(func=bench_pipeline)
+
+    cpu = sub.add_parser("cpu", help="Optimized CPU backend against the PyTorch eager baseline")
+    cpu.add_argument("--weights", required=True, help="yolov7-tiny .pt weights")
+    cpu.add_argument("--source", default="yolov7/images/mosquito.jpg", help="Image to run on")
+    cpu.add_argument("--img-size", type=int, default=640)
+    cpu.add_argument("--threads", type=int, default=None, help="Intra-op threads for the optimized backend")
+    cpu.add_argument("--iters", type=int, default=50)
+    cpu.add_argument("--conf", type=float, default=0.5)
+    cpu.set_defaults(func=bench_cpu)
+
+    onnx = sub.add_parser("onnx", help="ONNX Runtime end2end backend against PostProcess and the PyTorch CPU path")
+    onnx.add_argument("--model", default=None, help="End2End .onnx from export.py")
+    onnx.add_argument("--weights", default=None, help="The .pt weights it was exported from")
+    onnx.add_argument("--source", default="yolov7/images/mosquito.jpg", help="Image to run on")
+    onnx.add_argument("--threads", type=int, default=None)
+    onnx.add_argument("--iters", type=int, default=50)
+    onnx.add_argument("--conf", type=float, default=0.5)
+    onnx.set_defaults(func=bench_onnx)
+
+    tiled = sub.add_parser("tiled", help="Tiled inference against the single letterbox")
+    tiled.add_argument("--source", default=None, help="Directory of images, labels in a sibling labels/ dir; synthetic frames if unset")
+    tiled.add_argument("--weights", default=None, help=".pt or .onnx weights; synthetic backend if unset")
+    tiled.add_argument("--latency", type=float, default=0.02, help="Synthetic backend seconds per call")
+    tiled.add_argument("--size", type=frame_size, default=(3840, 2160), help="Synthetic frame size as WxH")
+    tiled.add_argument("--frames", type=int, default=20, help="Synthetic frames")
+    tiled.add_argument("--tile-size", type=int, default=640)
+    tiled.add_argument("--overlap", type=float, default=0.2)
+    tiled.add_argument("--batch-size", type=int, default=4, help="Tiles per backend call")
+    tiled.add_argument("--conf", type=float, default=0.5)
+    tiled.set_defaults(func=bench_tiled)
+
+    motion = sub.add_parser("motion", help="Motion-gated inference against inferring every frame, replayed on video")
+    motion.add_argument("--source", default=None, help="Recorded trap video; a synthetic clip if unset")
+    motion.add_argument("--weights", default=None, help=".pt or .onnx weights; synthetic backend if unset")
+    motion.add_argument("--latency", type=float, default=0.02, help="Synthetic backend seconds per call")
+    motion.add_argument("--size", type=frame_size, default=(1920, 1080), help="Synthetic frame size as WxH")
+    motion.add_argument("--frames", type=int, default=200, help="Frames to replay")
+    motion.add_argument("--moving", type=float, default=0.2, help="Fraction of the synthetic clip with motion")
+    motion.add_argument("--threshold", type=int, default=25, help="Pixel difference counted as motion")
+    motion.add_argument("--pad", type=int, default=32)
+    motion.add_argument("--min-size", type=int, default=640, help="Smallest region inferred")
+    motion.add_argument("--refresh", type=int, default=300, help="Infer the whole frame every this many frames")
+    motion.add_argument("--batch-size", type=int, default=4, help="Regions per backend call")
+    motion.add_argument("--conf", type=float, default=0.5)
+    motion.set_defaults(func=bench_motion)
+
+    capture = sub.add_parser("capture", help="Capture thread against inline reads, on a synthetic camera")
+    capture.add_argument("--fps", type=int, default=30, help="Synthetic camera frame rate")
+    capture.add_argument("--buffers", type=int, default=4, help="Driver queue depth")
+    capture.add_argument("--latency", type=float, default=0.1, help="Detector seconds per frame")
+    capture.add_argument("--duration", type=float, default=5.0, help="Seconds to run each reader")
+    capture.add_argument("--fail-every", type=int, default=60, help="Fail a read every this many frames")
+    capture.add_argument("--fail-opens", type=int, default=2, help="Opens that fail before the camera appears")
+    capture.set_defaults(func=bench_capture)
+
+    streams = sub.add_parser("streams", help="Batched multi-stream detection against one call per frame, on video files")
+    streams.add_argument("--sources", nargs="+", default=None, help="Video files to use as streams; synthetic clips if unset")
+    streams.add_argument("--streams", type=int, default=4, help="Synthetic streams")
+    streams.add_argument("--weights", default=None, help=".pt or .onnx weights; synthetic backend if unset")
+    streams.add_argument("--latency", type=float, default=0.02, help="Synthetic backend seconds per call")
+    streams.add_argument("--size", type=frame_size, default=(1280, 720), help="Synthetic frame size as WxH")
+    streams.add_argument("--fps", type=int, default=15, help="Rate each stream is replayed at")
+    streams.add_argument("--policy", default="latest", choices=["latest", "queue", "block"], help="Drop policy of every stream")
+    streams.add_argument("--duration", type=float, default=5.0, help="Seconds to run each configuration")
+    streams.add_argument("--conf", type=float, default=0.5)
+    streams.set_defaults(func=bench_streams)
+
+    track = sub.add_parser("tracker", help="Uploads per tracked mosquito against the max counter heuristic")
+    track.add_argument("--frames", type=int, default=3000, help="Frames to simulate")
+    track.add_argument("--arrivals", type=int, default=40, help="Mosquitoes landing during the run")
+    track.add_argument("--stay", type=int, default=200, help="Typical frames a mosquito stays")
+    track.set_defaults(func=bench_tracker)
+
+    spool = sub.add_parser("spool", help="Enqueue latency and batched dequeue of the on-disk upload spool")
+    spool.add_argument("--items", type=int, default=500)
+    spool.add_argument("--image-kb", type=int, default=100, help="JPEG size")
+    spool.add_argument("--batch-size", type=int, default=16)
+    spool.add_argument("--dir", default=None, help="Directory to put the spool in, e.g. on the SD card")
+    spool.set_defaults(func=bench_spool)
+
+    upload = sub.add_parser("upload", help="Upload throughput against a local mock Firebase")
+    upload.add_argument("--items", type=int, default=100)
+    upload.add_argument("--image-kb", type=int, default=100, help="JPEG size")
+    upload.add_argument("--latencies", type=float, nargs="+", default=[0.05, 0.2], help="Seconds the server takes per request")
+    upload.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8], help="Upload workers")
+    upload.set_defaults(func=bench_upload)
+
+    commit = sub.add_parser("commit", help="Batched Firestore commits against one write per document")
+    commit.add_argument("--items", type=int, default=200)
+    commit.add_argument("--image-kb", type=int, default=20, help="JPEG size")
+    commit.add_argument("--latency", type=float, default=0.1, help="Seconds the server takes per request")
+    commit.add_argument("--concurrency", type=int, default=8, help="Upload workers")
+    commit.add_argument("--commit-size", type=int, default=20)
+    commit.add_argument("--commit-delay", type=float, default=0.5)
+    commit.add_argument("--poison", type=int, default=1, help="Documents the server rejects until written alone")
+    commit.add_argument("--reject", type=int, default=1, help="Documents the server always rejects")
+    commit.set_defaults(func=bench_commit)
+
+    faults = sub.add_parser("faults", help="Retries and the circuit breaker against a server injecting 5xx errors, timeouts and an outage")
+    faults.add_argument("--items", type=int, default=100)
+    faults.add_argument("--image-kb", type=int, default=20, help="JPEG size")
+    faults.add_argument("--latency", type=float, default=0.02, help="Seconds the server takes per request")
+    faults.add_argument("--concurrency", type=int, default=4, help="Upload workers")
+    faults.add_argument("--error-rate", type=float, default=0.1, help="Fraction of requests answered with a 503")
+    faults.add_argument("--timeout-rate", type=float, default=0.05, help="Fraction of requests that hang past the timeout")
+    faults.add_argument("--request-timeout", type=float, default=0.5)
+    faults.add_argument("--outage-start", type=float, default=0.3, help="Seconds after start the outage begins")
+    faults.add_argument("--outage", type=float, default=3.0, help="Seconds every request fails")
+    faults.add_argument("--breaker-threshold", type=int, default=5, help="Failures in a row that open the breaker")
+    faults.add_argument("--breaker-reset", type=float, default=0.5, help="Seconds between probes while open")
+    faults.set_defaults(func=bench_faults)
+
+    auth = sub.add_parser("auth", help="Access token refresh across several token lifetimes")
+    auth.add_argument("--items", type=int, default=100)
+    auth.add_argument("--image-kb", type=int, default=20, help="JPEG size")
+    auth.add_argument("--interval", type=float, default=0.05, help="Seconds between detections")
+    auth.add_argument("--latency", type=float, default=0.02, help="Seconds the server takes per request")
+    auth.add_argument("--concurrency", type=int, default=4, help="Upload workers")
+    auth.add_argument("--lifetime", type=float, default=1.5, help="Seconds a token stays valid")
+    auth.add_argument("--margin", type=float, default=0.5, help="Seconds before expiry the token is refreshed")
+    auth.add_argument("--refresh-delay", type=float, default=0.1, help="Seconds a token request takes")
+    auth.add_argument("--skew", type=float, default=0.8, help="Seconds the server's clock runs ahead")
+    auth.set_defaults(func=bench_auth)
+
+    stress = sub.add_parser("stress", help="Uploads submitted from several threads at once, drained and stopped at a deadline")
+    stress.add_argument("--threads", type=int, default=8)
+    stress.add_argument("--items", type=int, default=500, help="Uploads per thread")
+    stress.add_argument("--image-kb", type=int, default=1, help="JPEG size")
+    stress.add_argument("--latency", type=float, default=0.005, help="Seconds the server takes per request")
+    stress.add_argument("--slow-latency", type=float, default=0.1, help="Server latency while stopping at the deadline")
+    stress.add_argument("--concurrency", type=int, default=8, help="Upload workers")
+    stress.add_argument("--deadline", type=float, default=1.0, help="Seconds given to drain before stopping")
+    stress.set_defaults(func=bench_stress)
+
+    encode = sub.add_parser("encode", help="Detection loop latency during bursts of uploads, encoding inline against on encoder threads")
+    encode.add_argument("--frames", type=int, default=300)
+    encode.add_argument("--size", type=frame_size, default=(1920, 1080), help="Frame size as WxH")
+    encode.add_argument("--burst", type=int, default=5, help="Detections uploaded per burst")
+    encode.add_argument("--burst-every", type=int, default=20, help="Frames between bursts")
+    encode.add_argument("--workers", type=int, default=2, help="Encoder threads")
+    encode.add_argument("--memory", type=float, default=64, help="MiB of frames allowed to wait for encoding")
+    encode.add_argument("--latency", type=float, default=0.02, help="Seconds the server takes per request")
+    encode.set_defaults(func=bench_encode)
+
+    payload = sub.add_parser("payload", help="Payload size and encode time per profile, and JPEG quality adapted to a slow link")
+    payload.add_argument("--frames", type=int, default=50)
+    payload.add_argument("--size", type=frame_size, default=(1920, 1080), help="Frame size as WxH")
+    payload.add_argument("--qualities", type=int, nargs="+", default=[95, 75, 50], help="JPEG qualities, the first is the adaptive maximum")
+    payload.add_argument("--rate", type=float, default=2.0, help="Detections per second")
+    payload.add_argument("--duration", type=float, default=10.0, help="Seconds detections come in")
+    payload.add_argument("--bandwidth", type=float, default=400 * 1024, help="Link bytes per second")
+    payload.add_argument("--target-delay", type=float, default=2.0, help="Seconds of backlog the adaptive quality aims under")
+    payload.set_defaults(func=bench_payload)
+
+    multipart = sub.add_parser("multipart", help="Image and Firestore document against one multipart upload with custom metadata")
+    multipart.add_argument("--items", type=int, default=50)
+    multipart.add_argument("--latency", type=float, default=0.1, help="Seconds the server takes per request")
+    multipart.add_argument("--concurrency", type=int, default=4, help="Upload workers")
+    multipart.set_defaults(func=bench_multipart)
+
+    offline = sub.add_parser("offline", help="Retrying through an outage against offline first operation with a bulk sync afterwards")
+    offline.add_argument("--rate", type=float, default=10.0, help="Detections per second")
+    offline.add_argument("--duration", type=float, default=6.0, help="Seconds detections come in")
+    offline.add_argument("--outage", type=float, default=4.0, help="Seconds the network is down, up to the end")
+    offline.add_argument("--latency", type=float, default=0.02, help="Seconds the server takes per request")
+    offline.add_argument("--errors", type=float, default=1.0, help="Seconds of 503s, then of network down, before the breaker case recovers")
+    offline.add_argument("--probe-interval", type=float, default=1.0, help="Seconds between probes while offline, or breaker probes while retrying")
+    offline.add_argument("--quota-items", type=int, default=30, help="Disk quota in images, 0 for none")
+    offline.add_argument("--order", default="newest", choices=["oldest", "newest", "confidence"], help="Order the backlog is sent in")
+    offline.add_argument("--sync-rate", type=float, default=512, help="KiB per second the backlog is sent at")
+    offline.set_defaults(func=bench_offline)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    opt.func(opt)
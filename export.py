@@ -0,0 +1,54 @@
+import argparse
+import os
+
+import torch
+
+from models.experimental import attempt_load, End2End
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export .pt weights to an ONNX model with NMS in the graph')
+    parser.add_argument('-w', '--weights', required=True, help='Input weights (.pt) file path (required)')
+    parser.add_argument('-o', '--output', help='Output (.onnx) file path (optional)')
+    parser.add_argument('--img-size', type=int, default=640, help='Square input size, must match the backend')
+    parser.add_argument('--batch-size', type=int, default=1, help='Fixed batch size of the exported graph')
+    parser.add_argument('--max-det', type=int, default=100, help='Boxes kept per class by NMS')
+    parser.add_argument('--iou-thres', type=float, default=0.1, help='NMS IoU threshold, YoloTRT.IOU_THRESHOLD')
+    parser.add_argument('--conf-thres', type=float, default=0.1, help='NMS score threshold, kIgnoreThresh')
+    args = parser.parse_args()
+    if not os.path.isfile(args.weights):
+        raise SystemExit('Invalid input file')
+    if not args.output:
+        args.output = os.path.splitext(args.weights)[0] + '.onnx'
+    return args
+
+
+def export_onnx(weights, output, img_size=640, batch_size=1, max_det=100, iou_thres=0.1, conf_thres=0.1):
+    device = torch.device('cpu')
+    model = attempt_load(weights, map_location=device)  # fused FP32 model
+    model.model[-1].export = False  # keep the grid so boxes come out decoded
+
+    img = torch.zeros(batch_size, 3, img_size, img_size, device=device)
+    export_end2end(model, img, output, len(model.names), img_size, max_det, iou_thres, conf_thres)
+    print(f'Exported {weights} to {output}')
+    return output
+
+
+def export_end2end(model, example, output, n_classes, img_size=640, max_det=100, iou_thres=0.1, conf_thres=0.1):
+    """Exports model, whose output is (batch, anchors, 5 + nc) boxes in input pixels, with NMS appended."""
+    # max_wh selects ONNX_ORT: class-offset NMS run by onnxruntime inside the graph. Boxes may run
+    # past the input edges, so the offset is utils.general's 4096 rather than img_size, which let
+    # a box past the right edge suppress one of the next class past the left edge
+    model = End2End(model, max_det, iou_thres, conf_thres, max_wh=4096, device=example.device, n_classes=n_classes)
+    model.eval()
+
+    with torch.no_grad():
+        model(example)  # dry run builds the detection grids
+        torch.onnx.export(model, example, output, opset_version=12, do_constant_folding=True,
+                          input_names=['images'], output_names=['output'])
+    return output
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    export_onnx(args.weights, args.output, args.img_size, args.batch_size, args.max_det, args.iou_thres, args.conf_thres)
@@ -0,0 +1,162 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+try:
+    from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quantize_static
+except ImportError:
+    CalibrationDataReader = object
+    quantize_static = None
+
+from src.backend import ONNXBackend
+from src.boxes import box_iou
+from src.yoloDet import YoloTRT
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='INT8 post-training quantization of an export.py ONNX model')
+    parser.add_argument('-m', '--model', required=True, help='FP32 End2End .onnx from export.py (required)')
+    parser.add_argument('-o', '--output', help='Output INT8 .onnx file path (optional)')
+    parser.add_argument('--calib', required=True, help='Calibration images: directory or list file, as for LoadImagesAndLabels')
+    parser.add_argument('--calib-images', type=int, default=200, help='Number of calibration images')
+    parser.add_argument('--method', default='minmax', choices=['minmax', 'entropy', 'percentile'], help='Calibration method')
+    parser.add_argument('--val', default=None, help='Labelled images to report mAP on (optional)')
+    parser.add_argument('--val-images', type=int, default=500)
+    parser.add_argument('--iters', type=int, default=50, help='Frames to time each model on')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--conf', type=float, default=0.001, help='Confidence threshold for mAP')
+    parser.add_argument('--max-map-drop', type=float, default=0.01, help='Fail if mAP@.5 drops by more than this')
+    args = parser.parse_args()
+    if not os.path.isfile(args.model):
+        raise SystemExit('Invalid input file')
+    if not args.output:
+        args.output = os.path.splitext(args.model)[0] + '-int8.onnx'
+    return args
+
+
+def load_dataset(path, img_size):
+    from utils.datasets import LoadImagesAndLabels
+    return LoadImagesAndLabels(path, img_size=img_size, augment=False, rect=False)
+
+
+def dataset_images(dataset, limit):
+    """Yields (BGR image, labels as pixel xyxy with class in column 0) from a LoadImagesAndLabels dataset."""
+    from utils.datasets import load_image
+    for i in range(min(limit, len(dataset))):
+        img, _, (h, w) = load_image(dataset, i)
+        labels = dataset.labels[i].copy()
+        if len(labels):
+            cx, cy, bw, bh = labels[:, 1] * w, labels[:, 2] * h, labels[:, 3] * w, labels[:, 4] * h
+            labels[:, 1:5] = np.stack([cx - bw / 2, cy - bh / 2, cx + bw / 2, cy + bh / 2], 1)
+        yield img, labels
+
+
+class CalibrationReader(CalibrationDataReader):
+    """onnxruntime CalibrationDataReader over dataset images, preprocessed exactly as at inference."""
+    def __init__(self, model, dataset, limit):
+        self.model = model
+        self.images = dataset_images(dataset, limit)
+        self.input_name = model.backend.input_name
+
+    def get_next(self):
+        batch = self.model.backend.allocate_input(self.model.batch_size)
+        n = 0
+        for img, _ in self.images:
+            self.model.PreProcessImg(img, batch[n:n + 1])
+            n += 1
+            if n == len(batch):
+                break
+        if n == 0:
+            return None
+        batch[n:] = self.model.PAD_VALUE
+        return {self.input_name: batch}
+
+
+def quantize(model_path, output, calib_path, calib_images=200, method='minmax'):
+    if quantize_static is None:
+        raise ImportError('quantize requires onnxruntime')
+    model = YoloTRT(backend=ONNXBackend(model_path))
+    dataset = load_dataset(calib_path, model.input_w)
+    calibrate_method = {
+        'minmax': CalibrationMethod.MinMax,
+        'entropy': CalibrationMethod.Entropy,
+        'percentile': CalibrationMethod.Percentile,
+    }[method]
+    # Only the convolutions are quantized: the box decode and the NMS stay in FP32
+    quantize_static(model_path, output, CalibrationReader(model, dataset, calib_images),
+                    quant_format=QuantFormat.QDQ, op_types_to_quantize=['Conv'], per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                    calibrate_method=calibrate_method)
+    model.close()
+    print(f'Quantized {model_path} to {output}')
+    return output
+
+
+def evaluate(model, dataset, limit):
+    """mAP@0.5 and mAP@0.5:0.95 of model over the first limit images of dataset."""
+    from utils.metrics import ap_per_class
+
+    iouv = np.linspace(0.5, 0.95, 10)
+    stats = []
+    for img, labels in dataset_images(dataset, limit):
+        dets, _ = model.Inference(img)
+        correct = np.zeros((len(dets), len(iouv)), dtype=bool)
+        if len(dets) and len(labels):
+            iou = box_iou(dets["box"], labels[:, 1:5])
+            iou[dets["class_id"][:, None] != labels[None, :, 0]] = 0
+            for k, thres in enumerate(iouv):
+                matched = np.zeros(len(labels), dtype=bool)
+                for i in np.argsort(-dets["conf"]):
+                    candidates = np.where(~matched & (iou[i] >= thres))[0]
+                    if len(candidates):
+                        matched[candidates[iou[i, candidates].argmax()]] = True
+                        correct[i, k] = True
+        stats.append((correct, dets["conf"], dets["class_id"], labels[:, 0]))
+
+    correct, conf, pred_cls, target_cls = [np.concatenate(x, 0) for x in zip(*stats)]
+    if not len(target_cls):
+        return 0.0, 0.0
+    _, _, ap, _, _ = ap_per_class(correct, conf, pred_cls, target_cls)
+    return ap[:, 0].mean(), ap.mean()
+
+
+def latency(model, dataset, iters):
+    img, _ = next(dataset_images(dataset, 1))
+    model.Inference(img)  # warm up
+    t = time.perf_counter()
+    for _ in range(iters):
+        model.Inference(img)
+    return (time.perf_counter() - t) / iters * 1000
+
+
+def report(fp32_path, int8_path, calib_path, val_path=None, val_images=500, iters=50, threads=None, conf=0.001):
+    results = {}
+    for name, path in [('fp32', fp32_path), ('int8', int8_path)]:
+        model = YoloTRT(conf=conf, backend=ONNXBackend(path, threads=threads))
+        calib = load_dataset(calib_path, model.input_w)
+        ms = latency(model, calib, iters)
+        maps = evaluate(model, load_dataset(val_path, model.input_w), val_images) if val_path else (None, None)
+        results[name] = (ms, *maps)
+        model.close()
+
+    (fp32_ms, fp32_map50, fp32_map), (int8_ms, int8_map50, int8_map) = results['fp32'], results['int8']
+    print(f'{"":6}{"ms/frame":>10}{"mAP@.5":>10}{"mAP@.5:.95":>12}')
+    for name, (ms, map50, map_) in results.items():
+        maps = f'{map50:10.4f}{map_:12.4f}' if map50 is not None else f'{"-":>10}{"-":>12}'
+        print(f'{name:6}{ms:10.2f}{maps}')
+    print(f'int8 is {fp32_ms / int8_ms:.2f}x faster', end='')
+    if fp32_map50 is None:
+        print()
+        return None
+    print(f', mAP@.5 {int8_map50 - fp32_map50:+.4f}, mAP@.5:.95 {int8_map - fp32_map:+.4f}')
+    return fp32_map50 - int8_map50
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    quantize(args.model, args.output, args.calib, args.calib_images, args.method)
+    drop = report(args.model, args.output, args.calib, args.val, args.val_images, args.iters, args.threads, args.conf)
+    if drop is not None and drop > args.max_map_drop:
+        raise SystemExit(f'mAP@.5 dropped by {drop:.4f}, more than --max-map-drop {args.max_map_drop}')
@@ -0,0 +1,90 @@
+import asyncio
+import threading
+from datetime import datetime, timezone
+
+from google.auth.transport.requests import Request
+
+
+class TokenProvider:
+    """Caches an access token and refreshes it before it expires.
+
+    A background thread refreshes the credentials refresh_margin seconds
+    before their expiry, so requests never wait on a refresh and the
+    blocking token request never runs on the event loop. Credentials without
+    an expiry are refreshed every `lifetime` seconds. When the server still
+    rejects a token, refresh(stale) fetches a new one on an executor thread;
+    concurrent callers holding the same stale token share one refresh.
+
+    If the first token cannot be fetched, e.g. when booting without network,
+    token stays None and the thread retries every retry_interval seconds.
+    """
+    def __init__(self, credentials, refresh_margin=300.0, lifetime=3600.0, retry_interval=30.0):
+        self.credentials = credentials
+        self.refresh_margin = refresh_margin
+        self.lifetime = lifetime
+        self.retry_interval = retry_interval
+        self.refreshes = 0
+        self.__lock = threading.RLock()
+        self.__stopped = threading.Event()
+        self.__replaced = threading.Event()  # a caller fetched a token, so the next refresh is due at another time
+        try:
+            self.__refresh()
+        except Exception as e:
+            print("⚠️ Error fetching access token, retrying in the background:", e)
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    @property
+    def token(self):
+        return self.credentials.token
+
+    async def refresh(self, stale):
+        """A token other than stale, refreshing the credentials off the event loop if needed."""
+        return await asyncio.get_running_loop().run_in_executor(None, self.__replace, stale)
+
+    def expires_in(self):
+        """Seconds until the current token expires."""
+        expiry = self.credentials.expiry
+        if expiry is None:
+            return self.lifetime
+        if expiry.tzinfo is None:
+            expiry = expiry.replace(tzinfo=timezone.utc)  # google-auth keeps expiries as naive UTC
+        return (expiry - datetime.now(timezone.utc)).total_seconds()
+
+    def close(self):
+        self.__stopped.set()
+        self.__replaced.set()
+
+    def __refresh(self):
+        with self.__lock:
+            self.credentials.refresh(Request())
+            self.refreshes += 1
+            return self.credentials.token
+
+    def __replace(self, stale):
+        with self.__lock:
+            if self.credentials.token != stale:
+                return self.credentials.token  # refreshed while this caller waited
+            token = self.__refresh()
+            self.__replaced.set()
+            return token
+
+    def __run(self):
+        delay = self.__next_refresh() if self.token is not None else self.retry_interval
+        while True:
+            self.__replaced.wait(delay)
+            if self.__stopped.is_set():
+                return
+            if self.__replaced.is_set():
+                self.__replaced.clear()
+                delay = self.__next_refresh()
+                continue
+            try:
+                self.__refresh()
+                delay = self.__next_refresh()
+            except Exception as e:
+                print("⚠️ Error refreshing access token:", e)
+                delay = self.retry_interval
+
+    def __next_refresh(self):
+        return max(self.expires_in() - self.refresh_margin, 1.0)
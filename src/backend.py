@@ -0,0 +1,301 @@
+import numpy as np
+
+try:
+    import tensorrt as trt
+    import pycuda.autoinit
+    import pycuda.driver as cuda
+except ImportError:
+    trt = None
+    cuda = None
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+
+class InferenceBackend:
+    """Owns a loaded model and everything needed to run it.
+
+    Backends take a (batch, 3, input_h, input_w) float32 tensor and return a
+    (batch, output_len) float32 array laid out like the yololayer plugin output:
+    a detection count followed by max_det rows of (cx, cy, w, h, conf, class_id)
+    in network input coordinates.
+
+    load() also allocates input_buffer, a (batch, 3, input_h, input_w) array
+    callers can preprocess into directly; infer() reads its input in place.
+    allocate_input() makes more buffers like it, e.g. for pipelining.
+    """
+    batch_size = 1
+    input_h = 640
+    input_w = 640
+    max_det = 100
+    det_len = 6
+    input_buffer = None
+    nms_in_graph = False  # outputs are already NMS'd, PostProcess only rescales
+
+    @property
+    def output_len(self):
+        return 1 + self.max_det * self.det_len
+
+    def load(self):
+        raise NotImplementedError
+
+    def allocate_input(self, batch_size=1):
+        return np.empty((batch_size, 3, self.input_h, self.input_w), dtype=np.float32)
+
+    def infer(self, batch):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TRTBackend(InferenceBackend):
+    """TensorRT engine session.
+
+    The execution context, CUDA stream and pinned host / device buffers are
+    created once in load() and reused for every call to infer().
+    """
+    def __init__(self, library, engine):
+        self.library = library
+        self.engine_path = engine
+        self.engine = None
+        self.context = None
+        self.stream = None
+        self.bindings = []
+        self.host_inputs = []
+        self.cuda_inputs = []
+        self.host_outputs = []
+        self.cuda_outputs = []
+
+    def load(self):
+        if trt is None:
+            raise ImportError("TRTBackend requires tensorrt and pycuda")
+        import ctypes
+        ctypes.CDLL(self.library)
+
+        with open(self.engine_path, 'rb') as f:
+            serialized_engine = f.read()
+
+        self.cuda_ctx = pycuda.autoinit.context
+        runtime = trt.Runtime(trt.Logger(trt.Logger.INFO))
+        self.engine = runtime.deserialize_cuda_engine(serialized_engine)
+        self.batch_size = self.engine.max_batch_size
+
+        for binding in self.engine:
+            shape = self.engine.get_binding_shape(binding)
+            size = trt.volume(shape) * self.batch_size
+            dtype = trt.nptype(self.engine.get_binding_dtype(binding))
+            host_mem = cuda.pagelocked_empty(size, dtype)
+            cuda_mem = cuda.mem_alloc(host_mem.nbytes)
+
+            self.bindings.append(int(cuda_mem))
+            if self.engine.binding_is_input(binding):
+                self.input_h = shape[-2]
+                self.input_w = shape[-1]
+                self.host_inputs.append(host_mem)
+                self.cuda_inputs.append(cuda_mem)
+            else:
+                self.max_det = (trt.volume(shape) - 1) // self.det_len
+                self.host_outputs.append(host_mem)
+                self.cuda_outputs.append(cuda_mem)
+
+        self.input_buffer = self.host_inputs[0].reshape(self.batch_size, 3, self.input_h, self.input_w)
+        self.context = self.engine.create_execution_context()
+        self.stream = cuda.Stream()
+        return self
+
+    def allocate_input(self, batch_size=1):
+        # Pinned, so the host to device copy can run asynchronously
+        return cuda.pagelocked_empty((batch_size, 3, self.input_h, self.input_w), np.float32)
+
+    def infer(self, batch):
+        # Implicit batch engines run any batch up to max_batch_size, so a
+        # partial batch only transfers and executes its own slots
+        n = len(batch)
+        host_input = np.ascontiguousarray(batch, dtype=np.float32)
+        host_output = self.host_outputs[0].reshape(self.batch_size, -1)[:n]
+        self.cuda_ctx.push()
+        try:
+            cuda.memcpy_htod_async(self.cuda_inputs[0], host_input, self.stream)
+            self.context.execute_async(n, self.bindings, stream_handle=self.stream.handle)
+            cuda.memcpy_dtoh_async(host_output, self.cuda_outputs[0], self.stream)
+            self.stream.synchronize()
+        finally:
+            self.cuda_ctx.pop()
+        return host_output
+
+    def close(self):
+        if self.engine is None:
+            return
+        self.cuda_ctx.push()
+        try:
+            for mem in self.cuda_inputs + self.cuda_outputs:
+                mem.free()
+        finally:
+            self.cuda_ctx.pop()
+        self.bindings, self.cuda_inputs, self.cuda_outputs = [], [], []
+        self.host_inputs, self.host_outputs = [], []
+        self.input_buffer = None
+        self.context = None
+        self.stream = None
+        self.engine = None
+
+
+class TorchBackend(InferenceBackend):
+    """PyTorch backend built on models/yolo.py, for machines without a GPU.
+
+    attempt_load fuses Conv+BN and reparameterizes RepConv blocks; the
+    network up to the detection head is then traced and frozen, and runs in
+    channels_last under torch.inference_mode. threads sets the intra-op
+    thread count. Decodes the raw IDetect output the same way the yololayer
+    plugin does so that YoloTRT.PostProcess can be shared between backends.
+    """
+    def __init__(self, weights, img_size=640, batch_size=1, device='cpu', ignore_thresh=0.1, threads=None, trace=True):
+        self.weights = weights
+        self.input_h = self.input_w = img_size
+        self.batch_size = batch_size
+        self.device = device
+        self.ignore_thresh = ignore_thresh
+        self.threads = threads
+        self.trace = trace
+        self.model = None
+        self.detect = None
+
+    def load(self):
+        if torch is None:
+            raise ImportError("TorchBackend requires torch")
+        from models.experimental import attempt_load
+
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        self.device = torch.device(self.device)
+        model = attempt_load(self.weights, map_location=self.device)  # fused Conv+BN and RepConv
+        model = model.to(memory_format=torch.channels_last).eval()
+        self.input_buffer = self.allocate_input(self.batch_size)
+
+        if self.trace:
+            # Trace up to the detection head, which runs eagerly like utils.torch_utils.TracedModel
+            self.detect = model.model[-1]
+            model.traced = True
+            example = torch.from_numpy(self.input_buffer).to(self.device)
+            with torch.no_grad():
+                model = torch.jit.freeze(torch.jit.trace(model, example, strict=False))
+        self.model = model
+        return self
+
+    def allocate_input(self, batch_size=1):
+        # A channels_last tensor seen from numpy as an NCHW array with NHWC strides,
+        # so preprocessing writes straight into the layout the convolutions use
+        tensor = torch.empty((batch_size, 3, self.input_h, self.input_w), dtype=torch.float32,
+                             memory_format=torch.channels_last)
+        if self.device.type == 'cuda':
+            tensor = tensor.pin_memory()
+        return tensor.numpy()
+
+    def infer(self, batch):
+        with torch.inference_mode():
+            x = torch.from_numpy(batch).to(self.device)
+            if self.detect is not None:
+                pred = self.detect(list(self.model(x)))[0]
+            else:
+                pred = self.model(x)[0]
+        return self.to_plugin_output(pred.float().cpu().numpy())
+
+    def to_plugin_output(self, pred):
+        """Packs (batch, anchors, 5 + nc) predictions into the plugin layout."""
+        output = np.zeros((len(pred), self.output_len), dtype=np.float32)
+        for i, p in enumerate(pred):
+            p = p[p[:, 4] >= self.ignore_thresh]
+            cls_conf = p[:, 5:]
+            class_id = cls_conf.argmax(1)
+            conf = p[:, 4] * cls_conf[np.arange(len(p)), class_id]
+            if len(p) > self.max_det:
+                top = np.argpartition(-conf, self.max_det)[:self.max_det]
+                p, conf, class_id = p[top], conf[top], class_id[top]
+            dets = output[i, 1:].reshape(self.max_det, self.det_len)
+            n = len(p)
+            output[i, 0] = n
+            dets[:n, :4] = p[:, :4]
+            dets[:n, 4] = conf
+            dets[:n, 5] = class_id
+        return output
+
+    def close(self):
+        self.model = None
+        self.detect = None
+        self.input_buffer = None
+
+
+class ONNXBackend(InferenceBackend):
+    """ONNX Runtime backend for models exported by export.py.
+
+    The End2End export runs NMS inside the graph (ONNX_ORT), so its output is
+    already the final detections and the Python NMS is skipped. The graph has
+    a fixed batch size; partial batches are padded with the input buffer.
+    """
+    nms_in_graph = True
+
+    def __init__(self, model, threads=None, providers=('CPUExecutionProvider',)):
+        self.model_path = model
+        self.threads = threads
+        self.providers = list(providers)
+        self.session = None
+
+    def load(self):
+        if ort is None:
+            raise ImportError("ONNXBackend requires onnxruntime")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        self.session = ort.InferenceSession(self.model_path, options, providers=self.providers)
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.batch_size, _, self.input_h, self.input_w = model_input.shape
+        self.input_buffer = np.zeros((self.batch_size, 3, self.input_h, self.input_w), dtype=np.float32)
+        return self
+
+    def infer(self, batch):
+        n = len(batch)
+        if n < self.batch_size:
+            if not np.may_share_memory(batch, self.input_buffer):
+                np.copyto(self.input_buffer[:n], batch)
+            batch = self.input_buffer
+        dets = self.session.run(None, {self.input_name: np.ascontiguousarray(batch)})[0]
+        return self.to_plugin_output(dets, n)
+
+    def to_plugin_output(self, dets, n):
+        """Packs ONNX_ORT rows of (batch_id, x1, y1, x2, y2, class_id, score) into the plugin layout."""
+        output = np.zeros((n, self.output_len), dtype=np.float32)
+        for i in range(n):
+            d = dets[dets[:, 0] == i]
+            if len(d) > self.max_det:
+                d = d[np.argpartition(-d[:, 6], self.max_det)[:self.max_det]]
+            rows = output[i, 1:].reshape(self.max_det, self.det_len)
+            k = len(d)
+            output[i, 0] = k
+            rows[:k, 0] = (d[:, 1] + d[:, 3]) / 2
+            rows[:k, 1] = (d[:, 2] + d[:, 4]) / 2
+            rows[:k, 2] = d[:, 3] - d[:, 1]
+            rows[:k, 3] = d[:, 4] - d[:, 2]
+            rows[:k, 4] = d[:, 6]
+            rows[:k, 5] = d[:, 5]
+        return output
+
+    def close(self):
+        self.session = None
+        self.input_buffer = None
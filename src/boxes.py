@@ -0,0 +1,41 @@
+import numpy as np
+
+
+def box_iou(box1, box2):
+    """Pairwise IoU of (N, 4) and (M, 4) xyxy boxes."""
+    lt = np.maximum(box1[:, None, :2], box2[None, :, :2])
+    rb = np.minimum(box1[:, None, 2:], box2[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(2)
+    area1 = (box1[:, 2:] - box1[:, :2]).prod(1)
+    area2 = (box2[:, 2:] - box2[:, :2]).prod(1)
+    return inter / (area1[:, None] + area2[None, :] - inter + 1e-16)
+
+
+def expand_box(box, w, h, min_size, pad=0.0):
+    """Pads an xyxy box by pad times its size, to at least min_size square, kept inside a w x h frame."""
+    x1, y1, x2, y2 = (float(v) for v in box)
+    bw = max((x2 - x1) * (1 + 2 * pad), min_size)
+    bh = max((y2 - y1) * (1 + 2 * pad), min_size)
+    cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+    x1 = int(np.clip(cx - bw / 2, 0, max(0, w - bw)))
+    y1 = int(np.clip(cy - bh / 2, 0, max(0, h - bh)))
+    return x1, y1, int(min(w, x1 + bw)), int(min(h, y1 + bh))
+
+
+def merge_boxes(boxes):
+    """Unions overlapping xyxy boxes until none overlap."""
+    merged = True
+    while merged:
+        merged = False
+        out = []
+        for box in boxes:
+            for i, other in enumerate(out):
+                if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                    out[i] = (min(box[0], other[0]), min(box[1], other[1]),
+                              max(box[2], other[2]), max(box[3], other[3]))
+                    merged = True
+                    break
+            else:
+                out.append(box)
+        boxes = out
+    return boxes
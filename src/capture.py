@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from collections import deque
+
+import cv2
+
+
+class CameraCapture:
+    """Reads a camera on its own thread and hands out only the newest frame.
+
+    cv2.VideoCapture queues frames in the driver, so a slow reader gets ever
+    staler ones. Here a thread reads as fast as the camera delivers and
+    reopens it with backoff whenever it drops out; a video file is read to
+    its end once.
+    """
+    def __init__(self, source=0, api=cv2.CAP_ANY, settings=None, warmup=0.0, backoff=1.0, max_backoff=30.0,
+                 fps=None, opener=None, policy="latest", depth=1, ready=None):
+        # What happens when frames arrive faster than they are read: "latest" keeps only the newest,
+        # "queue" the newest depth frames, and "block" pauses reading while depth frames wait, e.g. for recorded video
+        if policy not in ("latest", "queue", "block"):
+            raise ValueError(f"unknown drop policy {policy!r}")
+        self.source = source  # source and api are passed to cv2.VideoCapture, so a video file can stand in
+        self.api = api
+        self.settings = settings or {}  # cv2.CAP_PROP_* values applied on every (re)open
+        self.warmup = warmup  # seconds to let the camera settle after opening
+        self.backoff = backoff  # first delay before reopening, doubled on every failure up to max_backoff
+        self.max_backoff = max_backoff
+        self.fps = fps  # paces sources that are not real-time, such as video files
+        self.policy = policy
+        self.depth = 1 if policy == "latest" else depth
+        self.ready = ready  # threading.Event set whenever a frame arrives, so one thread can wait on several captures
+        # opener replaces cv2.VideoCapture entirely, e.g. with a synthetic source
+        self.opener = opener or (lambda: cv2.VideoCapture(self.source, self.api))
+        self.frames = 0
+        self.dropped = 0  # frames replaced before anyone read them
+        self.reconnects = 0
+        self.timestamp = None  # capture time of the frame last returned by read()
+        self.__file = isinstance(source, str) and opener is None and os.path.isfile(source)
+        self.__frames = deque()
+        self.__ended = False
+        self.__connected = False
+        self.__stopped = threading.Event()
+        self.__ready = threading.Condition()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def isOpened(self):
+        return self.__connected
+
+    @property
+    def ended(self):
+        """Whether the source is a video file that ended and every frame of it was read."""
+        with self.__ready:
+            return self.__ended and not self.__frames
+
+    def read(self, timeout=None):
+        """(True, frame) with the oldest frame kept and not returned yet, or (False, None) on timeout or release.
+
+        With the "latest" policy that is always the newest frame.
+        """
+        with self.__ready:
+            self.__ready.wait_for(lambda: self.__frames or self.__ended or self.__stopped.is_set(), timeout)
+            if not self.__frames:
+                return False, None
+            frame, self.timestamp = self.__frames.popleft()
+            self.__ready.notify_all()
+            return True, frame
+
+    def release(self):
+        self.__stopped.set()
+        with self.__ready:
+            self.__ready.notify_all()
+        self.__thread.join()
+
+    def stats(self):
+        return {"frames": self.frames, "dropped": self.dropped, "reconnects": self.reconnects}
+
+    def __open(self):
+        """Opens the source, retrying with backoff until it opens or the capture is released."""
+        delay = self.backoff
+        while not self.__stopped.is_set():
+            cap = self.opener()
+            if cap.isOpened():
+                for prop, value in self.settings.items():
+                    cap.set(prop, value)
+                self.__stopped.wait(self.warmup)
+                return cap
+            cap.release()
+            print(f"Camera not connected. Retrying in {delay:g} seconds...")
+            self.__stopped.wait(delay)
+            delay = min(delay * 2, self.max_backoff)
+        return None
+
+    def __run(self):
+        while not self.__stopped.is_set():
+            cap = self.__open()
+            if cap is None:
+                return
+            print("Camera connected!")
+            self.__connected = True
+            next_read = time.time()
+            while not self.__stopped.is_set():
+                if self.fps:
+                    next_read += 1 / self.fps
+                    self.__stopped.wait(next_read - time.time())
+                ret, frame = cap.read()
+                if not ret and self.__file:
+                    print("End of video file.")
+                    self.__connected = False
+                    cap.release()
+                    with self.__ready:
+                        self.__ended = True
+                        self.__ready.notify_all()
+                    if self.ready is not None:
+                        self.ready.set()
+                    return
+                if not ret:
+                    print("Failed to grab frame, reconnecting...")
+                    break
+                # VideoCapture.read returns a new array each time, so the frame is handed over without a copy
+                with self.__ready:
+                    if self.policy == "block":
+                        self.__ready.wait_for(lambda: len(self.__frames) < self.depth or self.__stopped.is_set())
+                    elif len(self.__frames) == self.depth:
+                        self.__frames.popleft()
+                        self.dropped += 1
+                    self.__frames.append((frame, time.time()))
+                    self.frames += 1
+                    self.__ready.notify_all()
+                if self.ready is not None:
+                    self.ready.set()
+            self.__connected = False
+            cap.release()
+            if not self.__stopped.is_set():
+                self.reconnects += 1
@@ -1,11 +1,29 @@
 import cv2
-import time
 from datetime import datetime
 from src.yoloDet import YoloTRT
+from src.backend import TorchBackend, ONNXBackend
+from src.pipeline import InferencePipeline
+from src.motion import MotionGate
+from src.quality import QualityGate
+from src.capture import CameraCapture
+from src.tracker import Tracker
 from src.location import LocationManager
 from src.firebase import DetectionUploader
+from src.payload import PayloadEncoder
 import numpy as np
 
+CAMERA_SETTINGS = {
+    cv2.CAP_PROP_BUFFERSIZE: 1,
+    cv2.CAP_PROP_FPS: 5,
+    cv2.CAP_PROP_AUTOFOCUS: 0,
+    cv2.CAP_PROP_FOCUS: 200,
+    cv2.CAP_PROP_EXPOSURE: -6,
+    cv2.CAP_PROP_FOURCC: cv2.VideoWriter_fourcc(*"MJPG"),
+}
+
+# Class name stored with uploads, per model class id
+UPLOAD_CLASSES = ["Aedes Mosquito", "Aedes Mosquito", "Aedes Mosquito"]
+
 
 def sharpen_image(image):
     kernel = np.array([[0, -2, 0],
@@ -13,19 +31,29 @@ def sharpen_image(image):
                        [0, -2, 0]])
     return cv2.filter2D(image, -1, kernel)
 
-def scale_coords(coords, orig_shape, small_shape):
-    x1, y1, x2, y2 = coords
+def scale_coords(boxes, orig_shape, small_shape):
     scale_x = orig_shape[1] / small_shape[1]
     scale_y = orig_shape[0] / small_shape[0]
-    return int(x1 * scale_x), int(y1 * scale_y), int(x2 * scale_x), int(y2 * scale_y)
-
-def run_detection(dev_mode):
-    # Initialize YOLO model
+    return np.trunc(boxes * np.array([scale_x, scale_y, scale_x, scale_y]))
+
+def load_backend(weights, threads=None):
+    """CPU backend for .pt or .onnx weights, or None for the TensorRT engine."""
+    if not weights:
+        return None
+    if weights.endswith(".onnx"):
+        return ONNXBackend(weights, threads=threads)
+    return TorchBackend(weights, threads=threads)
+
+def run_detection(dev_mode, weights=None, threads=None, tile_size=None, tile_overlap=0.2, motion=False,
+                  quality=None, quality_stats=None, source=None, payload=None, index="firestore",
+                  offline=None):
+    # Initialize YOLO model, on the CPU if weights are given
     model = YoloTRT(
         library="yolov7/build/libmyplugins.so",
         engine="yolov7/build/yolov7-tiny.engine",
         conf=0.7,
-        yolo_ver="v7"
+        yolo_ver="v7",
+        backend=load_backend(weights, threads)
     )
 
     # Initialize location manager
@@ -34,82 +62,122 @@ def run_detection(dev_mode):
 
     # Initialize Database manager
     print("Initializing Detection Uploader...")
-    database_manager = DetectionUploader()
-
-    # Keep checking until a camera is connected
-    while True:
-        cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
-        if cap.isOpened():
-            print("Camera connected!")
-            time.sleep(5)
-            break
-        else:
-            print("Camera not connected. Retrying in 5 seconds...")
-            time.sleep(5)
+    # payload holds the PayloadEncoder settings of what is uploaded per mosquito
+    # offline holds the DetectionUploader offline first, disk quota and drain settings
+    database_manager = DetectionUploader(index=index, payload=PayloadEncoder(**(payload or {})), **(offline or {}))
 
-    cap.set(cv2.CAP_PROP_FPS, 5)
-    cap.set(cv2.CAP_PROP_AUTOFOCUS, 0)
-    cap.set(cv2.CAP_PROP_FOCUS, 200)
-    cap.set(cv2.CAP_PROP_EXPOSURE, -6)
-    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    # Read the camera on its own thread, reconnecting whenever it drops out
+    if source is None:
+        cap = CameraCapture(0, cv2.CAP_V4L2, CAMERA_SETTINGS, warmup=5)
+    else:
+        cap = CameraCapture(source, fps=CAMERA_SETTINGS[cv2.CAP_PROP_FPS])
 
     frame_counter = 0
     skip_frames = 1  # Process every frame
-    max_mosquito_counter = 0
+    tracker = Tracker()
+    pipeline = InferencePipeline(model)
+    gate = None
+    if motion:
+        # Static frames reuse the last detections, moving regions are inferred alone
+        full_frame = (lambda img: model.InferenceTiled(img, tile_size, tile_overlap)) if tile_size else None
+        gate = MotionGate(model, inference=full_frame, min_size=tile_size or model.input_w)
+    # quality holds the QualityGate thresholds, frames failing them are not inferred
+    quality_gate = QualityGate(**quality) if quality is not None else None
+
+    def upload(finished):
+        """Sends each finished mosquito track to firebase once, with its best frame.
+
+        Tracks whose best frame is the same frame share one upload, with the
+        detections of all of them.
+        """
+        frames = {}
+        for track_id, conf, (best_frame, best_detections, best_time, lat, lon) in finished:
+            print(f"Detected mosquito {track_id} at {lat}, {lon} at {best_time.strftime('%Y-%m-%d %H:%M:%S')}. Uploading to Firebase...")
+            _, detections, *_ = frames.setdefault(id(best_frame), (best_frame, {}, best_time, lat, lon))
+            detections[id(best_detections)] = best_detections
+
+        for best_frame, detections, best_time, lat, lon in frames.values():
+            # Encoded as JPEG on the uploader's encoder threads
+            database_manager.schedule_frame(best_frame, {
+                "timestamp": best_time,
+                "latitude": lat,
+                "longitude": lon,
+                "detections": np.concatenate(list(detections.values())),
+                "classes": UPLOAD_CLASSES
+            })
+
+    def handle(sharp_frame, frame, detections, t):
+        """Draws and tracks the detections of an inferred frame, and returns the frame."""
+        fps = round(1 / t, 2) if t else 0
+
+        # add fps
+        cv2.putText(frame, f"FPS: {fps}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 1)
+
+        print("Detections:", len(detections))
+        payload = None
+        if len(detections):
+            lat, lon = location_manager.current_location()
+            current_time = datetime.now()
+            processed_detections = detections.copy()
+            processed_detections["box"] = scale_coords(detections["box"], frame.shape, sharp_frame.shape)
+
+            for (x1, y1, x2, y2), conf, class_id in processed_detections:
+                # Draw bounding box
+                x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+                cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 1)
+                cv2.putText(frame, f"{model.categories[class_id]} - {conf:.2f}", (x1, y1+1), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 1)
+
+            print("Processed Detections: ", len(processed_detections))
+            payload = (frame, processed_detections, current_time, lat, lon)
+        else:
+            processed_detections = detections
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            print("Failed to grab frame")
-            break
+        # Tracks keep the frame of their most confident detection until they are uploaded
+        tracker.update(processed_detections, payload)
 
-        print("Max Mosquito Counter: ", max_mosquito_counter)
+        upload(tracker.finished())
+        return frame
 
-        if frame_counter % skip_frames == 0:
+    while True:
+        ret, frame = cap.read(timeout=1)
+        if not ret:
+            if cap.ended:
+                break  # the video file is over
+            continue  # the capture thread is reconnecting
+
+        completed = []
+        infer_frame = frame_counter % skip_frames == 0
+        if infer_frame and quality_gate is not None:
+            infer_frame = quality_gate.check(frame)
+            if frame_counter % 100 == 0:
+                print("Quality gate:", quality_gate.stats()["skipped"])
+                if quality_stats:
+                    quality_gate.export(quality_stats)
+
+        if infer_frame and gate is not None:
+            regions = gate.changed_regions(frame)
+            if regions == []:
+                # Nothing moved, so skip sharpening and inference
+                detections, t = gate.infer(frame, regions)
+                completed.append((frame, frame, detections, t))
+            else:
+                sharp_frame = sharpen_image(frame)
+                detections, t = gate.infer(sharp_frame, regions)
+                completed.append((sharp_frame, frame, detections, t))
+            if frame_counter % 100 == 0:
+                print("Motion gate:", gate.stats())
+        elif infer_frame:
             sharp_frame = sharpen_image(frame)
-            detections, t = model.Inference(sharp_frame)
-            fps = round(1 / t, 2)
-
-            # add fps
-            cv2.putText(frame, f"FPS: {fps}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 1)
-
-            print("Detections:", len(detections))
-            if detections:
-                lat, lon = location_manager.current_location()
-                current_time = datetime.now()
-                processed_detections = []
-
-                for detection in detections:
-                    # Draw bounding box
-                    x1, y1, x2, y2 = scale_coords(detection['box'], frame.shape, sharp_frame.shape)
-
-                    cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 1)
-                    cv2.putText(frame, f"{detection['class']} - {detection['conf']:.2f}", (x1, y1+1), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 1)
-                    # add to processed detections
-                    processed_detections.append({
-                        "class": "Aedes Mosquito",
-                        "confidence": detection['conf'],
-                        "box": [x1, y1, x2, y2]
-                    })
-
-                print("Processed Detections: ", len(processed_detections))
-
-                # send to firebase if it exceeds the max mosquito counter
-                if len(processed_detections) > max_mosquito_counter:
-                    print(f"Detected mosquito at {lat}, {lon} at {current_time.strftime('%Y-%m-%d %H:%M:%S')}. Uploading to Firebase...")
-                    max_mosquito_counter = len(processed_detections)
-
-                    # Encode image as JPEG
-                    _, buffer = cv2.imencode(".jpg", frame)
-
-                    # Convert to bytes
-                    image_bytes = buffer.tobytes()
-                    database_manager.schedule_for_upload(image_bytes, {
-                        "timestamp": current_time,
-                        "latitude": lat,
-                        "longitude": lon,
-                        "detections": processed_detections
-                    })
+            if tile_size:
+                # The tiles of a frame are already batched, so run them inline
+                detections, t = model.InferenceTiled(sharp_frame, tile_size, tile_overlap)
+                completed.append((sharp_frame, frame, detections, t))
+            else:
+                pipeline.submit(sharp_frame, frame)
+
+        # Handle the frames that finished while this one was captured
+        for result in completed + pipeline.completed():
+            frame = handle(*result)
 
         frame_counter += 1
 
@@ -121,7 +189,17 @@ def run_detection(dev_mode):
             if cv2.waitKey(1) == ord('q'):
                 break
 
+    print("Capture:", cap.stats())
+    print("Payload:", database_manager.payload.stats())
     cap.release()
     cv2.destroyAllWindows()
+    # The frames still in flight are tracked too, before the tracks are flushed
+    for result in pipeline.close():
+        handle(*result)
+    # Mosquitoes still being tracked would otherwise never be uploaded
+    upload(tracker.flush())
+    if quality_gate is not None and quality_stats:
+        quality_gate.export(quality_stats)
+    model.close()
     location_manager.close()
-    database_manager.wait_for_completion()
\ No newline at end of file
+    database_manager.wait_for_completion(timeout=30)
\ No newline at end of file
@@ -0,0 +1,8 @@
+import numpy as np
+
+# One row per detection, in original frame coordinates
+DETECTION_DTYPE = np.dtype([
+    ("box", np.float32, (4,)),
+    ("conf", np.float32),
+    ("class_id", np.int32),
+])
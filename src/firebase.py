@@ -1,114 +1,517 @@
 import json
 import asyncio
 import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 import aiohttp
-from google.auth.transport.requests import Request
 from google.oauth2 import service_account
 from datetime import datetime, timezone
 
 from app import DEVICE_NAME, DEVICE_ID
+from src.auth import TokenProvider
+from src.payload import PayloadEncoder
+from src.spool import ORDERS, UploadSpool
+from src.retry import CircuitBreaker, RateLimiter, backoff_delay
 
 
 class DetectionUploader:
-    def __init__(self):
+    """Uploads detections to Firebase from an event loop on its own thread.
+
+    Every upload is stored in an UploadSpool on disk before it is scheduled
+    and removed only once Firebase accepted it, so whatever is not sent
+    before a crash, a power cut or an outage is sent later. The loop is only
+    reached through call_soon_threadsafe, so uploads may be scheduled from
+    any thread.
+    """
+    def __init__(self, spool_path="uploads.db", batch_size=16, concurrency=4, queue_size=None,
+                 overflow="spill", max_pending=1000, index="firestore", commit_size=20, commit_delay=1.0, request_timeout=60.0,
+                 retry_base=1.0, retry_cap=300.0, breaker_threshold=5, breaker_reset=30.0, token_margin=300.0, encode_workers=2,
+                 frame_memory=64 * 1024 ** 2, payload=None, offline_after=None, probe_interval=30.0,
+                 disk_quota=None, drain_order="oldest", sync_rate=None, credentials=None,
+                 storage_url="https://firebasestorage.googleapis.com", firestore_url="https://firestore.googleapis.com"):
+        if overflow not in ("spill", "drop-oldest"):
+            raise ValueError(f"unknown overflow policy {overflow!r}")
+        if index not in ("firestore", "metadata"):
+            raise ValueError(f"unknown index {index!r}")
+        if drain_order not in ORDERS:
+            raise ValueError(f"unknown drain order {drain_order!r}")
         self.__SERVICE_ACCOUNT_FILE = "trapmosCredentials.json"
         self.__BUCKET_NAME = "finaltrapmos.firebasestorage.app"
-        self.__credentials = service_account.Credentials.from_service_account_file(
-            self.__SERVICE_ACCOUNT_FILE,
-            scopes=[
-                "https://www.googleapis.com/auth/cloud-platform",
-                "https://www.googleapis.com/auth/datastore"
-                ]
-        )
+        # credentials and the service URLs can be replaced, e.g. to upload to a local test server
+        self.__STORAGE_URL = storage_url
+        self.__FIRESTORE_URL = firestore_url
+        if credentials is None:
+            credentials = service_account.Credentials.from_service_account_file(
+                self.__SERVICE_ACCOUNT_FILE,
+                scopes=[
+                    "https://www.googleapis.com/auth/cloud-platform",
+                    "https://www.googleapis.com/auth/datastore"
+                    ]
+            )
+        self.__credentials = credentials
         self.__PROJECT_ID = self.__credentials.project_id
 
-        auth_req = Request()
-        self.__credentials.refresh(auth_req)
-        self.__access_token = self.__credentials.token
+        # The access token is refreshed token_margin seconds before it expires, and again on a 401
+        self.__tokens = TokenProvider(self.__credentials, refresh_margin=token_margin)
 
-        self.__queue = asyncio.Queue()
-        self.__loop = asyncio.get_event_loop()
-        self.__running = True
-        self.__task = self.__loop.create_task(self.__worker())
-        self.__thread = threading.Thread(target=self.__run_loop)
+        self.__spool = UploadSpool(spool_path)
+        self.__batch_size = batch_size  # items read from the spool at a time, to refill the in-memory queue
+        self.__queue_size = queue_size or 2 * concurrency
+        self.__concurrency = concurrency  # workers uploading at once over one aiohttp session
+        # "drop-oldest" caps the spool at max_pending items, "spill" keeps them all
+        self.__overflow = overflow
+        self.__max_pending = max_pending
+        # "metadata" writes no documents, the detection data goes with the image as its Storage custom
+        # metadata in one multipart request, for a job on the server to index
+        self.__index = index
+        self.__commit_size = min(commit_size, 500)  # Firestore's limit on writes per commit
+        self.__commit_delay = commit_delay  # seconds to wait at most for a batch of documents to fill
+        self.__request_timeout = request_timeout
+        # A failed item goes back to the spool, retried after a jittered backoff from retry_base up to retry_cap seconds
+        self.__retry_base = retry_base
+        self.__retry_cap = retry_cap
+        # Uploads pause after breaker_threshold failures in a row, probing every breaker_reset seconds
+        self.__breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        # Offline first: offline_after requests in a row without any answer mark the network down, and nothing
+        # is sent, nor counted as an attempt, until a probe every probe_interval seconds gets an answer
+        self.__offline_after = offline_after
+        self.__probe_interval = probe_interval
+        self.__disk_quota = disk_quota  # bytes of spooled images kept at most, dropping the oldest
+        self.__drain_order = drain_order  # an ORDERS key: "oldest", "newest" or "confidence" first
+        self.__limiter = RateLimiter(sync_rate) if sync_rate else None  # bytes per second sent at most
+        self.__network_failures = 0
+        self.online = True
+        self.dropped = 0
+        self.rejected = 0
+        if len(self.__spool):
+            print(f"📦 Replaying {len(self.__spool)} unsent uploads")
+        # schedule_frame encodes frames on these threads, so the detection loop does not wait on cv2.imencode
+        self.__encoder = ThreadPoolExecutor(encode_workers, thread_name_prefix="encoder")
+        self.__frame_memory = frame_memory  # bytes of frames waiting to be encoded, past that they are encoded inline
+        self.payload = payload or PayloadEncoder()  # decides what is sent for a frame, and at what JPEG quality
+        self.frame_bytes = 0  # held by frames waiting to be encoded
+        self.encoded_inline = 0
+        self.__lock = threading.Lock()
+        self.__closed = False
+        self.__draining = False
+        self.__deadline = None
+        self.__started = threading.Event()
+        self.__thread = threading.Thread(target=asyncio.run, args=(self.__run(),), name="uploader")
         self.__thread.start()
+        self.__started.wait()
+
+    async def __run(self):
+        """Main task of the uploader thread, feeding the spool to the upload workers until drained."""
+        self.__loop = asyncio.get_running_loop()
+        self.__queue = asyncio.Queue(maxsize=self.__queue_size)
+        self.__documents = asyncio.Queue()
+        self.__wakeup = asyncio.Event()
+        self.__network_up = asyncio.Event()
+        self.__network_up.set()
+        self.__started.set()
+        try:
+            timeout = aiohttp.ClientTimeout(total=self.__request_timeout)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                self.__session = session
+                print("🚀 Uploader started")
+                workers = [self.__loop.create_task(self.__worker(session)) for _ in range(self.__concurrency)]
+                batcher = self.__loop.create_task(self.__batch_documents(session))
+                await self.__feed()
+                try:
+                    await asyncio.wait_for(self.__finish(workers, batcher), self.__remaining())
+                except asyncio.TimeoutError:
+                    print("⚠️ Upload deadline passed, leaving the rest for the next start")
+        finally:
+            # Nothing is in flight any more, so whatever is still leased was not sent
+            self.__spool.release_all()
 
-    def __run_loop(self):
-        asyncio.set_event_loop(self.__loop)
-        self.__loop.run_forever()
+    async def __finish(self, workers, batcher):
+        """Lets the workers and the batcher finish what they have, then stops them."""
+        for _ in workers:
+            await self.__queue.put(None)  # stops a worker once the items before it are done
+        await asyncio.gather(*workers)
+        await self.__documents.put(None)
+        await batcher
 
-    async def __worker(self):
-        """Background task that handles uploads."""
-        async with aiohttp.ClientSession() as session:
-            print("🚀 Uploader started")
-            while self.__running:
+    async def __feed(self):
+        """Leases items from the spool to the workers until it is drained or the deadline passes."""
+        while not (self.__draining and (self.__expired() or not len(self.__spool))):
+            # Lease no more than the queue has room for, the rest stays on disk, as does everything while offline
+            room = self.__queue.maxsize - self.__queue.qsize() if self.__network_up.is_set() else 0
+            batch = self.__spool.get_batch(min(self.__batch_size, room), self.__drain_order) if room else []
+            if not batch:
+                remaining = self.__remaining()
                 try:
-                    image, data, firebase_path = await asyncio.wait_for(self.__queue.get(), timeout=1.0)
-                    result = await self.__upload_to_firebase(session, image, data, firebase_path)
-                    if result:
-                        self.__queue.task_done()
+                    await asyncio.wait_for(self.__wakeup.wait(), timeout=1.0 if remaining is None else min(1.0, remaining))
                 except asyncio.TimeoutError:
-                    pass  # Prevents blocking if the queue is empty
-                except:
-                    print(data)
-                    print("⚠️ Error uploading image")
+                    pass  # Prevents blocking if the spool is empty
+                self.__wakeup.clear()
+                continue
+            for item in batch:
+                await self.__queue.put(item)
 
-    async def __upload_to_firebase(self, session, image, data, firebase_path):
-        """Uploads an image to Firebase Storage via REST API asynchronously."""
-        try:
+    def __remaining(self):
+        """Seconds until the deadline, or None without one."""
+        if self.__deadline is None:
+            return None
+        return max(0.0, self.__deadline - time.monotonic())
+
+    def __expired(self):
+        return self.__remaining() == 0.0
+
+    async def __worker(self, session):
+        """Uploads queued images one at a time, alongside the other workers.
+
+        Their Firestore documents are handed to __batch_documents, which acks
+        the items once the documents are written. Images uploaded with their
+        metadata are acked right away.
+        """
+        while True:
+            item = await self.__queue.get()
+            self.__queue.task_done()
+            self.__wakeup.set()  # the queue has room again
+            if item is None:
+                return
+            item_id, image, data, firebase_path, attempts, uploaded = item
             file_name = firebase_path.split("/")[-1]
-            firebase_url = f"https://firebasestorage.googleapis.com/v0/b/{self.__BUCKET_NAME}/o?name={firebase_path}"
-            firestore_url = f"https://firestore.googleapis.com/v1/projects/{self.__PROJECT_ID}/databases/(default)/documents/Uploads/{file_name}"
+            if uploaded:
+                # Only the document failed last time, the image is in Storage already
+                await self.__documents.put((item_id, attempts, file_name, self.__to_firestore_json(data, file_name)))
+                continue
+            if not await self.__wait_for_network() or not await self.__wait_for_breaker():
+                self.__spool.release([item_id])
+                continue
+            if self.__limiter is not None:
+                await asyncio.sleep(self.__limiter.reserve(len(image)))
+            metadata = self.__to_custom_metadata(data, file_name) if self.__index == "metadata" else None
+            try:
+                status = await self.__upload_to_firebase(session, image, firebase_path, metadata)
+            except:
+                print(data)
+                print("⚠️ Error uploading image")
+                status = None
+            if self.__network_lost(status):
+                self.__spool.release([item_id])
+                continue
+            result = status == 200
+            self.__record(result)
+            if not result:
+                self.__retry([item_id], [attempts])
+                continue
+            self.payload.record_upload(len(image))
+            if metadata is not None:
+                self.__spool.ack([item_id])
+                self.__wakeup.set()  # the spool may be drained
+            else:
+                self.__spool.mark_uploaded([item_id])
+                await self.__documents.put((item_id, attempts, file_name, self.__to_firestore_json(data, file_name)))
 
-            headers = {
-                "Authorization": f"Bearer {self.__access_token}",
-                "Content-Type": "image/jpeg",
-            }
+    async def __batch_documents(self, session):
+        """Writes the Firestore documents of uploaded images in batches.
+
+        A batch is committed once it holds commit_size documents or its
+        first document has waited commit_delay seconds. Up to concurrency
+        commits run at once.
+        """
+        self.__commits = commits = asyncio.Semaphore(self.__concurrency)
+        pending = set()
+        stopping = False
+        while not stopping:
+            batch = [await self.__documents.get()]
+            if batch[0] is None:
+                break
+            deadline = self.__loop.time() + self.__commit_delay
+            while len(batch) < self.__commit_size:
+                try:
+                    document = await asyncio.wait_for(self.__documents.get(), deadline - self.__loop.time())
+                except asyncio.TimeoutError:
+                    break
+                if document is None:
+                    stopping = True
+                    break
+                batch.append(document)
+
+            await commits.acquire()
+            task = self.__loop.create_task(self.__write_batch(session, batch))
+            task.add_done_callback(lambda task: commits.release())
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        try:
+            if pending:
+                await asyncio.wait(pending)
+        except asyncio.CancelledError:
+            for task in pending:
+                task.cancel()
+            raise
+
+    async def __write_batch(self, session, batch):
+        """Commits a batch and acks its items.
+
+        If Firestore rejects the commit, its documents are committed one by
+        one, concurrently, and a document rejected on its own is moved out of
+        the spool. Called holding a commit slot.
+        """
+        ids = [item_id for item_id, _, _, _ in batch]
+        attempts = [attempt for _, attempt, _, _ in batch]
+        if not await self.__wait_for_network() or not await self.__wait_for_breaker():
+            self.__spool.release(ids)
+            return
+        status = await self.__commit_documents(session, batch)
+        if self.__network_lost(status):
+            self.__spool.release(ids)
+            return
+        # Firestore refused the documents themselves, not the request
+        rejected = status is not None and 400 <= status < 500 and status not in (401, 403, 408, 429)
+        # A rejected commit still means Firestore is up
+        self.__record(status == 200 or rejected)
+        if status == 200:
+            self.__spool.ack(ids)
+            self.__wakeup.set()  # the spool may be drained
+        elif rejected and len(batch) > 1:
+            # The batch's commit slot goes to its single document commits meanwhile
+            self.__commits.release()
+            try:
+                await asyncio.gather(*(self.__write_alone(session, document) for document in batch))
+            finally:
+                await self.__commits.acquire()
+        elif rejected:
+            self.__spool.reject(ids, f"HTTP {status}")
+            self.rejected += 1
+            self.__wakeup.set()
+            print(f"❌ Firestore rejected document {batch[0][2]}, moved it to the rejected table")
+        else:
+            self.__retry(ids, attempts)
+
+    async def __write_alone(self, session, document):
+        async with self.__commits:
+            await self.__write_batch(session, [document])
+
+    async def __wait_for_breaker(self):
+        """Waits until the circuit breaker lets a request out, or returns False if the deadline passes first."""
+        while not self.__breaker.allow():
+            if self.__expired():
+                return False
+            await asyncio.sleep(min(max(self.__breaker.retry_in(), 0.05), 1.0))
+        return True
+
+    async def __wait_for_network(self):
+        """Waits until the network is up, or returns False if the deadline passes first."""
+        while not self.__network_up.is_set():
+            if self.__expired():
+                return False
+            remaining = self.__remaining()
+            try:
+                await asyncio.wait_for(self.__network_up.wait(), 1.0 if remaining is None else min(1.0, remaining))
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    def __network_lost(self, status):
+        """Whether a request that got status, None without an answer, failed because the network is down.
+
+        Only in offline first mode; enough of them in a row take the uploader offline.
+        """
+        if self.__offline_after is None:
+            return False
+        if status is not None:
+            self.__network_failures = 0
+            return False
+        if self.__breaker.state == CircuitBreaker.HALF_OPEN:
+            self.__record(False)  # the breaker's probe got no answer, so it reopens instead of waiting on it forever
+        self.__network_failures += 1
+        if self.online and self.__network_failures >= self.__offline_after:
+            self.online = False
+            self.__network_up.clear()
+            print(f"📴 Network down, keeping {len(self.__spool)} uploads on disk until it is back")
+            self.__loop.create_task(self.__probe())
+        return True
+
+    async def __probe(self):
+        """Sends an empty request every probe_interval seconds until any answer comes back."""
+        timeout = aiohttp.ClientTimeout(total=min(self.__request_timeout, 10.0))
+        while not self.__expired():
+            remaining = self.__remaining()
+            await asyncio.sleep(self.__probe_interval if remaining is None else min(self.__probe_interval, remaining))
+            try:
+                async with self.__session.head(self.__STORAGE_URL, timeout=timeout):
+                    pass
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                continue
+            self.__network_failures = 0
+            self.online = True
+            self.__network_up.set()
+            self.__wakeup.set()
+            print(f"📶 Network back, sending {len(self.__spool)} uploads")
+            return
+
+    def __record(self, success):
+        if success:
+            self.__breaker.record_success()
+            return
+        was_open = self.__breaker.state == CircuitBreaker.OPEN
+        self.__breaker.record_failure()
+        if not was_open and self.__breaker.state == CircuitBreaker.OPEN:
+            print(f"⚠️ Firebase unreachable, pausing uploads for {self.__breaker.reset_timeout:g} seconds")
 
-            async with session.post(firebase_url, headers=headers, data=image) as response:
-                if response.status == 200:
-                    print("✅ Upload successful:", await response.json())
-                else:
-                    print("❌ Upload failed:", await response.text())
-                    return False
+    def __retry(self, ids, attempts):
+        """Sends failed items back to the spool, due again after a jittered exponential backoff."""
+        self.__spool.retry(ids, [backoff_delay(attempt, self.__retry_base, self.__retry_cap) for attempt in attempts])
 
+    async def __post(self, session, url, content_type, data, headers=None):
+        """POSTs with the current access token, refreshing it and retrying once on 401.
+
+        Returns the HTTP status and the response body. Without a token yet it
+        is fetched first; if that fails the error is raised like any network
+        error, so the request counts as failed or as the network being down.
+        """
+        token = self.__tokens.token
+        if token is None:
+            token = await self.__tokens.refresh(None)
+        for attempt in range(2):
             headers = {
-                "Authorization": f"Bearer {self.__access_token}",
-                "Content-Type": "application/json",
+                **(headers or {}),
+                "Authorization": f"Bearer {token}",
+                "Content-Type": content_type,
             }
+            async with session.post(url, headers=headers, data=data) as response:
+                if response.status != 401 or attempt:
+                    return response.status, await response.text()
+            token = await self.__tokens.refresh(token)
 
-            json_data_str = json.dumps(self.__to_firestore_json(data, file_name))
+    async def __upload_to_firebase(self, session, image, firebase_path, metadata=None):
+        """Uploads an image to Firebase Storage via REST API asynchronously.
+
+        With metadata, a dict of strings, the image is sent with it as its
+        custom metadata in a single multipart request. Returns the HTTP
+        status, or None if the request did not complete.
+        """
+        try:
+            firebase_url = f"{self.__STORAGE_URL}/v0/b/{self.__BUCKET_NAME}/o?name={firebase_path}"
 
-            async with session.patch(firestore_url, headers=headers, data=json_data_str) as response:
-                if response.status == 200:
-                    print("✅ Upload successful:", await response.json())
-                else:
-                    print("❌ Upload failed:", await response.text())
-                    return False
+            if metadata is None:
+                status, body = await self.__post(session, firebase_url, "image/jpeg", image)
+            else:
+                boundary = uuid.uuid4().hex
+                resource = json.dumps({"name": firebase_path, "contentType": "image/jpeg", "metadata": metadata})
+                multipart = b"".join([
+                    f"--{boundary}\r\nContent-Type: application/json; charset=utf-8\r\n\r\n{resource}\r\n".encode(),
+                    f"--{boundary}\r\nContent-Type: image/jpeg\r\n\r\n".encode(),
+                    image,
+                    f"\r\n--{boundary}--".encode(),
+                ])
+                status, body = await self.__post(session, firebase_url, f"multipart/related; boundary={boundary}",
+                                                 multipart, {"X-Goog-Upload-Protocol": "multipart"})
+            if status == 200:
+                print("✅ Upload successful:", json.loads(body))
+            else:
+                print("❌ Upload failed:", body)
+            return status
 
         except Exception as e:
             print("⚠️ Error uploading image:", e)
-            return False
+            return None
+
+    async def __commit_documents(self, session, documents):
+        """Writes (item id, attempts, file name, document) tuples to Firestore in one atomic commit.
+
+        Returns the HTTP status, or None if the request did not complete.
+        """
+        try:
+            database = f"projects/{self.__PROJECT_ID}/databases/(default)"
+            commit_url = f"{self.__FIRESTORE_URL}/v1/{database}/documents:commit"
+
+            json_data_str = json.dumps({"writes": [
+                {"update": {"name": f"{database}/documents/Uploads/{file_name}", **document}}
+                for _, _, file_name, document in documents
+            ]})
+
+            status, body = await self.__post(session, commit_url, "application/json", json_data_str)
+            if status == 200:
+                print(f"✅ Committed {len(documents)} documents:", json.loads(body).get("commitTime"))
+            else:
+                print("❌ Commit failed:", body)
+            return status
+
+        except Exception as e:
+            print("⚠️ Error committing documents:", e)
+            return None
 
     def schedule_for_upload(self, image, data):
-        """Schedules an image for upload without blocking."""
+        """Stores an image for upload, returning once it is on disk. Safe to call from any thread."""
         file_path = self.__generate_name(data)
-        self.__queue.put_nowait((image, data, file_path))
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError("uploader is closed")
+            self.__spool.put(image, data, file_path)
+            dropped = 0
+            if self.__overflow == "drop-oldest":
+                dropped += self.__spool.trim(self.__max_pending)
+            if self.__disk_quota is not None:
+                dropped += self.__spool.trim_bytes(self.__disk_quota)
+            if dropped:
+                self.dropped += dropped
+                print(f"⚠️ Upload backlog full, dropped the {dropped} oldest")
+        self.__wake()
 
-    async def wait_until_done(self):
-        """Waits for all uploads to complete before exiting."""
-        await self.__queue.join()
-        self.shutdown()  # Ensure cleanup
+    def schedule_frame(self, frame, data):
+        """Stores a BGR frame for upload once an encoder thread has encoded it as JPEG.
 
-    def shutdown(self):
-        """Properly stops the background worker task."""
-        self.__running = False
+        The frame is kept, not copied, so it must not be modified afterwards.
+        """
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError("uploader is closed")
+            inline = self.frame_bytes + frame.nbytes > self.__frame_memory
+            if inline:
+                self.encoded_inline += 1
+            else:
+                self.frame_bytes += frame.nbytes
+        if inline:
+            self.schedule_for_upload(*self.__encode(frame, data))
+        else:
+            self.__encoder.submit(self.__encode_and_schedule, frame, data)
 
-    def wait_for_completion(self):
-        """Blocks until all uploads are done."""
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self.wait_until_done())
+    def __encode(self, frame, data):
+        """The payload for a frame and its data, with the payload described in data["payload"]."""
+        self.payload.adapt(len(self.__spool))
+        image, description = self.payload.encode(frame, data["detections"])
+        return image, {**data, "payload": description}
+
+    def __encode_and_schedule(self, frame, data):
+        try:
+            self.schedule_for_upload(*self.__encode(frame, data))
+        except Exception as e:
+            print("⚠️ Error encoding image:", e)
+        finally:
+            with self.__lock:
+                self.frame_bytes -= frame.nbytes
+
+    def wait_for_completion(self, timeout=None):
+        """Blocks until every upload is done, or timeout seconds have passed, and stops the uploader.
+
+        Frames waiting to be encoded are always stored first. Uploads still
+        in flight at the deadline are abandoned. Returns the number of
+        uploads left in the spool, which are sent after a restart.
+        """
+        if timeout is not None:
+            self.__deadline = time.monotonic() + timeout
+        self.__encoder.shutdown(wait=True)
+        self.__draining = True
+        self.__wake()
+        self.__thread.join()
+        with self.__lock:
+            self.__closed = True
+            self.__tokens.close()
+            left = len(self.__spool)
+            self.__spool.close()
+        return left
+
+    def __wake(self):
+        try:
+            self.__loop.call_soon_threadsafe(self.__wakeup.set)
+        except RuntimeError:
+            pass  # the loop already closed, the item waits in the spool for the next start
 
     def __generate_name(self, data):
         """Generates a unique name for the image based on the path.
@@ -121,12 +524,15 @@ class DetectionUploader:
         return f"{DEVICE_NAME}/{DEVICE_ID}_{timestamp}_{lat}_{lon}_{unique_id}.jpg"
 
     def __to_firestore_json(self, data, file_name):
-        """Converts the data to Firestore JSON format."""
+        """Converts the data to Firestore JSON format.
+                data["detections"] is a DETECTION_DTYPE array and data["classes"]
+                maps its class ids to names.
+        """
         detections = [{
             "mapValue": {
                 "fields": {
-                    "class": { "stringValue": detection["class"] },
-                    "confidence": { "doubleValue": float(detection["confidence"]) },
+                    "class": { "stringValue": data["classes"][int(detection["class_id"])] },
+                    "confidence": { "doubleValue": float(detection["conf"]) },
                     "box": { "arrayValue": { "values": [
                         { "doubleValue": float(detection["box"][0]) },
                         { "doubleValue": float(detection["box"][1]) },
@@ -139,36 +545,65 @@ class DetectionUploader:
 
         timestamp = timestamp = data["timestamp"].astimezone(timezone.utc).replace(microsecond=0).isoformat()
 
-        return {
-            "fields": {
-                "device": { "stringValue": DEVICE_NAME },
-                "file": { "stringValue": file_name },
-                "timestamp": { "timestampValue": timestamp },
-                "latitude": { "doubleValue": float(data["latitude"]) },
-                "longitude": { "doubleValue": float(data["longitude"]) },
-                "detections": { "arrayValue": { "values": detections } }
-            }
+        fields = {
+            "device": { "stringValue": DEVICE_NAME },
+            "file": { "stringValue": file_name },
+            "timestamp": { "timestampValue": timestamp },
+            "latitude": { "doubleValue": float(data["latitude"]) },
+            "longitude": { "doubleValue": float(data["longitude"]) },
+            "detections": { "arrayValue": { "values": detections } }
         }
+        if data.get("payload") is not None:
+            fields["payload"] = self.__to_firestore_value(data["payload"])
+        return { "fields": fields }
+
+    def __to_custom_metadata(self, data, file_name):
+        """The Storage custom metadata of an image uploaded with its data, as strings."""
+        detections = [{
+            "class": data["classes"][int(detection["class_id"])],
+            "confidence": float(detection["conf"]),
+            "box": [float(v) for v in detection["box"]],
+        } for detection in data["detections"]]
+        metadata = {
+            "device": DEVICE_NAME,
+            "file": file_name,
+            "timestamp": data["timestamp"].astimezone(timezone.utc).replace(microsecond=0).isoformat(),
+            "latitude": str(float(data["latitude"])),
+            "longitude": str(float(data["longitude"])),
+            "detections": json.dumps(detections),
+        }
+        if data.get("payload") is not None:
+            metadata["payload"] = json.dumps(data["payload"])
+        return metadata
+
+    def __to_firestore_value(self, value):
+        """Converts plain JSON data, e.g. a payload description, to a Firestore value."""
+        if isinstance(value, dict):
+            return { "mapValue": { "fields": { k: self.__to_firestore_value(v) for k, v in value.items() } } }
+        if isinstance(value, (list, tuple)):
+            return { "arrayValue": { "values": [self.__to_firestore_value(v) for v in value] } }
+        if isinstance(value, bool):
+            return { "booleanValue": value }
+        if isinstance(value, int):
+            return { "integerValue": str(value) }
+        if isinstance(value, float):
+            return { "doubleValue": value }
+        return { "stringValue": str(value) }
 
 if __name__ == "__main__":
     import cv2
+    import numpy as np
+    from src.detections import DETECTION_DTYPE
 
     data = {
         "timestamp": datetime.now(),
         "latitude": 14.1234,
         "longitude": 121.1234,
-        "detections": [
-            {
-                "class": "Aedes aegypti",
-                "confidence": 0.95,
-                "box": [0, 0, 100, 100]
-            },
-            {
-                "class": "Aedes albopictus",
-                "confidence": 0.85,
-                "box": [100, 100, 200, 200]
-            }
-        ]
+        "detections": np.array([
+            ([0, 0, 100, 100], 0.95, 1),
+            ([100, 100, 200, 200], 0.85, 2)
+        ], dtype=DETECTION_DTYPE),
+        "classes": ["Culex quinquefasciatus", "Aedes aegypti", "Aedes albopictus"]
     }
 
     firebase = DetectionUploader()
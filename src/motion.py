@@ -0,0 +1,124 @@
+import cv2
+import numpy as np
+
+from src.boxes import expand_box, merge_boxes
+
+
+class MotionGate:
+    """Skips inference on static frames and limits it to the regions that changed.
+
+    Each frame is compared, downscaled and blurred, against a running average
+    of the previous ones. When nothing moved the detector is not run at all
+    and the previous detections are reused. Otherwise only the padded
+    bounding boxes of the changed areas are cropped and inferred at native
+    resolution, at least min_size square, and their detections replace the
+    previous ones inside those regions. Once the regions cover more than
+    full_frame of the frame, or every refresh frames, the whole frame is
+    letterboxed and inferred instead, or passed to inference if given,
+    e.g. to run it tiled.
+
+    frames, skipped_frames, inferred_pixels and frame_pixels count what the
+    gate saved; stats() summarises them.
+    """
+    def __init__(self, model, inference=None, threshold=25, min_area=16, pad=32, min_size=640, scale=0.25, alpha=0.05,
+                 full_frame=0.5, refresh=300):
+        self.model = model
+        self.inference = inference or model.Inference
+        self.threshold = threshold
+        self.min_area = min_area
+        self.pad = pad
+        self.min_size = min_size
+        self.scale = scale
+        self.alpha = alpha
+        self.full_frame = full_frame
+        self.refresh = refresh
+        self.frames = 0
+        self.skipped_frames = 0
+        self.inferred_pixels = 0
+        self.frame_pixels = 0
+        self.__background = None
+        self.__detections = model.DetectionArray([], [], [])
+        self.__since_full = 0
+
+    def reset(self):
+        """Forgets the background, so the next frame is inferred in full."""
+        self.__background = None
+
+    def changed_regions(self, frame):
+        """(x1, y1, x2, y2) regions of frame that moved since the previous frames.
+
+        Returns an empty list when nothing changed and None when the whole
+        frame should be inferred.
+        """
+        h, w = frame.shape[:2]
+        small = cv2.resize(frame, (max(1, int(w * self.scale)), max(1, int(h * self.scale))),
+                           interpolation=cv2.INTER_LINEAR)
+        gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+
+        if self.__background is None or self.__background.shape != gray.shape:
+            self.__background = gray.astype(np.float32)
+            return None
+        diff = cv2.absdiff(gray, cv2.convertScaleAbs(self.__background))
+        cv2.accumulateWeighted(gray, self.__background, self.alpha)
+
+        _, mask = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)
+        if not cv2.countNonZero(mask):
+            return []
+        mask = cv2.dilate(mask, None, iterations=2)
+        _, _, components, _ = cv2.connectedComponentsWithStats(mask)
+        # Row 0 is the background component
+        components = components[1:][components[1:, cv2.CC_STAT_AREA] >= self.min_area * self.scale ** 2]
+        if not len(components):
+            return []
+
+        x1 = components[:, cv2.CC_STAT_LEFT] / self.scale - self.pad
+        y1 = components[:, cv2.CC_STAT_TOP] / self.scale - self.pad
+        x2 = x1 + components[:, cv2.CC_STAT_WIDTH] / self.scale + 2 * self.pad
+        y2 = y1 + components[:, cv2.CC_STAT_HEIGHT] / self.scale + 2 * self.pad
+        regions = [expand_box(box, w, h, self.min_size) for box in zip(x1, y1, x2, y2)]
+        regions = merge_boxes(regions)
+        if sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in regions) > self.full_frame * h * w:
+            return None
+        return regions
+
+    def infer(self, img, regions=None):
+        """Detections for img given its changed_regions(), and the inference time.
+
+        img may differ from the frame the regions were found on, e.g. be its
+        sharpened copy, as long as the shape is the same.
+        """
+        h, w = img.shape[:2]
+        self.frames += 1
+        self.frame_pixels += h * w
+        self.__since_full += 1
+
+        if regions is None or (self.refresh and self.__since_full >= self.refresh):
+            self.__detections, t = self.inference(img)
+            self.inferred_pixels += h * w
+            self.__since_full = 0
+            return self.__detections, t
+        if not regions:
+            self.skipped_frames += 1
+            return self.__detections, 0
+
+        detections, t = self.model.InferenceRegions(img, regions)
+        self.inferred_pixels += sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in regions)
+        # Keep the previous detections whose centres lie outside every inferred region
+        previous = self.__detections
+        if len(previous):
+            centres = (previous["box"][:, :2] + previous["box"][:, 2:]) / 2
+            inside = np.zeros(len(previous), dtype=bool)
+            for x1, y1, x2, y2 in regions:
+                inside |= ((centres >= (x1, y1)) & (centres < (x2, y2))).all(1)
+            detections = np.concatenate([previous[~inside], detections])
+            detections = detections[np.argsort(-detections["conf"], kind="stable")]
+        self.__detections = detections
+        return detections, t
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "skipped_frames": self.skipped_frames,
+            "inferred_pixels": self.inferred_pixels,
+            "inferred_fraction": self.inferred_pixels / self.frame_pixels if self.frame_pixels else 0.0,
+        }
@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+from src.boxes import expand_box, merge_boxes
+
+PROFILES = ("full", "crops")
+
+
+class PayloadEncoder:
+    """Encodes the image uploaded for a detection, following a payload profile.
+
+    "full" sends the whole frame. "crops" sends a crop around every
+    detection at native resolution, padded by pad times the box size and at
+    least min_crop pixels square, under a thumbnail_width wide thumbnail of
+    the frame, all packed into one JPEG. encode() also returns where each
+    crop came from, so the boxes can be found in the packed image.
+
+    The JPEG quality is `quality`. With adaptive=True it moves between
+    min_quality and quality in steps of quality_step, at most once every
+    adapt_interval seconds: down while the uploads waiting would take more
+    than target_delay seconds to send at the throughput measured over the
+    last `window` seconds, up while they would take less than half of that.
+
+    stats() reports the payloads encoded, their mean size and encode time,
+    and the bytes sent per detection.
+    """
+    def __init__(self, profile="full", quality=95, pad=1.0, min_crop=96, thumbnail_width=320, adaptive=False,
+                 min_quality=40, quality_step=10, target_delay=60.0, window=30.0, adapt_interval=1.0):
+        if profile not in PROFILES:
+            raise ValueError(f"unknown payload profile {profile!r}")
+        self.profile = profile
+        self.max_quality = quality
+        self.quality = quality
+        self.pad = pad
+        self.min_crop = min_crop
+        self.thumbnail_width = thumbnail_width
+        self.adaptive = adaptive
+        self.min_quality = min_quality
+        self.quality_step = quality_step
+        self.target_delay = target_delay
+        self.window = window
+        self.adapt_interval = adapt_interval
+        self.payloads = 0
+        self.payload_bytes = 0
+        self.encode_seconds = 0.0
+        self.detections = 0
+        self.__lock = threading.Lock()
+        self.__uploads = deque()
+        self.__adapted = 0.0
+
+    def encode(self, frame, detections):
+        """JPEG bytes for a frame and its DETECTION_DTYPE detections, and a description of the payload.
+
+        The description holds the profile and JPEG quality and, for "crops",
+        the frame and thumbnail sizes as [w, h] and, for every crop, its box
+        in the frame and the [x, y] it was placed at.
+        """
+        t = time.perf_counter()
+        quality = self.quality
+        if self.profile == "crops" and len(detections):
+            image, description = self.__pack(frame, detections)
+        else:
+            image, description = frame, {}
+        _, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        payload = buffer.tobytes()
+        description = {"profile": self.profile, "quality": quality, **description}
+        with self.__lock:
+            self.payloads += 1
+            self.payload_bytes += len(payload)
+            self.encode_seconds += time.perf_counter() - t
+            self.detections += len(detections)
+        return payload, description
+
+    def record_upload(self, nbytes):
+        """Counts a payload of nbytes that finished uploading."""
+        now = time.monotonic()
+        with self.__lock:
+            self.__uploads.append((now, nbytes))
+            while self.__uploads[0][0] < now - self.window:
+                self.__uploads.popleft()
+
+    def throughput(self):
+        """Bytes per second uploaded over the last window seconds, or None before anything was uploaded."""
+        now = time.monotonic()
+        with self.__lock:
+            sent = sum(nbytes for t, nbytes in self.__uploads if t >= now - self.window)
+            if not sent:
+                return None
+            return sent / min(self.window, max(now - self.__uploads[0][0], 1.0))
+
+    def adapt(self, pending):
+        """Steps the quality for `pending` uploads waiting to be sent, if adaptive."""
+        now = time.monotonic()
+        if not self.adaptive or now - self.__adapted < self.adapt_interval:
+            return self.quality
+        throughput = self.throughput()
+        if throughput is None or not self.payloads:
+            return self.quality
+        delay = pending * self.payload_bytes / self.payloads / throughput
+        if delay > self.target_delay and self.quality > self.min_quality:
+            self.quality = max(self.min_quality, self.quality - self.quality_step)
+            self.__adapted = now
+        elif delay < self.target_delay / 2 and self.quality < self.max_quality:
+            self.quality = min(self.max_quality, self.quality + self.quality_step)
+            self.__adapted = now
+        return self.quality
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "profile": self.profile,
+                "quality": self.quality,
+                "payloads": self.payloads,
+                "mean_bytes": self.payload_bytes / self.payloads if self.payloads else None,
+                "mean_encode_ms": self.encode_seconds / self.payloads * 1000 if self.payloads else None,
+                "bytes_per_detection": self.payload_bytes / self.detections if self.detections else None,
+            }
+
+    def __pack(self, frame, detections):
+        """The thumbnail with the crops shelved under it, left to right."""
+        h, w = frame.shape[:2]
+        tw = min(self.thumbnail_width, w)
+        th = max(1, round(h * tw / w))
+        thumbnail = cv2.resize(frame, (tw, th), interpolation=cv2.INTER_AREA)
+
+        regions = merge_boxes([expand_box(box, w, h, self.min_crop, self.pad) for box in detections["box"]])
+        width = max([tw] + [x2 - x1 for x1, y1, x2, y2 in regions])
+        placed, x, y, row = [], 0, th, 0
+        for x1, y1, x2, y2 in regions:
+            if x and x + x2 - x1 > width:
+                x, y, row = 0, y + row, 0
+            placed.append((x, y))
+            x += x2 - x1
+            row = max(row, y2 - y1)
+
+        image = np.zeros((y + row, width, 3), dtype=frame.dtype)
+        image[:th, :tw] = thumbnail
+        for (x1, y1, x2, y2), (x, y) in zip(regions, placed):
+            image[y:y + y2 - y1, x:x + x2 - x1] = frame[y1:y2, x1:x2]
+        return image, {
+            "frame": [w, h],
+            "thumbnail": [tw, th],
+            "crops": [{"box": list(region), "at": list(at)} for region, at in zip(regions, placed)],
+        }
@@ -0,0 +1,113 @@
+import queue
+import threading
+import time
+
+
+class InferencePipeline:
+    """Overlaps preprocessing, inference and post-processing of consecutive frames.
+
+    Each stage runs on its own thread, so while frame N executes on the backend
+    frame N+1 is letterboxed and frame N-1 is post-processed. Frames move
+    through bounded queues and a fixed pool of input buffers, so submit()
+    blocks once `depth` frames are waiting and results come out in order.
+    Detections are drawn on the submitted frames only if annotate is set.
+    """
+    def __init__(self, model, depth=2, annotate=False):
+        self.model = model
+        self.annotate = annotate
+        self.__buffers = queue.Queue()
+        for _ in range(depth):
+            self.__buffers.put(model.backend.allocate_input())
+        self.__inputs = queue.Queue(maxsize=depth)
+        self.__preprocessed = queue.Queue(maxsize=depth)
+        self.__inferred = queue.Queue(maxsize=depth)
+        self.__results = queue.Queue(maxsize=depth)
+        self.__error = None
+        self.__closed = False
+
+        self.__threads = [
+            threading.Thread(target=self.__run_stage, args=(self.__preprocess, self.__inputs, self.__preprocessed), daemon=True),
+            threading.Thread(target=self.__run_stage, args=(self.__infer, self.__preprocessed, self.__inferred), daemon=True),
+            threading.Thread(target=self.__run_stage, args=(self.__postprocess, self.__inferred, self.__results), daemon=True),
+        ]
+        for thread in self.__threads:
+            thread.start()
+
+    def submit(self, img, tag=None):
+        """Queues a frame, blocking while the pipeline is full.
+
+        tag is passed through untouched, e.g. the original frame or its timestamp.
+        """
+        self.__raise_error()
+        self.__inputs.put((img, tag))
+
+    def get(self, timeout=None):
+        """Next result as (img, tag, detections, inference time), in submission order."""
+        result = self.__results.get(timeout=timeout)
+        if result is None:
+            self.__raise_error()
+            raise queue.Empty
+        return result
+
+    def completed(self):
+        """Results that are ready now, without blocking."""
+        results = []
+        while True:
+            try:
+                results.append(self.get(timeout=0))
+            except queue.Empty:
+                return results
+
+    def close(self):
+        """Waits for frames in flight and returns their results."""
+        if self.__closed:
+            return []
+        self.__closed = True
+        self.__inputs.put(None)
+        results = []
+        while True:
+            result = self.__results.get()
+            if result is None:
+                break
+            results.append(result)
+        for thread in self.__threads:
+            thread.join()
+        self.__raise_error()
+        return results
+
+    def __raise_error(self):
+        if self.__error is not None:
+            raise self.__error
+
+    def __run_stage(self, stage, source, sink):
+        while True:
+            item = source.get()
+            if item is None:
+                sink.put(None)
+                return
+            if self.__error is not None:
+                continue  # drain until the sentinel so upstream stages never block
+            try:
+                sink.put(stage(*item))
+            except Exception as e:
+                self.__error = e
+                sink.put(None)
+
+    def __preprocess(self, img, tag):
+        buffer = self.__buffers.get()
+        _, _, origin_h, origin_w = self.model.PreProcessImg(img, buffer)
+        return img, tag, buffer, origin_h, origin_w
+
+    def __infer(self, img, tag, buffer, origin_h, origin_w):
+        t1 = time.time()
+        # The backend reuses its output buffer, so keep a copy per frame
+        output = self.model.backend.infer(buffer)[0].copy()
+        t2 = time.time()
+        self.__buffers.put(buffer)
+        return img, tag, output, origin_h, origin_w, t2 - t1
+
+    def __postprocess(self, img, tag, output, origin_h, origin_w, t):
+        dets = self.model.Detections(output, origin_h, origin_w)
+        if self.annotate:
+            self.model.Annotate(img, dets)
+        return img, tag, dets, t
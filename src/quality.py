@@ -0,0 +1,88 @@
+import json
+from collections import deque
+
+import cv2
+import numpy as np
+
+
+class QualityGate:
+    """Rejects blurry or badly exposed frames before they reach the detector.
+
+    Frames are scored on a downscaled grayscale copy: sharpness is the
+    variance of its Laplacian, exposure its mean brightness and the fraction
+    of pixels clipped to black or white in its histogram. check() returns
+    False for frames below min_sharpness, outside the brightness range or
+    with more than max_clipped of their pixels clipped.
+
+    stats() counts the frames skipped for each reason and summarises the
+    scores of the last `window` frames, so the thresholds can be tuned per
+    site; export() writes it as JSON.
+    """
+    def __init__(self, min_sharpness=100.0, min_brightness=40, max_brightness=220, max_clipped=0.5,
+                 scale=0.25, window=1000):
+        self.min_sharpness = min_sharpness
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.max_clipped = max_clipped
+        self.scale = scale
+        self.frames = 0
+        self.skipped = {"blurry": 0, "dark": 0, "bright": 0, "clipped": 0}
+        self.__scores = deque(maxlen=window)
+
+    def score(self, frame):
+        """(sharpness, brightness, clipped fraction) of a BGR frame."""
+        h, w = frame.shape[:2]
+        small = cv2.resize(frame, (max(1, int(w * self.scale)), max(1, int(h * self.scale))),
+                           interpolation=cv2.INTER_LINEAR)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        sharpness = cv2.Laplacian(gray, cv2.CV_32F).var()
+        hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+        brightness = hist @ np.arange(256) / gray.size
+        clipped = (hist[:8].sum() + hist[-8:].sum()) / gray.size
+        return float(sharpness), float(brightness), float(clipped)
+
+    def reason(self, sharpness, brightness, clipped):
+        """Why a frame with these scores is rejected, or None if it is usable."""
+        if sharpness < self.min_sharpness:
+            return "blurry"
+        if brightness < self.min_brightness:
+            return "dark"
+        if brightness > self.max_brightness:
+            return "bright"
+        if clipped > self.max_clipped:
+            return "clipped"
+        return None
+
+    def check(self, frame):
+        """Scores frame and returns whether it is worth running the detector on."""
+        scores = self.score(frame)
+        self.frames += 1
+        self.__scores.append(scores)
+        reason = self.reason(*scores)
+        if reason is not None:
+            self.skipped[reason] += 1
+        return reason is None
+
+    def stats(self):
+        stats = {
+            "frames": self.frames,
+            "skipped": dict(self.skipped),
+            "thresholds": {
+                "min_sharpness": self.min_sharpness,
+                "min_brightness": self.min_brightness,
+                "max_brightness": self.max_brightness,
+                "max_clipped": self.max_clipped,
+            },
+        }
+        if self.__scores:
+            scores = np.array(self.__scores)
+            percentiles = np.percentile(scores, [5, 50, 95], axis=0)
+            stats["recent"] = {
+                name: dict(zip(["p5", "p50", "p95"], percentiles[:, i].round(2).tolist()))
+                for i, name in enumerate(["sharpness", "brightness", "clipped"])
+            }
+        return stats
+
+    def export(self, path):
+        with open(path, "w") as f:
+            json.dump(self.stats(), f, indent=2)
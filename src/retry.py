@@ -0,0 +1,74 @@
+import random
+import time
+
+
+def backoff_delay(attempt, base=1.0, cap=300.0):
+    """Seconds to wait before retry number attempt (from 0), with full jitter.
+
+    Drawn uniformly up to base * 2**attempt, capped at cap, so clients
+    failing together do not retry together.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter:
+    """Token bucket letting through `rate` units, e.g. bytes, per second, in bursts of up to burst."""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.__tokens = self.burst
+        self.__last = time.monotonic()
+
+    def reserve(self, amount):
+        """Takes amount from the bucket and returns the seconds to wait before using it."""
+        now = time.monotonic()
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+        self.__tokens -= amount
+        return max(0.0, -self.__tokens / self.rate)
+
+
+class CircuitBreaker:
+    """Stops calls to a backend that keeps failing and probes it until it recovers.
+
+    The breaker opens after failure_threshold consecutive failures. While
+    open, allow() refuses every call until reset_timeout seconds have passed;
+    then it lets a single probe through (half open). A success closes it
+    again, a failure reopens it for another reset_timeout.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0  # times the breaker opened
+        self.__opened_at = 0.0
+
+    def allow(self):
+        """Whether a call may go out now."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.retry_in() == 0:
+            self.state = self.HALF_OPEN
+            return True
+        return False  # open, or a probe is already out
+
+    def retry_in(self):
+        """Seconds until an open breaker lets a probe through."""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.__opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened += 1
+            self.state = self.OPEN
+            self.__opened_at = time.monotonic()
@@ -0,0 +1,228 @@
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from src.detections import DETECTION_DTYPE
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+# get_batch orders, as SQL
+ORDERS = {
+    "oldest": "id",
+    "newest": "id DESC",
+    "confidence": "confidence DESC, id DESC",
+}
+
+
+def encode_data(data):
+    """Upload metadata as JSON, with the detections as (x1, y1, x2, y2, conf, class_id) rows."""
+    detections = data["detections"]
+    return json.dumps({
+        **data,
+        "timestamp": data["timestamp"].strftime(TIMESTAMP_FORMAT),
+        "detections": np.column_stack([detections["box"], detections["conf"], detections["class_id"]]).tolist(),
+    })
+
+
+def decode_data(text):
+    data = json.loads(text)
+    rows = np.array(data["detections"], dtype=np.float64).reshape(-1, 6)
+    detections = np.empty(len(rows), dtype=DETECTION_DTYPE)
+    detections["box"] = rows[:, :4]
+    detections["conf"] = rows[:, 4]
+    detections["class_id"] = rows[:, 5]
+    data["detections"] = detections
+    data["timestamp"] = datetime.strptime(data["timestamp"], TIMESTAMP_FORMAT)
+    return data
+
+
+class UploadSpool:
+    """Pending uploads kept in SQLite, so they survive crashes and power cuts.
+
+    put() commits the JPEG and its metadata before returning. Consumers
+    lease the oldest items with get_batch() and ack() them once uploaded.
+    Failed items are put back with retry(), which counts the attempt and
+    holds the item back for a delay, and items that were not tried with
+    release(). Leases are cleared on startup, so everything not acked is
+    handed out again after a restart. mark_uploaded() records that an
+    item's image is in Storage, so only its document is retried, and
+    reject() moves items whose document is refused for good to the
+    rejected table. Items are handed out oldest first,
+    or newest or most confident first, and trim() and trim_bytes() drop the
+    oldest to keep the spool under a count or a disk quota.
+
+    The database runs in WAL mode, where a put() only appends to the log.
+    synchronous="FULL" syncs every put to disk, "NORMAL" only at
+    checkpoints, which is faster but may lose the last puts on power loss.
+    """
+    def __init__(self, path="uploads.db", synchronous="FULL"):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute(f"PRAGMA synchronous={synchronous}")
+        self.__db.execute("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                data TEXT NOT NULL,
+                image BLOB NOT NULL,
+                created REAL NOT NULL,
+                leased INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                retry_at REAL NOT NULL DEFAULT 0,
+                size INTEGER NOT NULL DEFAULT 0,
+                confidence REAL NOT NULL DEFAULT 0,
+                uploaded INTEGER NOT NULL DEFAULT 0
+            )""")
+        self.__db.execute("""
+            CREATE TABLE IF NOT EXISTS rejected (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                data TEXT NOT NULL,
+                reason TEXT NOT NULL,
+                rejected REAL NOT NULL
+            )""")
+        # Spools written before retries, sizes, confidences and uploads were tracked
+        columns = [row[1] for row in self.__db.execute("PRAGMA table_info(uploads)")]
+        for column, definition in [("attempts", "INTEGER NOT NULL DEFAULT 0"), ("retry_at", "REAL NOT NULL DEFAULT 0"),
+                                   ("size", "INTEGER NOT NULL DEFAULT 0"), ("confidence", "REAL NOT NULL DEFAULT 0"),
+                                   ("uploaded", "INTEGER NOT NULL DEFAULT 0")]:
+            if column not in columns:
+                self.__db.execute(f"ALTER TABLE uploads ADD COLUMN {column} {definition}")
+        if "size" not in columns:
+            self.__db.execute("UPDATE uploads SET size = length(image)")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS uploads_leased ON uploads (leased, id)")
+        # Items leased before a crash were never acked
+        self.release_all()
+
+    def __len__(self):
+        with self.__lock:
+            return self.__db.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+
+    def pending(self):
+        """Items not leased yet."""
+        with self.__lock:
+            return self.__db.execute("SELECT COUNT(*) FROM uploads WHERE leased = 0").fetchone()[0]
+
+    def nbytes(self):
+        """Bytes of the images stored."""
+        with self.__lock:
+            return self.__db.execute("SELECT COALESCE(SUM(size), 0) FROM uploads").fetchone()[0]
+
+    def put(self, image, data, name):
+        """Stores an upload durably and returns its id."""
+        text = encode_data(data)
+        confidence = float(data["detections"]["conf"].max()) if len(data["detections"]) else 0.0
+        with self.__lock:
+            cursor = self.__db.execute(
+                "INSERT INTO uploads (name, data, image, created, size, confidence) VALUES (?, ?, ?, ?, ?, ?)",
+                (name, text, sqlite3.Binary(image), time.time(), len(image), confidence))
+            return cursor.lastrowid
+
+    def get_batch(self, size=16, order="oldest"):
+        """Leases up to size of the items due, in `order`, as (id, image, data, name, attempts, uploaded)."""
+        with self.__lock:
+            self.__db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.__db.execute(
+                    "SELECT id, image, data, name, attempts, uploaded FROM uploads WHERE leased = 0 AND retry_at <= ? "
+                    f"ORDER BY {ORDERS[order]} LIMIT ?", (time.time(), size)).fetchall()
+                if rows:
+                    self.__db.execute(f"UPDATE uploads SET leased = 1 WHERE id IN ({','.join('?' * len(rows))})",
+                                      [row[0] for row in rows])
+                self.__db.execute("COMMIT")
+            except BaseException:
+                self.__db.execute("ROLLBACK")
+                raise
+        return [(item_id, bytes(image), decode_data(data), name, attempts, bool(uploaded))
+                for item_id, image, data, name, attempts, uploaded in rows]
+
+    def ack(self, ids):
+        """Removes uploaded items."""
+        self.__update("DELETE FROM uploads", ids)
+
+    def mark_uploaded(self, ids):
+        """Records that the images of items are in Storage."""
+        self.__update("UPDATE uploads SET uploaded = 1", ids)
+
+    def reject(self, ids, reason):
+        """Moves items that can never be written to the rejected table, without their images."""
+        ids = list(ids)
+        if not ids:
+            return
+        marks = ",".join("?" * len(ids))
+        with self.__lock:
+            self.__db.execute("BEGIN IMMEDIATE")
+            try:
+                self.__db.execute(f"INSERT OR REPLACE INTO rejected (id, name, data, reason, rejected) "
+                                  f"SELECT id, name, data, ?, ? FROM uploads WHERE id IN ({marks})",
+                                  [reason, time.time(), *ids])
+                self.__db.execute(f"DELETE FROM uploads WHERE id IN ({marks})", ids)
+                self.__db.execute("COMMIT")
+            except BaseException:
+                self.__db.execute("ROLLBACK")
+                raise
+
+    def rejected(self):
+        """Number of items in the rejected table."""
+        with self.__lock:
+            return self.__db.execute("SELECT COUNT(*) FROM rejected").fetchone()[0]
+
+    def release(self, ids):
+        """Returns leased items to the spool, to be handed out again."""
+        self.__update("UPDATE uploads SET leased = 0", ids)
+
+    def release_all(self):
+        """Returns every leased item to the spool."""
+        with self.__lock:
+            self.__db.execute("UPDATE uploads SET leased = 0 WHERE leased = 1")
+
+    def retry(self, ids, delays):
+        """Returns failed items to the spool, each due again after its delay in seconds."""
+        now = time.time()
+        with self.__lock:
+            self.__db.executemany("UPDATE uploads SET leased = 0, attempts = attempts + 1, retry_at = ? WHERE id = ?",
+                                  [(now + delay, item_id) for item_id, delay in zip(ids, delays)])
+
+    def trim(self, max_items):
+        """Drops the oldest unleased items beyond max_items and returns how many were dropped."""
+        with self.__lock:
+            excess = self.__db.execute("SELECT COUNT(*) FROM uploads").fetchone()[0] - max_items
+            if excess <= 0:
+                return 0
+            return self.__db.execute(
+                "DELETE FROM uploads WHERE id IN (SELECT id FROM uploads WHERE leased = 0 ORDER BY id LIMIT ?)",
+                (excess,)).rowcount
+
+    def trim_bytes(self, max_bytes):
+        """Drops the oldest unleased items until the images take at most max_bytes, and returns how many were dropped."""
+        with self.__lock:
+            excess = self.__db.execute("SELECT COALESCE(SUM(size), 0) FROM uploads").fetchone()[0] - max_bytes
+            if excess <= 0:
+                return 0
+            ids = []
+            for item_id, size in self.__db.execute("SELECT id, size FROM uploads WHERE leased = 0 ORDER BY id"):
+                if excess <= 0:
+                    break
+                ids.append(item_id)
+                excess -= size
+            if not ids:
+                return 0
+            self.__db.execute(f"DELETE FROM uploads WHERE id IN ({','.join('?' * len(ids))})", ids)
+            return len(ids)
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+    def __update(self, statement, ids):
+        ids = list(ids)
+        if not ids:
+            return
+        with self.__lock:
+            self.__db.execute(f"{statement} WHERE id IN ({','.join('?' * len(ids))})", ids)
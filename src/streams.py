@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from src.capture import CameraCapture
+
+
+def read_sources(sources):
+    """Stream sources from a streams.txt style file, one per line, or a single source, as LoadStreams takes them."""
+    if isinstance(sources, str) and os.path.isfile(sources) and sources.endswith(".txt"):
+        with open(sources, "r") as f:
+            sources = [x.strip() for x in f.read().strip().splitlines() if len(x.strip())]
+    elif isinstance(sources, (str, int)):
+        sources = [sources]
+    return [int(s) if isinstance(s, str) and s.isnumeric() else s for s in sources]
+
+
+class StreamDetector:
+    """Runs one batched detector over several camera streams.
+
+    Like utils.datasets.LoadStreams every source is read on its own thread,
+    here a CameraCapture, but frames are never copied: each batch letterboxes
+    them straight into the backend input buffer. Iterating yields the results
+    of each batch as (stream, frame, detections) tuples until every stream
+    ended, which only video files do.
+    """
+    def __init__(self, model, sources, policies="latest", depth=2, fps=None):
+        self.model = model
+        self.sources = read_sources(sources)
+        # The CameraCapture drop policy of each stream, "latest" for live cameras or "block" to replay
+        # recorded video without dropping, and depth the frames a "queue" or "block" stream keeps
+        if isinstance(policies, str):
+            policies = [policies] * len(self.sources)
+        self.__ready = threading.Event()
+        self.captures = [
+            CameraCapture(source, fps=fps, policy=policy, depth=depth, ready=self.__ready)
+            for source, policy in zip(self.sources, policies)
+        ]
+        self.__latencies = [deque(maxlen=1000) for _ in self.captures]
+        self.__processed = [0] * len(self.captures)
+        self.__start = time.time()
+        self.__closed = False
+
+    def __iter__(self):
+        while not self.__closed and not all(capture.ended for capture in self.captures):
+            batch = self.next_batch(timeout=1)
+            if batch:
+                yield batch
+
+    def next_batch(self, timeout=None):
+        """Detections for the frames every stream has ready, waiting up to timeout for at least one."""
+        frames, streams, stamps = self.__collect()
+        if not frames:
+            self.__ready.wait(timeout)
+            self.__ready.clear()
+            frames, streams, stamps = self.__collect()
+        if not frames:
+            return []
+
+        detections, _ = self.model.InferenceBatch(frames)
+        done = time.time()
+        for stream, stamp in zip(streams, stamps):
+            self.__processed[stream] += 1
+            self.__latencies[stream].append(done - stamp)
+        return list(zip(streams, frames, detections))
+
+    def stats(self):
+        """Per stream frames processed, FPS, mean and p95 latency in ms, and frames captured and dropped."""
+        elapsed = time.time() - self.__start
+        stats = []
+        for capture, processed, latencies in zip(self.captures, self.__processed, self.__latencies):
+            latencies = np.array(latencies) * 1000
+            stats.append({
+                "processed": processed,
+                "fps": processed / elapsed if elapsed else 0.0,
+                "latency_ms": float(latencies.mean()) if len(latencies) else None,
+                "latency_p95_ms": float(np.percentile(latencies, 95)) if len(latencies) else None,
+                **capture.stats(),
+            })
+        return stats
+
+    def close(self):
+        self.__closed = True
+        for capture in self.captures:
+            capture.release()
+
+    def __collect(self):
+        """One frame from each stream that has one ready, without blocking."""
+        frames, streams, stamps = [], [], []
+        for stream, capture in enumerate(self.captures):
+            ret, frame = capture.read(timeout=0)
+            if ret:
+                frames.append(frame)
+                streams.append(stream)
+                stamps.append(capture.timestamp)
+        return frames, streams, stamps
@@ -0,0 +1,174 @@
+import numpy as np
+
+from src.boxes import box_iou
+
+# Constant velocity model over (cx, cy, area, aspect ratio), as in SORT
+F = np.eye(7, dtype=np.float64)
+F[0, 4] = F[1, 5] = F[2, 6] = 1
+H = np.eye(4, 7, dtype=np.float64)
+Q = np.diag([1, 1, 1, 1, 0.01, 0.01, 0.0001])
+R = np.diag([1, 1, 10, 10])
+P0 = np.diag([10, 10, 10, 10, 10000, 10000, 10000])
+
+
+def box_to_z(boxes):
+    """(N, 4) xyxy boxes to (N, 4) (cx, cy, area, aspect ratio) measurements."""
+    w = boxes[:, 2] - boxes[:, 0]
+    h = boxes[:, 3] - boxes[:, 1]
+    return np.stack([boxes[:, 0] + w / 2, boxes[:, 1] + h / 2, w * h, w / np.maximum(h, 1e-6)], 1)
+
+
+def z_to_box(z):
+    w = np.sqrt(np.maximum(z[:, 2] * z[:, 3], 0))
+    h = z[:, 2] / np.maximum(w, 1e-6)
+    return np.stack([z[:, 0] - w / 2, z[:, 1] - h / 2, z[:, 0] + w / 2, z[:, 1] + h / 2], 1)
+
+
+class Tracker:
+    """SORT-style tracker giving detections stable IDs across frames.
+
+    Every track is a Kalman filter over its box centre, area and aspect
+    ratio; all tracks are predicted and updated at once as stacked NumPy
+    arrays. Detections are matched to the predicted tracks of the same class
+    greedily by IoU. A track is confirmed after min_hits matches and removed
+    after max_age frames without one.
+
+    update() takes an optional payload, e.g. the frame, which each matched
+    track keeps while this is its most confident detection. finished()
+    returns every confirmed track once, with its best confidence and
+    payload, when it is removed or upload_after frames after it was first
+    seen, whichever comes first. flush() reports the rest, e.g. at shutdown.
+    """
+    def __init__(self, iou_threshold=0.3, max_age=15, min_hits=3, upload_after=50):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.upload_after = upload_after
+        self.next_id = 0
+        self.__x = np.zeros((0, 7))
+        self.__p = np.zeros((0, 7, 7))
+        self.__ids = np.zeros(0, dtype=np.int64)
+        self.__class_id = np.zeros(0, dtype=np.int64)
+        self.__hits = np.zeros(0, dtype=np.int64)
+        self.__misses = np.zeros(0, dtype=np.int64)
+        self.__age = np.zeros(0, dtype=np.int64)
+        self.__best_conf = np.zeros(0)
+        self.__reported = np.zeros(0, dtype=bool)
+        self.__payloads = []
+        self.__finished = []
+
+    def __len__(self):
+        return len(self.__ids)
+
+    def boxes(self):
+        """Current xyxy box of every track."""
+        return z_to_box(self.__x[:, :4])
+
+    def update(self, dets, payload=None):
+        """Advances every track by one frame and matches dets, a DETECTION_DTYPE array, to them.
+
+        Returns the track id of each detection, or -1 while its track is not confirmed.
+        """
+        self.__predict()
+        matches, unmatched = self.__match(dets)
+        track_ids = np.full(len(dets), -1, dtype=np.int64)
+
+        if len(matches):
+            t, d = matches[:, 0], matches[:, 1]
+            self.__correct(t, box_to_z(dets["box"][d].astype(np.float64)))
+            self.__hits[t] += 1
+            self.__misses[t] = 0
+            better = dets["conf"][d] > self.__best_conf[t]
+            for i, j in zip(t[better], d[better]):
+                self.__best_conf[i] = dets["conf"][j]
+                self.__payloads[i] = payload
+            confirmed = self.__hits[t] >= self.min_hits
+            track_ids[d[confirmed]] = self.__ids[t[confirmed]]
+
+        self.__add(dets[unmatched], payload)
+        self.__retire()
+        return track_ids
+
+    def finished(self):
+        """(track id, best confidence, payload) of the confirmed tracks that are done, each once."""
+        finished, self.__finished = self.__finished, []
+        return finished
+
+    def flush(self):
+        """finished() plus every confirmed track not reported yet, however young."""
+        self.__report((self.__hits >= self.min_hits) & ~self.__reported)
+        return self.finished()
+
+    def __predict(self):
+        # Keep the predicted area positive
+        shrinking = self.__x[:, 2] + self.__x[:, 6] <= 0
+        self.__x[shrinking, 6] = 0
+        self.__x = self.__x @ F.T
+        self.__p = F @ self.__p @ F.T + Q
+        self.__misses += 1
+        self.__age += 1
+
+    def __match(self, dets):
+        """(K, 2) matched (track, detection) indices and the unmatched detection indices."""
+        if not len(self.__ids) or not len(dets):
+            return np.zeros((0, 2), dtype=np.int64), np.arange(len(dets))
+        iou = box_iou(self.boxes(), dets["box"].astype(np.float64))
+        iou[self.__class_id[:, None] != dets["class_id"][None, :]] = 0
+
+        # Greedy assignment, highest IoU first
+        t, d = np.nonzero(iou >= self.iou_threshold)
+        order = np.argsort(-iou[t, d], kind="stable")
+        used_t = np.zeros(len(self.__ids), dtype=bool)
+        used_d = np.zeros(len(dets), dtype=bool)
+        matches = []
+        for i, j in zip(t[order], d[order]):
+            if not used_t[i] and not used_d[j]:
+                used_t[i] = used_d[j] = True
+                matches.append((i, j))
+        return np.array(matches, dtype=np.int64).reshape(-1, 2), np.nonzero(~used_d)[0]
+
+    def __correct(self, t, z):
+        x, p = self.__x[t], self.__p[t]
+        y = z - x @ H.T
+        s = H @ p @ H.T + R
+        k = p @ H.T @ np.linalg.inv(s)
+        self.__x[t] = x + (k @ y[:, :, None])[:, :, 0]
+        self.__p[t] = (np.eye(7) - k @ H) @ p
+
+    def __add(self, dets, payload):
+        n = len(dets)
+        if not n:
+            return
+        x = np.zeros((n, 7))
+        x[:, :4] = box_to_z(dets["box"].astype(np.float64))
+        self.__x = np.concatenate([self.__x, x])
+        self.__p = np.concatenate([self.__p, np.repeat(P0[None], n, 0)])
+        self.__ids = np.concatenate([self.__ids, np.arange(self.next_id, self.next_id + n)])
+        self.next_id += n
+        self.__class_id = np.concatenate([self.__class_id, dets["class_id"].astype(np.int64)])
+        self.__hits = np.concatenate([self.__hits, np.ones(n, dtype=np.int64)])
+        self.__misses = np.concatenate([self.__misses, np.zeros(n, dtype=np.int64)])
+        self.__age = np.concatenate([self.__age, np.zeros(n, dtype=np.int64)])
+        self.__best_conf = np.concatenate([self.__best_conf, dets["conf"].astype(np.float64)])
+        self.__reported = np.concatenate([self.__reported, np.zeros(n, dtype=bool)])
+        self.__payloads += [payload] * n
+
+    def __retire(self):
+        """Reports the tracks that are done and drops the ones that went stale."""
+        confirmed = self.__hits >= self.min_hits
+        stale = self.__misses > self.max_age
+        self.__report(confirmed & ~self.__reported & (stale | (self.__age >= self.upload_after)))
+
+        if stale.any():
+            keep = ~stale
+            self.__x, self.__p = self.__x[keep], self.__p[keep]
+            self.__ids, self.__class_id = self.__ids[keep], self.__class_id[keep]
+            self.__hits, self.__misses, self.__age = self.__hits[keep], self.__misses[keep], self.__age[keep]
+            self.__best_conf, self.__reported = self.__best_conf[keep], self.__reported[keep]
+            self.__payloads = [p for p, k in zip(self.__payloads, keep) if k]
+
+    def __report(self, report):
+        for i in np.nonzero(report)[0]:
+            self.__finished.append((int(self.__ids[i]), float(self.__best_conf[i]), self.__payloads[i]))
+            self.__payloads[i] = None  # reported, so the payload need not be kept any longer
+        self.__reported |= report
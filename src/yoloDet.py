@@ -1,143 +1,251 @@
 import cv2
 import numpy as np
-import tensorrt as trt
-import pycuda.autoinit
 import random
-import ctypes
-import pycuda.driver as cuda
 import time
+from collections import OrderedDict
 
+from src.backend import TRTBackend
+from src.detections import DETECTION_DTYPE
 
-EXPLICIT_BATCH = 1 << (int)(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH)
-host_inputs  = []
-cuda_inputs  = []
-host_outputs = []
-cuda_outputs = []
-bindings = []
+# Input shapes whose letterbox geometry and resize buffer are kept; motion crops come in any size
+LETTERBOX_CACHE_SIZE = 8
 
 
 class YoloTRT():
-    def __init__(self, library, engine, conf, yolo_ver):
+    def __init__(self, library=None, engine=None, conf=0.5, yolo_ver="v7", backend=None):
         self.CONF_THRESH = conf
         self.IOU_THRESHOLD = 0.1
-        self.LEN_ALL_RESULT = 601
         self.LEN_ONE_RESULT = 38
+        self.NMS_TOPK = 100
+        self.PAD_VALUE = np.float32(128) / np.float32(255.0)
+        self.__letterbox_cache = OrderedDict()
+        self.__tile_cache = {}
         self.yolo_version = yolo_ver
         # self.categories = ["Culex quinquefasciatus", "Aedes aegypti", "Aedes albopictus"]
         self.categories = ["Aedes mosquito", "Aedes mosquito", "Aedes mosquito"]
-        TRT_LOGGER = trt.Logger(trt.Logger.INFO)
 
-        ctypes.CDLL(library)
+        self.backend = backend if backend is not None else TRTBackend(library, engine)
+        self.backend.load()
+        self.batch_size = self.backend.batch_size
+        self.input_w = self.backend.input_w
+        self.input_h = self.backend.input_h
+        self.LEN_ALL_RESULT = self.backend.output_len
 
-        with open(engine, 'rb') as f:
-            serialized_engine = f.read()
+    def close(self):
+        self.backend.close()
 
-        runtime = trt.Runtime(TRT_LOGGER)
-        self.engine = runtime.deserialize_cuda_engine(serialized_engine)
-        self.batch_size = self.engine.max_batch_size
-
-        for binding in self.engine:
-            size = trt.volume(self.engine.get_binding_shape(binding)) * self.batch_size
-            dtype = trt.nptype(self.engine.get_binding_dtype(binding))
-            host_mem = cuda.pagelocked_empty(size, dtype)
-            cuda_mem = cuda.mem_alloc(host_mem.nbytes)
-
-            bindings.append(int(cuda_mem))
-            if self.engine.binding_is_input(binding):
-                self.input_w = self.engine.get_binding_shape(binding)[-1] * (self.batch_size ** 0.5)
-                self.input_h = self.engine.get_binding_shape(binding)[-2] * (self.batch_size ** 0.5)
-                host_inputs.append(host_mem)
-                cuda_inputs.append(cuda_mem)
+    def LetterboxGeometry(self, h, w):
+        """Resized size and padding for an (h, w) frame, cached for the last few input shapes."""
+        geometry = self.__letterbox_cache.get((h, w))
+        if geometry is not None:
+            self.__letterbox_cache.move_to_end((h, w))
+        else:
+            r_w = self.input_w / w
+            r_h = self.input_h / h
+            if r_h > r_w:
+                tw = self.input_w
+                th = int(r_w * h)
+                tx1 = 0
+                ty1 = int((self.input_h - th) / 2)
             else:
-                host_outputs.append(host_mem)
-                cuda_outputs.append(cuda_mem)
+                tw = int(r_h * w)
+                th = self.input_h
+                tx1 = int((self.input_w - tw) / 2)
+                ty1 = 0
+            resized = np.empty((th, tw, 3), dtype=np.uint8)
+            geometry = self.__letterbox_cache[(h, w)] = (tw, th, tx1, ty1, resized)
+            if len(self.__letterbox_cache) > LETTERBOX_CACHE_SIZE:
+                self.__letterbox_cache.popitem(last=False)
+        return geometry
+
+    def PreProcessImg(self, img, out=None):
+        """Letterboxes a BGR frame into a (1, 3, H, W) normalized RGB tensor.
 
-    def PreProcessImg(self, img):
+        Writes straight into out (e.g. a slot of the backend's pinned input
+        buffer) when given, so no intermediate full-frame copies are made.
+        """
         image_raw = img
         h, w, c = image_raw.shape
-        image = cv2.cvtColor(image_raw, cv2.COLOR_BGR2RGB)
-        r_w = self.input_w / w
-        r_h = self.input_h / h
-        if r_h > r_w:
-            tw = self.input_w
-            th = int(r_w * h)
-            tx1 = tx2 = 0
-            ty1 = int((self.input_h - th) / 2)
-            ty2 = self.input_h - th - ty1
-        else:
-            tw = int(r_h * w)
-            th = self.input_h
-            tx1 = int((self.input_w - tw) / 2)
-            tx2 = self.input_w - tw - tx1
-            ty1 = ty2 = 0
-        image = cv2.resize(image, (int(tw), int(th)))
-        image = cv2.copyMakeBorder(image, int(ty1), int(ty2), int(tx1), int(tx2), cv2.BORDER_CONSTANT, None, (128, 128, 128))
-        image = image.astype(np.float32)
-        image /= 255.0
-        image = np.transpose(image, [2, 0, 1])
-        image = np.expand_dims(image, axis=0)
-        image = np.ascontiguousarray(image)
-        return image, image_raw, h, w
+        if out is None:
+            out = np.empty((1, 3, self.input_h, self.input_w), dtype=np.float32)
+        tw, th, tx1, ty1, resized = self.LetterboxGeometry(h, w)
+        cv2.resize(image_raw, (tw, th), dst=resized)
+
+        image = out[0]
+        image[:, :ty1] = self.PAD_VALUE
+        image[:, ty1 + th:] = self.PAD_VALUE
+        image[:, ty1:ty1 + th, :tx1] = self.PAD_VALUE
+        image[:, ty1:ty1 + th, tx1 + tw:] = self.PAD_VALUE
+        for i in range(3):
+            # BGR -> RGB by reading channels in reverse
+            np.divide(resized[:, :, 2 - i], np.float32(255.0), out=image[i, ty1:ty1 + th, tx1:tx1 + tw], dtype=np.float32)
+        return out, image_raw, h, w
 
     def Inference(self, img):
-        input_image, image_raw, origin_h, origin_w = self.PreProcessImg(img)
-        np.copyto(host_inputs[0], input_image.ravel())
-        stream = cuda.Stream()
-        self.context = self.engine.create_execution_context()
-        cuda.memcpy_htod_async(cuda_inputs[0], host_inputs[0], stream)
-        t1 = time.time()
-        self.context.execute_async(self.batch_size, bindings, stream_handle=stream.handle)
-        cuda.memcpy_dtoh_async(host_outputs[0], cuda_outputs[0], stream)
-        stream.synchronize()
-        t2 = time.time()
-        output = host_outputs[0]
-
-        for i in range(self.batch_size):
-            result_boxes, result_scores, result_classid = self.PostProcess(output[i*self.LEN_ALL_RESULT:(i+1)*self.LEN_ALL_RESULT], origin_h, origin_w)
+        det_res, t = self.InferenceBatch([img])
+        return det_res[0], t[0]
 
+    def InferenceBatch(self, frames):
+        """Runs frames through the backend batch_size at a time.
+
+        Each chunk is letterboxed into one input tensor and inferred with a
+        single engine call; a partial last chunk runs with a smaller batch.
+        Returns the detections of every frame, in order, and each frame's
+        share of its chunk's inference time.
+        """
+        input_buffer = self.backend.input_buffer
         det_res = []
-        for j in range(len(result_boxes)):
-            box = result_boxes[j]
-            det = dict()
-            det["class"] = self.categories[int(result_classid[j])]
-            det["conf"] = result_scores[j]
-            det["box"] = box
-            det_res.append(det)
-            self.PlotBbox(box, img, label="{}:{:.2f}".format("Aedes mosquito", result_scores[j]),)
-        return det_res, t2-t1
+        t = []
+        for start in range(0, len(frames), self.batch_size):
+            chunk = frames[start:start + self.batch_size]
+            shapes = []
+            for i, img in enumerate(chunk):
+                _, _, origin_h, origin_w = self.PreProcessImg(img, input_buffer[i:i + 1])
+                shapes.append((origin_h, origin_w))
+            t1 = time.time()
+            output = self.backend.infer(input_buffer[:len(chunk)])
+            t2 = time.time()
 
-    def PostProcess(self, output, origin_h, origin_w):
+            for out, (origin_h, origin_w) in zip(output, shapes):
+                det_res.append(self.Detections(out, origin_h, origin_w))
+                t.append((t2 - t1) / len(chunk))
+        return det_res, t
+
+    def InferenceTiled(self, img, tile_size=640, overlap=0.2):
+        """Detects on overlapping tile_size crops of the full-resolution frame.
+
+        Small objects keep their native resolution instead of being squashed
+        into a single letterbox. Returns the detections and the total
+        inference time.
+        """
+        h, w = img.shape[:2]
+        regions = [(x, y, min(x + tile_size, w), min(y + tile_size, h))
+                   for x, y in self.TileGrid(h, w, tile_size, overlap)]
+        return self.InferenceRegions(img, regions)
+
+    def InferenceRegions(self, img, regions):
+        """Detects on the (x1, y1, x2, y2) crops of a frame.
+
+        The crops are inferred batch_size at a time, their boxes mapped back
+        to frame coordinates and merged across crops with one NMS. Returns
+        the detections and the total inference time.
+        """
+        h, w = img.shape[:2]
+        input_buffer = self.backend.input_buffer
+        boxes = [np.zeros((0, 6), dtype=np.float32)]
+        t = 0
+        for start in range(0, len(regions), self.batch_size):
+            chunk = regions[start:start + self.batch_size]
+            for i, (x1, y1, x2, y2) in enumerate(chunk):
+                self.PreProcessImg(img[y1:y2, x1:x2], input_buffer[i:i + 1])
+            t1 = time.time()
+            output = self.backend.infer(input_buffer[:len(chunk)])
+            t += time.time() - t1
+
+            for out, (x1, y1, x2, y2) in zip(output, chunk):
+                crop_boxes = self.ScaleBoxes(self.Predictions(out), y2 - y1, x2 - x1, conf_thres=self.CONF_THRESH)
+                crop_boxes[:, [0, 2]] += x1
+                crop_boxes[:, [1, 3]] += y1
+                boxes.append(crop_boxes)
+
+        boxes = np.concatenate(boxes)
+        boxes = self.Suppress(boxes[np.argsort(-boxes[:, 4])], max(h, w), self.IOU_THRESHOLD)
+        if not len(boxes):
+            return self.DetectionArray([], [], []), t
+        return self.DetectionArray(boxes[:, :4], boxes[:, 4], boxes[:, 5]), t
+
+    def TileGrid(self, h, w, tile_size, overlap):
+        """Top-left corners of the tiles covering an (h, w) frame, cached per shape."""
+        if not 0 <= overlap < 1:
+            raise ValueError(f"tile overlap must be in [0, 1), got {overlap!r}")
+        key = (h, w, tile_size, overlap)
+        grid = self.__tile_cache.get(key)
+        if grid is None:
+            def starts(length):
+                if length <= tile_size:
+                    return [0]
+                # Evenly spread tiles so neighbours overlap by at least `overlap`
+                n = int(np.ceil((length - tile_size) / (tile_size * (1 - overlap)))) + 1
+                return np.linspace(0, length - tile_size, n).round().astype(int).tolist()
+            grid = self.__tile_cache[key] = [(x, y) for y in starts(h) for x in starts(w)]
+        return grid
+
+    def Detections(self, output, origin_h, origin_w):
+        """Post-processes one frame's output into a DETECTION_DTYPE array."""
+        return self.DetectionArray(*self.PostProcess(output, origin_h, origin_w))
+
+    def DetectionArray(self, boxes, scores, classid):
+        dets = np.empty(len(boxes), dtype=DETECTION_DTYPE)
+        if len(dets):
+            dets["box"] = boxes
+            dets["conf"] = scores
+            dets["class_id"] = classid
+        return dets
+
+    def Annotate(self, img, dets):
+        """Draws detections on img in place."""
+        for box, conf, class_id in dets:
+            self.PlotBbox(box, img, label="{}:{:.2f}".format(self.categories[class_id], conf),)
+
+    def Predictions(self, output):
+        """(num, 6) rows of (cx, cy, w, h, conf, class_id) from one plugin output."""
         num = int(output[0])
         if self.yolo_version == "v5":
             pred = np.reshape(output[1:], (-1, self.LEN_ONE_RESULT))[:num, :]
             pred = pred[:, :6]
         elif self.yolo_version == "v7":
             pred = np.reshape(output[1:], (-1, 6))[:num, :]
+        return pred
 
-        boxes = self.NonMaxSuppression(pred, origin_h, origin_w, conf_thres=self.CONF_THRESH, nms_thres=self.IOU_THRESHOLD)
+    def PostProcess(self, output, origin_h, origin_w):
+        pred = self.Predictions(output)
+        if self.backend.nms_in_graph:
+            boxes = self.ScaleBoxes(pred, origin_h, origin_w, conf_thres=self.CONF_THRESH)
+        else:
+            boxes = self.NonMaxSuppression(pred, origin_h, origin_w, conf_thres=self.CONF_THRESH, nms_thres=self.IOU_THRESHOLD)
         result_boxes = boxes[:, :4] if len(boxes) else np.array([])
         result_scores = boxes[:, 4] if len(boxes) else np.array([])
         result_classid = boxes[:, 5] if len(boxes) else np.array([])
         return result_boxes, result_scores, result_classid
 
-    def NonMaxSuppression(self, prediction, origin_h, origin_w, conf_thres=0.5, nms_thres=0.4):
+    def ScaleBoxes(self, prediction, origin_h, origin_w, conf_thres=0.5):
+        """Keeps boxes above conf_thres in original frame xyxy, sorted by confidence."""
         boxes = prediction[prediction[:, 4] >= conf_thres]
+        if len(boxes) > self.NMS_TOPK:
+            boxes = boxes[np.argpartition(-boxes[:, 4], self.NMS_TOPK)[:self.NMS_TOPK]]
         boxes[:, :4] = self.xywh2xyxy(origin_h, origin_w, boxes[:, :4])
         boxes[:, 0] = np.clip(boxes[:, 0], 0, origin_w -1)
         boxes[:, 2] = np.clip(boxes[:, 2], 0, origin_w -1)
         boxes[:, 1] = np.clip(boxes[:, 1], 0, origin_h -1)
         boxes[:, 3] = np.clip(boxes[:, 3], 0, origin_h -1)
         confs = boxes[:, 4]
-        boxes = boxes[np.argsort(-confs)]
-        keep_boxes = []
-        while boxes.shape[0]:
-            large_overlap = self.bbox_iou(np.expand_dims(boxes[0, :4], 0), boxes[:, :4]) > nms_thres
-            label_match = boxes[0, -1] == boxes[:, -1]
-            # Indices of boxes with lower confidence scores, large IOUs and matching labels
-            invalid = large_overlap & label_match
-            keep_boxes += [boxes[0]]
-            boxes = boxes[~invalid]
-        boxes = np.stack(keep_boxes, 0) if len(keep_boxes) else np.array([])
+        return boxes[np.argsort(-confs)]
+
+    def NonMaxSuppression(self, prediction, origin_h, origin_w, conf_thres=0.5, nms_thres=0.4):
+        boxes = self.ScaleBoxes(prediction, origin_h, origin_w, conf_thres)
+        return self.Suppress(boxes, max(origin_h, origin_w), nms_thres)
+
+    def Suppress(self, boxes, extent, nms_thres=0.4):
+        """Greedy per-class NMS over (x1, y1, x2, y2, conf, class_id) rows sorted by confidence.
+
+        extent bounds the box coordinates and is used to offset the classes.
+        """
+        # Shift each class into its own region so boxes of different classes never overlap
+        offset_boxes = boxes[:, :4] + boxes[:, 5:6] * (extent + 1)
+        iou = self.bbox_iou(offset_boxes[:, None], offset_boxes[None, :])
+        # overlap[i, j]: lower scoring box j is suppressed if box i is kept
+        overlap = np.triu(iou > nms_thres, 1)
+
+        # Greedy NMS is the fixed point of keep[j] = not any(keep[i] and overlap[i, j]).
+        # Every pass settles at least one more box, so it ends after at most N passes of O(N^2) each:
+        # a chain of N boxes each overlapping the next takes all N, clustered detections only a few.
+        keep = np.ones(len(boxes), dtype=bool)
+        while True:
+            new_keep = ~(overlap & keep[:, None]).any(0)
+            if np.array_equal(new_keep, keep):
+                break
+            keep = new_keep
+        boxes = boxes[keep] if keep.any() else np.array([])
         return boxes
 
     def xywh2xyxy(self, origin_h, origin_w, x):
@@ -159,16 +267,17 @@ class YoloTRT():
         return y
 
     def bbox_iou(self, box1, box2, x1y1x2y2=True):
+        # Boxes are indexed on the last axis, so (N, 1, 4) and (1, M, 4) give an (N, M) matrix
         if not x1y1x2y2:
             # Transform from center and width to exact coordinates
-            b1_x1, b1_x2 = box1[:, 0] - box1[:, 2] / 2, box1[:, 0] + box1[:, 2] / 2
-            b1_y1, b1_y2 = box1[:, 1] - box1[:, 3] / 2, box1[:, 1] + box1[:, 3] / 2
-            b2_x1, b2_x2 = box2[:, 0] - box2[:, 2] / 2, box2[:, 0] + box2[:, 2] / 2
-            b2_y1, b2_y2 = box2[:, 1] - box2[:, 3] / 2, box2[:, 1] + box2[:, 3] / 2
+            b1_x1, b1_x2 = box1[..., 0] - box1[..., 2] / 2, box1[..., 0] + box1[..., 2] / 2
+            b1_y1, b1_y2 = box1[..., 1] - box1[..., 3] / 2, box1[..., 1] + box1[..., 3] / 2
+            b2_x1, b2_x2 = box2[..., 0] - box2[..., 2] / 2, box2[..., 0] + box2[..., 2] / 2
+            b2_y1, b2_y2 = box2[..., 1] - box2[..., 3] / 2, box2[..., 1] + box2[..., 3] / 2
         else:
             # Get the coordinates of bounding boxes
-            b1_x1, b1_y1, b1_x2, b1_y2 = box1[:, 0], box1[:, 1], box1[:, 2], box1[:, 3]
-            b2_x1, b2_y1, b2_x2, b2_y2 = box2[:, 0], box2[:, 1], box2[:, 2], box2[:, 3]
+            b1_x1, b1_y1, b1_x2, b1_y2 = box1[..., 0], box1[..., 1], box1[..., 2], box1[..., 3]
+            b2_x1, b2_y1, b2_x2, b2_y2 = box2[..., 0], box2[..., 1], box2[..., 2], box2[..., 3]
 
         inter_rect_x1 = np.maximum(b1_x1, b2_x1)
         inter_rect_y1 = np.maximum(b1_y1, b2_y1)
@@ -1,16 +1,16 @@
 import cv2
 import imutils
+import numpy as np
 from datetime import datetime
 from src.yoloDet import YoloTRT
 from src.location import LocationManager
 from src.firebase import DetectionUploader
 
 
-def scale_coords(coords, orig_shape, small_shape):
-    x1, y1, x2, y2 = coords
+def scale_coords(boxes, orig_shape, small_shape):
     scale_x = orig_shape[1] / small_shape[1]
     scale_y = orig_shape[0] / small_shape[0]
-    return int(x1 * scale_x), int(y1 * scale_y), int(x2 * scale_x), int(y2 * scale_y)
+    return np.trunc(boxes * np.array([scale_x, scale_y, scale_x, scale_y]))
 
 
 def run_detection(image_path):
@@ -33,30 +33,26 @@ def run_detection(image_path):
     detections, t = model.Inference(small_frame)
     fps = round(1 / t, 2)
 
-    if detections:
+    if len(detections):
         lat, lon = location_manager.current_location()
         current_time = datetime.now()
-        processed_detections = []
+        names = np.array(model.categories)[detections["class_id"]]
+        processed_detections = detections[np.isin(names, ["Aedes aegypti", "Aedes albopictus"])]
+        processed_detections["box"] = scale_coords(processed_detections["box"], frame.shape, small_frame.shape)
 
-        for detection in detections:
-            if detection['class'] in ["Aedes aegypti", "Aedes albopictus"]:
-                x1, y1, x2, y2 = scale_coords(detection['box'], frame.shape, small_frame.shape)
-                cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 1)
-                cv2.putText(frame, f"FPS: {fps}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 1)
-                processed_detections.append({
-                    "class": detection['class'],
-                    "confidence": detection['conf'],
-                    "box": [x1, y1, x2, y2]
-                })
+        for (x1, y1, x2, y2), conf, class_id in processed_detections:
+            cv2.rectangle(frame, (int(x1), int(y1)), (int(x2), int(y2)), (0, 255, 0), 1)
+            cv2.putText(frame, f"FPS: {fps}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 1)
 
-        if processed_detections:
+        if len(processed_detections):
             print(f"Detected mosquito at {lat}, {lon} at {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
             _, buffer = cv2.imencode(".jpg", frame)
             database_manager.schedule_for_upload(buffer.tobytes(), {
                 "timestamp": current_time,
                 "latitude": lat,
                 "longitude": lon,
-                "detections": processed_detections
+                "detections": processed_detections,
+                "classes": model.categories
             })
 
     # Always display the image